@@ -0,0 +1,305 @@
+'''
+Non-blocking sends for the email providers, with optional hedged failover.
+
+This code base runs on Python 2 (the Mandrill client is called with async=False, a syntax
+error on Python 3.7+) so there is no asyncio. send_async hands the blocking provider call to
+a shared, bounded pool of threads and returns a SendFuture right away, so the caller can keep
+many sends in flight without a thread of its own for each of them.
+'''
+from abc import ABCMeta, abstractmethod
+from simple_email import ErrorResult, RateLimitedResult, MandrillEmail, MailgunEmail, SmtpEmail, provider_router, simple_validate_send_request, \
+    check_suppressed, check_sender_rate, resolve_template, suppress_recipient, lane_busy_result
+from rate_limit import RateLimited
+from retry import is_retryable
+from scheduler import LaneBusy, get_lane_scheduler, lane_of
+import Queue, logging, threading, config, metrics
+
+logger = logging.getLogger('simple_email')
+
+
+class SendFuture(object):
+    ''' The pending Result of a send '''
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        ''' Wait for the Result, returns None if it is not there after timeout seconds '''
+        self._done.wait(timeout)
+        return self._result
+
+    def add_done_callback(self, callback):
+        ''' Call callback(future) once the Result is set, right away if it already is '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        with self._lock:
+            self._result = result
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("Get an exception from a send callback!")
+
+
+class SendExecutor(object):
+    ''' A bounded pool of threads running the blocking provider calls, the threads start on first use '''
+
+    def __init__(self, size=None):
+        self.size = size or config.ASYNC_SEND_THREADS
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args):
+        ''' Run function(*args) on the pool, returns a SendFuture for its Result '''
+        future = SendFuture()
+        self._start()
+        self._tasks.put((future, function, args))
+        return future
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._run, name="async-send-%s" % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            future, function, args = self._tasks.get()
+            try:
+                result = function(*args)
+            except Exception:
+                logger.exception("Get an exception when sending the email!")
+                result = ErrorResult("Sorry! We cannot send email for now. Please try later.")
+            future.set_result(result)
+
+
+executor = SendExecutor()
+
+
+class AsyncSimpleEmail(object):
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def send_async(self, message_data):
+        ''' Start sending the email, returns a SendFuture of the Result '''
+        pass
+
+
+class AsyncProviderEmail(AsyncSimpleEmail):
+    ''' Runs the blocking provider through provider_router so its circuit breaker is kept up to date '''
+    provider = None
+
+    def send_async(self, message_data):
+        return executor.submit(self._send, message_data)
+
+    def _send(self, message_data):
+        try:
+            result = provider_router.send(self.provider, message_data)
+        except RateLimited as e:
+            return RateLimitedResult(e.retry_after)
+        if result is None:
+            return ErrorResult("%s is not available" % self.provider.name, 503)
+        suppress_recipient(message_data['to_email'], result, self.provider.name)
+        return result
+
+
+class AsyncMandrillEmail(AsyncProviderEmail):
+    provider = MandrillEmail
+
+
+class AsyncMailgunEmail(AsyncProviderEmail):
+    provider = MailgunEmail
+
+
+class AsyncSmtpEmail(AsyncProviderEmail):
+    provider = SmtpEmail
+
+
+ASYNC_PROVIDERS = dict((async_provider.provider.name, async_provider) for async_provider in (AsyncMandrillEmail, AsyncMailgunEmail, AsyncSmtpEmail))
+
+
+def send_email_async(message_data, hedge_after=None):
+    ''' Validate and send an email without blocking, the async counterpart of send_email
+
+    Args:
+        message_data: same as send_email
+        hedge_after: seconds to wait for the first provider before also sending through the next one,
+                     defaults to config.HEDGE_AFTER, None sends through one provider at a time (plain failover)
+
+    Returns:
+        a SendFuture of the Result
+    '''
+    message_data, result = resolve_template(message_data)
+    result = result or simple_validate_send_request(message_data) or check_suppressed(message_data) or check_sender_rate(message_data)
+    if result is not None:
+        future = SendFuture()
+        future.set_result(result)
+        return future
+    if hedge_after is None:
+        hedge_after = config.HEDGE_AFTER
+    return HedgedSend(message_data, hedge_after).start()
+
+
+class HedgedSend(object):
+    ''' Sends one message through the ranked providers and resolves its future with the first success
+
+    Each provider is tried at most once. The next provider is started when the current one fails or, if
+    hedge_after is set, when the current call has been on the wire for hedge_after seconds: the time spent
+    waiting for an executor thread doesn't count. A provider call only goes out if the email isn't sent yet
+    when its thread picks it up, and once a provider succeeded no other provider is started.
+    A provider call that is already on the wire cannot be taken back though: if the hedged call and the slow
+    one both end up succeeding the email was delivered twice, this is logged. Keep hedge_after well above the
+    normal latency of the first provider so hedging only kicks in when it is really stuck.
+
+    The bookkeeping is the one of deliver_email: the email holds a slot of its priority lane while it's sent,
+    a recipient rejected for good is suppressed without trying the other providers, and the failovers and
+    the final outcome are counted in the metrics.
+    '''
+
+    def __init__(self, message_data, hedge_after=None):
+        self.message_data = message_data
+        self.hedge_after = hedge_after
+        self.providers = [ASYNC_PROVIDERS[provider.name]() for provider in provider_router.ranked()]
+        self.future = SendFuture()
+        self._lock = threading.Lock()
+        self._started = 0
+        self._in_flight = 0
+        self._resolved = False
+        self._rejected_result = None
+        self._retry_after = None
+        self._retryable = False
+        self._lane = None
+        self._timer = None
+        self._start_time = metrics.clock()
+
+    def start(self):
+        with self._lock:
+            provider = self._start_next()
+        if provider is None:
+            self._finish(ErrorResult("Sorry! We cannot send email for now. Please try later."))
+        else:
+            self._dispatch(provider)
+        return self.future
+
+    def _start_next(self):
+        # must hold self._lock, returns the provider to start or None when there is nothing left to try
+        if self._resolved or self._started >= len(self.providers):
+            return None
+        provider = self.providers[self._started]
+        self._started += 1
+        self._in_flight += 1
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return provider
+
+    def _dispatch(self, provider):
+        # outside of self._lock since the callback runs right away if the send is already done
+        future = executor.submit(self._call, provider)
+        future.add_done_callback(lambda future: self._on_result(provider, future.result()))
+
+    def _call(self, provider):
+        # on an executor thread, the lane slot is taken before the first provider call and kept until the email is done
+        if self._lane is None:
+            lane = lane_of(self.message_data)
+            try:
+                get_lane_scheduler().acquire(lane, self.message_data['from_email'])
+            except LaneBusy as e:
+                return lane_busy_result(e)
+            self._lane = lane
+        with self._lock:
+            if self._resolved:
+                # sent by another provider while this call waited for a thread
+                return None
+            if self.hedge_after is not None and self._started < len(self.providers):
+                self._timer = threading.Timer(self.hedge_after, self._hedge, (provider,))
+                self._timer.daemon = True
+                self._timer.start()
+        try:
+            return provider._send(self.message_data)
+        except Exception:
+            logger.exception("Get an exception when calling %s to send the email!", provider.provider.name)
+            result = ErrorResult("Sorry! We cannot send email for now. Please try later.")
+            result.retryable = True
+            return result
+
+    def _hedge(self, slow_provider):
+        started = None
+        with self._lock:
+            if not self._resolved and self._in_flight:
+                logger.debug("No answer from %s within %ss, hedging with the next provider", slow_provider.provider.name, self.hedge_after)
+                started = self._start_next()
+        if started is not None:
+            metrics.FAILOVERS.inc(provider=slow_provider.provider.name)
+            self._dispatch(started)
+
+    def _on_result(self, provider, result):
+        started = final_result = None
+        name = provider.provider.name
+        with self._lock:
+            self._in_flight -= 1
+            if self._resolved:
+                if result is not None and result.status == "success":
+                    logger.warning("%s also sent an email that was already sent by another provider", name)
+                return
+            if self._lane is None:
+                # no slot in the lane, the email is given up without calling any provider
+                final_result = result
+            elif result.status == "success":
+                final_result = result
+            elif suppress_recipient(self.message_data['to_email'], result, name):
+                # the other providers would reject the recipient too
+                final_result = result
+            else:
+                if result.status == "rejected" and self._rejected_result is None:
+                    self._rejected_result = result
+                if isinstance(result, RateLimitedResult):
+                    self._retry_after = result.retry_after if self._retry_after is None else min(self._retry_after, result.retry_after)
+                else:
+                    self._retryable = self._retryable or is_retryable(result)
+                if self._in_flight == 0:
+                    started = self._start_next()
+                    if started is None:
+                        final_result = self._final_error()
+            if final_result is not None:
+                self._resolved = True
+                if self._timer is not None:
+                    self._timer.cancel()
+        if started is not None:
+            metrics.FAILOVERS.inc(provider=name)
+            self._dispatch(started)
+        if final_result is not None:
+            self._finish(final_result)
+
+    def _final_error(self):
+        # the Result when no provider sent the email, like try_providers
+        if self._rejected_result is not None:
+            return self._rejected_result
+        if self._retry_after is not None:
+            return RateLimitedResult(self._retry_after)
+        result = ErrorResult("Sorry! We cannot send email for now. Please try later.")
+        result.retryable = self._retryable
+        return result
+
+    def _finish(self, result):
+        if self._lane is not None:
+            get_lane_scheduler().release(self._lane)
+        metrics.STAGE_LATENCY.observe_since(self._start_time, stage="delivery")
+        metrics.REQUESTS.inc(outcome=metrics.outcome(result))
+        self.future.set_result(result)
@@ -0,0 +1,292 @@
+'''
+Attachments of the emails, kept on disk and streamed to the providers.
+
+An attachment is a dict {'name', 'type', 'path', 'size', 'sha1'}: spool() copies an uploaded file
+into config.ATTACHMENT_DIR, hashing it on the way. When an email is sent, the files are read through
+mmap and encoded a chunk at a time while the request body goes out. A worker sending several large
+attachments at once therefore holds a few chunks of each, not whole copies.
+
+Mandrill and SMTP take the attachments base64 encoded. The encodings are cached on disk by content
+hash (EncodedCache), so a file sent to many recipients is encoded only once.
+'''
+import base64, hashlib, mmap, os, re, shutil, threading, urllib, uuid, config
+
+# raw bytes read at a time, a multiple of 57 so each chunk encodes to whole 76 character base64 lines
+CHUNK_SIZE = 57 * 1024
+
+# line length of base64 in MIME (RFC 2045)
+MIME_LINE_LENGTH = 76
+
+# a type/subtype media type without parameters, the characters of RFC 6838
+MIME_TYPE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9!#$&^_.+-]*/[A-Za-z0-9][A-Za-z0-9!#$&^_.+-]*$')
+
+# the control characters, CR and LF included, that would break out of a header
+CONTROL_CHARACTERS = re.compile(u'[\x00-\x1f\x7f]')
+
+
+def spool(stream, name, content_type=None, directory=None):
+    ''' Copy a file object into the attachment directory
+
+    Returns:
+        the attachment dict
+    '''
+    directory = directory or config.ATTACHMENT_DIR
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, uuid.uuid4().hex)
+    digest = hashlib.sha1()
+    size = 0
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+    return {'name': clean_name(name), 'type': clean_type(content_type), 'path': path, 'size': size,
+            'sha1': digest.hexdigest()}
+
+
+def clean_name(name):
+    ''' The file name without the control characters, the name is user supplied and goes into the MIME headers '''
+    return CONTROL_CHARACTERS.sub('', name)
+
+
+def clean_type(content_type):
+    ''' The content type if it is a plain media type, application/octet-stream otherwise '''
+    return content_type if content_type and MIME_TYPE.match(content_type) else 'application/octet-stream'
+
+
+def disposition_filename(name):
+    # the filename parameters of a Content-Disposition header: an ASCII fallback and the RFC 2231 encoding of the name
+    name = clean_name(name.decode('utf-8', 'replace') if isinstance(name, str) else name)
+    fallback = name.encode('ascii', 'replace').replace('\\', '_').replace('"', '_')
+    return 'filename="%s"; filename*=utf-8\'\'%s' % (fallback, urllib.quote(name.encode('utf-8'), safe=''))
+
+
+def remove(attachments):
+    ''' Delete the spooled files of a message's attachments, once it was sent or given up on '''
+    for attachment in attachments or ():
+        try:
+            os.remove(attachment['path'])
+        except OSError:
+            pass
+
+
+def file_chunks(path, chunk_size=CHUNK_SIZE):
+    ''' The content of a file, chunk_size bytes at a time, read through mmap '''
+    with open(path, 'rb') as f:
+        for chunk in mapped_chunks(f, chunk_size):
+            yield chunk
+
+
+def mapped_chunks(f, chunk_size):
+    size = os.fstat(f.fileno()).st_size
+    if not size:
+        # mmap refuses empty files
+        return
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for offset in xrange(0, size, chunk_size):
+            yield mapped[offset:offset + chunk_size]
+    finally:
+        mapped.close()
+
+
+class FilePart(object):
+    ''' A file in a StreamingBody, optionally broken into CRLF separated lines
+
+    The file is opened right away: a cached encoding evicted in the meantime stays readable.
+    '''
+
+    def __init__(self, path, line_length=None):
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.line_length = line_length
+
+    def __len__(self):
+        if self.line_length and self.size:
+            return self.size + 2 * ((self.size - 1) // self.line_length)
+        return self.size
+
+    def __iter__(self):
+        try:
+            if not self.line_length:
+                for chunk in mapped_chunks(self._file, CHUNK_SIZE):
+                    yield chunk
+                return
+            first = True
+            for chunk in mapped_chunks(self._file, self.line_length * 1024):
+                lines = '\r\n'.join(chunk[offset:offset + self.line_length] for offset in xrange(0, len(chunk), self.line_length))
+                yield lines if first else '\r\n' + lines
+                first = False
+        finally:
+            self._file.close()
+
+
+class StreamingBody(object):
+    ''' A request body made of strings and FileParts, sent a chunk at a time
+
+    requests streams an object with __iter__, and sends a Content-Length instead of chunked encoding
+    when it also has a __len__. httplib reads it with read().
+    '''
+
+    def __init__(self, parts):
+        self.parts = [part.encode('utf-8') if isinstance(part, unicode) else part for part in parts]
+        self._chunks = None
+        self._buffer = b''
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, str):
+                if part:
+                    yield part
+            else:
+                for chunk in part:
+                    yield chunk
+
+    def read(self, size=-1):
+        if self._chunks is None:
+            self._chunks = iter(self)
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class Placeholders(object):
+    ''' Unique strings standing for the attachment contents in a document built in memory (JSON, MIME)
+
+    splice() cuts the document at the placeholders and puts the streamed parts in their place.
+    '''
+
+    def __init__(self):
+        self.token = uuid.uuid4().hex
+        self.parts = []
+
+    def add(self, part):
+        self.parts.append(part)
+        return '%s-%s' % (self.token, len(self.parts) - 1)
+
+    def splice(self, text):
+        pieces = re.split('%s-(\d+)' % self.token, text)
+        return [piece if i % 2 == 0 else self.parts[int(piece)] for i, piece in enumerate(pieces)]
+
+
+def multipart_body(fields, attachments, file_field='attachment'):
+    ''' A multipart/form-data body streaming the attachments, requests would build it in memory
+
+    Args:
+        fields: a dict of form fields, a list value is sent as the same field repeated
+
+    Returns:
+        (StreamingBody, content type)
+    '''
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, values in sorted(fields.items()):
+        for value in values if isinstance(values, list) else [values]:
+            parts.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n' % (boundary, name))
+            parts.append(value)
+            parts.append('\r\n')
+    for attachment in attachments:
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; %s\r\nContent-Type: %s\r\n\r\n'
+                     % (boundary, file_field, disposition_filename(attachment['name']), clean_type(attachment['type'])))
+        parts.append(FilePart(attachment['path']))
+        parts.append('\r\n')
+    parts.append('--%s--\r\n' % boundary)
+    return StreamingBody(parts), 'multipart/form-data; boundary=%s' % boundary
+
+
+class EncodedCache(object):
+    ''' The base64 encodings of the attachments, as files named after the content hash
+
+    The least recently used encodings are deleted once the cache holds more than max_bytes.
+    '''
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or config.ATTACHMENT_CACHE_DIR
+        self.max_bytes = max_bytes or config.ATTACHMENT_CACHE_SIZE
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, attachment):
+        ''' The path of the base64 encoding (without line breaks) of an attachment, encoding it if needed '''
+        path = os.path.join(self.directory, attachment['sha1'] + '.b64')
+        try:
+            # the modification time is the LRU order
+            os.utime(path, None)
+        except OSError:
+            pass
+        else:
+            with self._lock:
+                self.hits += 1
+            return path
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # made by another thread meanwhile
+                if not os.path.isdir(self.directory):
+                    raise
+        # concurrent encodings of the same file each write their own copy, the last rename wins
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            for chunk in file_chunks(attachment['path']):
+                f.write(base64.b64encode(chunk))
+        os.rename(tmp_path, path)
+        with self._lock:
+            self.misses += 1
+        self._evict(path)
+        return path
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def _evict(self, keep):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.b64'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path = os.path.join(self.directory, name)
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+_encoded_cache = None
+_encoded_cache_lock = threading.Lock()
+
+
+def get_encoded_cache():
+    ''' The process wide cache of encoded attachments, created on first use '''
+    global _encoded_cache
+    with _encoded_cache_lock:
+        if _encoded_cache is None:
+            _encoded_cache = EncodedCache()
+        return _encoded_cache
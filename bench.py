@@ -0,0 +1,145 @@
+'''
+Benchmark of the service against local fake Mandrill and Mailgun servers (see fake_providers.py).
+
+Usage:
+  bench.py [options] [send_email | view]
+
+Drives send_email directly, or POST / of the Flask app, from a fixed number of threads and prints
+a JSON report: throughput, p50/p99 latency, outcomes, failover rate and peak memory.
+
+Options:
+  --requests=N              emails to send [default: 1000]
+  --concurrency=N           threads sending them [default: 16]
+  --mandrill-latency=SPEC   seconds, "median:p99" for a lognormal distribution [default: 0.05:0.3]
+  --mailgun-latency=SPEC    same for Mailgun [default: 0.08:0.5]
+  --mandrill-errors=RATE    share of the Mandrill calls failing [default: 0]
+  --mailgun-errors=RATE     share of the Mailgun calls failing [default: 0]
+  --mandrill-outages=SPEC   windows in seconds since the start when Mandrill is down, e.g. 2-5,10-12
+  --mailgun-outages=SPEC    same for Mailgun
+  --rate-limits             keep the provider and sender rate limits of config.py, off by default
+  --seed=N                  seed of the fakes' random draws [default: 1]
+  --output=FILE             write the report to FILE instead of stdout
+'''
+from __future__ import print_function
+from docopt import docopt
+from fake_providers import FakeProviderServer, MANDRILL, MAILGUN, parse_latency, parse_outages, use_fake_providers
+import json, logging, resource, sys, threading, time, metrics, simple_email
+
+
+def percentile(sorted_values, share):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(share * (len(sorted_values) - 1)))]
+
+
+def message(index):
+    return {'to_email': 'user%s@example.com' % index, 'from_email': 'bench@example.com',
+            'subject': 'benchmark email %s' % index, 'content': 'content of the benchmark email'}
+
+
+def send_function(target):
+    ''' A function sending one message and returning its status '''
+    if target == 'view':
+        from view import app
+        clients = threading.local()
+
+        def send(message_data):
+            if not hasattr(clients, 'client'):
+                clients.client = app.test_client()
+            response = clients.client.post('/', data=message_data)
+            return 'ok' if response.status_code == 200 else 'http_%s' % response.status_code
+        return send
+    return lambda message_data: simple_email.send_email(message_data).status
+
+
+def run(target='send_email', requests=1000, concurrency=16, mandrill_server=None, mailgun_server=None, rate_limits=False):
+    ''' Send the emails through already started fakes and return the report as a dict '''
+    limiter = simple_email.rate_limiter
+    saved_limits = limiter.provider_limits, limiter.sender_limit
+    if not rate_limits:
+        # the limits of config.py would measure the quotas rather than the service
+        limiter.provider_limits, limiter.sender_limit = {}, None
+    simple_email.provider_router.reset()
+    # the failover rate is read from the metrics, whatever config.METRICS_ENABLED says
+    saved_metrics, metrics.enabled = metrics.enabled, True
+    metrics.clear()
+    send = send_function(target)
+    latencies = []
+    outcomes = {}
+    lock = threading.Lock()
+    indexes = iter(xrange(requests))
+
+    def worker():
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            start = time.time()
+            try:
+                outcome = send(message(index))
+            except Exception as e:
+                outcome = type(e).__name__
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    try:
+        with use_fake_providers(mandrill_server, mailgun_server):
+            start = time.time()
+            threads = [threading.Thread(target=worker) for i in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+        failovers = sum(metrics.FAILOVERS.value(provider=name) for name in (MANDRILL, MAILGUN))
+    finally:
+        limiter.provider_limits, limiter.sender_limit = saved_limits
+        metrics.enabled = saved_metrics
+
+    latencies.sort()
+    return {
+        'target': target,
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'throughput': round(requests / elapsed, 1) if elapsed else None,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': latencies[-1] if latencies else None,
+        'outcomes': outcomes,
+        'failover_rate': float(failovers) / requests if requests else 0.0,
+        'provider_calls': {MANDRILL: mandrill_server.calls, MAILGUN: mailgun_server.calls},
+        'provider_errors': {MANDRILL: mandrill_server.errors, MAILGUN: mailgun_server.errors},
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main(argv=None):
+    options = docopt(__doc__, argv=argv)
+    logging.basicConfig()
+    seed = int(options['--seed'])
+    mandrill_server = FakeProviderServer(MANDRILL, parse_latency(options['--mandrill-latency']),
+                                         float(options['--mandrill-errors']), parse_outages(options['--mandrill-outages']), seed)
+    mailgun_server = FakeProviderServer(MAILGUN, parse_latency(options['--mailgun-latency']),
+                                        float(options['--mailgun-errors']), parse_outages(options['--mailgun-outages']), seed + 1)
+    mandrill_server.start()
+    mailgun_server.start()
+    try:
+        report = run('view' if options['view'] else 'send_email', int(options['--requests']), int(options['--concurrency']),
+                     mandrill_server, mailgun_server, options['--rate-limits'])
+    finally:
+        mandrill_server.stop()
+        mailgun_server.stop()
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options['--output']:
+        with open(options['--output'], 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,356 @@
+'''
+Circuit breakers for the email providers and the router that picks which provider to call.
+
+A breaker keeps a rolling window of the calls made to its provider. It trips (open) when too
+many of them failed or were slow, a tripped provider is skipped until open_duration has passed,
+then a few probe calls are let through (half-open) to decide whether to close it again.
+
+SharedCircuitBreaker keeps the same state in a shared memory table instead, so that the worker
+processes of server.py trip and close the breakers together.
+'''
+from collections import deque
+from rate_limit import RateLimited
+import threading, time, config, metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, window=None, min_calls=None, error_rate=None, slow_call_duration=None,
+                 slow_call_rate=None, open_duration=None, half_open_calls=None, clock=time.time):
+        self.name = name
+        self.window = window or config.BREAKER_WINDOW
+        self.min_calls = min_calls or config.BREAKER_MIN_CALLS
+        self.error_rate = error_rate or config.BREAKER_ERROR_RATE
+        self.slow_call_duration = slow_call_duration or config.BREAKER_SLOW_CALL_DURATION
+        self.slow_call_rate = slow_call_rate or config.BREAKER_SLOW_CALL_RATE
+        self.open_duration = open_duration or config.BREAKER_OPEN_DURATION
+        self.half_open_calls = half_open_calls or config.BREAKER_HALF_OPEN_CALLS
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._state = CLOSED
+            self._opened_at = None
+            self._calls = deque()   # (timestamp, failed, slow) for each call in the window
+            self._failures = 0
+            self._slow_calls = 0
+            self._probes = 0        # probe calls let through since going half-open
+            self._probe_successes = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def allow_request(self):
+        ''' Whether a call can be made now, a half-open breaker only lets half_open_calls probes through '''
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+            return False
+
+    def release(self):
+        ''' Give back the probe allow_request let through for a call that was not made after all '''
+        with self._lock:
+            if self._current_state() == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record(self, success, latency):
+        ''' Record the outcome of a call that allow_request let through '''
+        with self._lock:
+            now = self.clock()
+            state = self._current_state()
+            slow = latency >= self.slow_call_duration
+            if state == HALF_OPEN:
+                if not success or slow:
+                    self._trip(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._close()
+                return
+            if state == OPEN:
+                # a call that started before the breaker tripped
+                return
+            self._calls.append((now, not success, slow))
+            self._failures += not success
+            self._slow_calls += slow
+            self._expire(now)
+            calls = len(self._calls)
+            if calls >= self.min_calls and (self._failures >= self.error_rate * calls or
+                                            self._slow_calls >= self.slow_call_rate * calls):
+                self._trip(now)
+
+    def health(self):
+        ''' A score between 0 and 1, 1 until there are at least min_calls calls in the window '''
+        with self._lock:
+            state = self._current_state()
+            if state == OPEN:
+                return 0.0
+            self._expire(self.clock())
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                score = 1.0
+            else:
+                score = (1.0 - float(self._failures) / calls) * (1.0 - 0.5 * self._slow_calls / calls)
+            if state == HALF_OPEN:
+                score *= 0.5
+            return score
+
+    def stats(self):
+        with self._lock:
+            self._expire(self.clock())
+            return {'state': self._current_state(), 'calls': len(self._calls),
+                    'failures': self._failures, 'slow_calls': self._slow_calls}
+
+    def _current_state(self):
+        if self._state == OPEN and self.clock() - self._opened_at >= self.open_duration:
+            self._state = HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+        return self._state
+
+    def _expire(self, now):
+        calls = self._calls
+        while calls and calls[0][0] <= now - self.window:
+            _, failed, slow = calls.popleft()
+            self._failures -= failed
+            self._slow_calls -= slow
+
+    def _trip(self, now):
+        self._state = OPEN
+        self._opened_at = now
+
+    def _close(self):
+        self._state = CLOSED
+        self._opened_at = None
+        self._calls.clear()
+        self._failures = 0
+        self._slow_calls = 0
+
+
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+# buckets of the rolling window of a SharedCircuitBreaker
+WINDOW_BUCKETS = 10
+SHARED_WIDTH = 4 + 4 * WINDOW_BUCKETS
+
+
+class SharedCircuitBreaker(CircuitBreaker):
+    ''' A CircuitBreaker whose state lives in a SharedSlots table of SHARED_WIDTH floats per key
+
+    The table holds the state, when it tripped, the probe counts, then WINDOW_BUCKETS buckets of
+    (bucket number, calls, failures, slow calls). The window is window / WINDOW_BUCKETS seconds per bucket
+    and its calls expire a bucket at a time rather than one by one.
+    '''
+
+    def __init__(self, name, table, **kwargs):
+        self.table = table
+        self._table_key = 'breaker:%s' % name
+        super(SharedCircuitBreaker, self).__init__(name, **kwargs)
+
+    def reset(self):
+        self.table.update(self._table_key, lambda values: [0.0] * SHARED_WIDTH)
+
+    @property
+    def state(self):
+        return self._transact(self._current_state)
+
+    def allow_request(self):
+        def allow(values, now):
+            state = self._current_state(values, now)
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and values[2] < self.half_open_calls:
+                values[2] += 1
+                return True
+            return False
+        return self._transact(allow)
+
+    def release(self):
+        def release(values, now):
+            if self._current_state(values, now) == HALF_OPEN and values[2] > 0:
+                values[2] -= 1
+        self._transact(release)
+
+    def record(self, success, latency):
+        def record(values, now):
+            state = self._current_state(values, now)
+            slow = latency >= self.slow_call_duration
+            if state == HALF_OPEN:
+                if not success or slow:
+                    values[0:2] = [STATES.index(OPEN), now]
+                else:
+                    values[3] += 1
+                    if values[3] >= self.half_open_calls:
+                        values[:] = [0.0] * SHARED_WIDTH
+                return
+            if state == OPEN:
+                return
+            number = int(now // self._bucket_duration())
+            offset = 4 + 4 * (number % WINDOW_BUCKETS)
+            if values[offset] != number:
+                values[offset:offset + 4] = [number, 0, 0, 0]
+            values[offset + 1] += 1
+            values[offset + 2] += not success
+            values[offset + 3] += slow
+            calls, failures, slow_calls = self._totals(values, now)
+            if calls >= self.min_calls and (failures >= self.error_rate * calls or slow_calls >= self.slow_call_rate * calls):
+                values[0:2] = [STATES.index(OPEN), now]
+        self._transact(record)
+
+    def health(self):
+        def health(values, now):
+            state = self._current_state(values, now)
+            if state == OPEN:
+                return 0.0
+            calls, failures, slow_calls = self._totals(values, now)
+            if calls < self.min_calls:
+                score = 1.0
+            else:
+                score = (1.0 - failures / calls) * (1.0 - 0.5 * slow_calls / calls)
+            if state == HALF_OPEN:
+                score *= 0.5
+            return score
+        return self._transact(health)
+
+    def stats(self):
+        def stats(values, now):
+            calls, failures, slow_calls = self._totals(values, now)
+            return {'state': self._current_state(values, now), 'calls': int(calls), 'failures': int(failures),
+                    'slow_calls': int(slow_calls)}
+        return self._transact(stats)
+
+    def _transact(self, function):
+        # function(values, now) runs with the table locked and may change values in place
+        outcome = []
+
+        def update(values):
+            values = values or [0.0] * SHARED_WIDTH
+            outcome.append(function(values, self.clock()))
+            return values
+        self.table.update(self._table_key, update)
+        return outcome[0]
+
+    def _current_state(self, values, now):
+        state = STATES[int(values[0])]
+        if state == OPEN and now - values[1] >= self.open_duration:
+            values[0], values[2], values[3] = STATES.index(HALF_OPEN), 0, 0
+            return HALF_OPEN
+        return state
+
+    def _bucket_duration(self):
+        return float(self.window) / WINDOW_BUCKETS
+
+    def _totals(self, values, now):
+        # calls, failures and slow calls of the buckets still in the window
+        number = int(now // self._bucket_duration())
+        totals = [0.0, 0.0, 0.0]
+        for offset in range(4, SHARED_WIDTH, 4):
+            if number - WINDOW_BUCKETS < values[offset] <= number:
+                for i in range(3):
+                    totals[i] += values[offset + 1 + i]
+        return totals
+
+
+class ProviderRouter(object):
+    ''' Ranks the providers by their recent health and keeps one breaker per provider
+
+    Args:
+        providers: the SimpleEmail subclasses in order of preference, used to break ties
+        rate_limiter: an optional RateLimiter, a provider over its rate limit is not called
+    '''
+
+    def __init__(self, providers, breaker_factory=CircuitBreaker, rate_limiter=None):
+        self.providers = list(providers)
+        self.breakers = dict((provider.name, breaker_factory(provider.name)) for provider in self.providers)
+        self.rate_limiter = rate_limiter
+
+    def ranked(self):
+        ''' The providers to try in order, tripped providers are left out '''
+        scored = []
+        for preference, provider in enumerate(self.providers):
+            breaker = self.breakers[provider.name]
+            if breaker.state != OPEN:
+                scored.append((-breaker.health(), preference, provider))
+        scored.sort(key=lambda item: item[:2])
+        return [provider for _, _, provider in scored]
+
+    def send(self, provider, message_data):
+        ''' Send through one provider and record the outcome on its breaker
+
+        Returns:
+            the Result from the provider, or None if the breaker did not let the call through.
+            A "rejected" result counts as a healthy call since the provider did answer.
+
+        Raises:
+            RateLimited: the provider is over its rate limit
+        '''
+        if not self._admit(provider, 1):
+            return None
+        start = time.time()
+        try:
+            result = provider().send(message_data)
+        except Exception:
+            self._record(provider, False, start, ["error"])
+            raise
+        self._record(provider, result.status != "error", start, [metrics.outcome(result)])
+        return result
+
+    def send_batch(self, provider, batch):
+        ''' Same as send for provider.send_batch, the call is healthy unless every message got an error '''
+        if not self._admit(provider, len(batch)):
+            return None
+        start = time.time()
+        try:
+            results = provider().send_batch(batch)
+        except Exception:
+            self._record(provider, False, start, ["error"] * len(batch))
+            raise
+        self._record(provider, any(result.status != "error" for result in results), start, map(metrics.outcome, results))
+        return results
+
+    def _admit(self, provider, tokens):
+        # the breaker is asked first, a provider it keeps out must not use up rate limit tokens
+        breaker = self.breakers[provider.name]
+        if not breaker.allow_request():
+            return False
+        try:
+            self._acquire(provider, tokens)
+        except RateLimited:
+            breaker.release()
+            raise
+        return True
+
+    def _acquire(self, provider, tokens):
+        if self.rate_limiter is not None:
+            retry_after = self.rate_limiter.acquire_provider(provider.name, tokens)
+            if retry_after:
+                raise RateLimited(provider.name, retry_after)
+
+    def _record(self, provider, success, start, outcomes):
+        latency = time.time() - start
+        self.breakers[provider.name].record(success, latency)
+        if metrics.enabled:
+            metrics.PROVIDER_LATENCY.observe(latency, provider=provider.name)
+            for outcome in outcomes:
+                metrics.PROVIDER_SENDS.inc(provider=provider.name, outcome=outcome)
+
+    def reset(self):
+        for breaker in self.breakers.values():
+            breaker.reset()
+        if self.rate_limiter is not None:
+            self.rate_limiter.reset()
+
+    def stats(self):
+        return dict((name, breaker.stats()) for name, breaker in self.breakers.items())
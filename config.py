@@ -4,3 +4,106 @@ Place to hold the setting for email services
 MANDRILL_API_KEY =  # put your mandrill API key here 
 MAILGUN_MESSAGE_BASE_URL = # put the mailgun message base url here e.g.  'https://api.mailgun.net/v2/YOUR_DOMAIN/messages'
 MAILGUN_API_KEY = # put your mailgun API key here 
+
+# Queue the emails sent through POST / and let the worker pool send them
+SEND_ASYNC = False
+SEND_QUEUE_PATH = 'send_queue.db'   # sqlite file backing the job queue
+SEND_QUEUE_WORKERS = 4              # number of concurrent workers draining the queue
+SEND_QUEUE_LEASE = 300              # seconds a worker has to send a job before it's taken for dead and the job queued again
+
+# Circuit breaker of each provider, see circuit_breaker.py
+BREAKER_WINDOW = 60                 # seconds of calls the error rate and latency are computed over
+BREAKER_MIN_CALLS = 20              # calls needed in the window before a breaker can trip
+BREAKER_ERROR_RATE = 0.5            # trip when this share of the calls failed
+BREAKER_SLOW_CALL_DURATION = 5.0    # calls taking longer than this many seconds are slow
+BREAKER_SLOW_CALL_RATE = 0.8        # trip when this share of the calls were slow
+BREAKER_OPEN_DURATION = 30          # seconds a tripped provider is skipped before probing it again
+BREAKER_HALF_OPEN_CALLS = 3         # probe calls let through while half-open, all must succeed to close
+
+# Keep-alive connection pools shared by the provider clients, see http_session.py
+HTTP_POOL_SIZE = 10                 # connections kept alive per provider
+HTTP_CONNECT_TIMEOUT = 3.05         # seconds to connect to a provider
+HTTP_READ_TIMEOUT = 10              # seconds to wait for a provider to respond
+
+BATCH_SIZE = 1000                   # recipients per provider call when sending a batch, Mailgun allows 1000
+
+# Non-blocking sends, see async_email.py
+ASYNC_SEND_THREADS = 50             # threads making the provider calls, more sends in flight wait for a free thread
+HEDGE_AFTER = None                  # seconds a provider call may take before the next provider is also tried, None turns hedging off
+
+VALIDATION_CACHE_SIZE = 10000       # email addresses whose validation verdict is cached
+
+METRICS_ENABLED = True              # collect the counters and latency histograms served on /metrics
+
+# Token bucket rate limits, see rate_limit.py. A limit is (emails per second, burst size)
+PROVIDER_RATE_LIMITS = {'mandrill': (50, 100), 'mailgun': (20, 50)}
+SENDER_RATE_LIMIT = (5, 20)         # limit of each from_email, None for no limit
+RATE_LIMIT_WAIT = 0                 # seconds a request may wait for its turn before getting a 429
+RATE_LIMIT_STORE = None             # file shared by the worker processes for the buckets, None keeps them in the process
+RATE_LIMIT_STORE_SLOTS = 10000      # number of buckets kept
+
+# Ledger of the emails sent with an idempotency key, see ledger.py
+LEDGER_PATH = 'ledger.db'
+LEDGER_TTL = 7 * 24 * 3600          # seconds an idempotency key is remembered
+LEDGER_CACHE_SIZE = 10000           # most recent keys answered from memory
+LEDGER_COMPACT_EVERY = 1000         # writes between two deletions of the expired keys
+LEDGER_PENDING_TIMEOUT = 300        # seconds after which a key still being sent can be reserved again
+
+# Retries of the emails that failed for a transient reason, see retry.py
+RETRY_ENABLED = False               # retry through the send queue instead of returning the error right away
+RETRY_MAX_ATTEMPTS = 5              # retries of an email before its error is final
+RETRY_BASE_DELAY = 2                # seconds, the backoff doubles with each retry
+RETRY_MAX_DELAY = 300               # seconds, cap of the backoff
+
+# Logging, set up once by configure_logging() when the app starts
+LOG_FILE = 'error.log'              # the errors are logged there
+LOG_DEBUG = False                   # also log everything to stderr
+
+# Suppression list of the recipients rejected for good, see suppression.py
+SUPPRESSION_ENABLED = False         # reject the emails to suppressed recipients without calling the providers
+SUPPRESSION_PATH = 'suppression.db'
+SUPPRESSION_BLOOM_CAPACITY = 1000000  # recipients the Bloom filter is sized for (about 1.2MB at 1% false positives)
+SUPPRESSION_SOFT_BOUNCE_TTL = 24 * 3600   # seconds an imported soft-bounce record stays suppressed
+
+# Providers in order of preference, smtp is only used when SMTP_HOST is set
+PROVIDER_ORDER = ('mandrill', 'mailgun', 'smtp')
+
+# SMTP relay of the smtp provider, see smtp_pool.py
+SMTP_HOST = None                    # e.g. 'smtp.example.com', None leaves the smtp provider out
+SMTP_PORT = 587
+SMTP_USERNAME = None                # no AUTH without a username
+SMTP_PASSWORD = None
+SMTP_STARTTLS = True
+SMTP_POOL_SIZE = 10                 # open sessions kept to the relay
+SMTP_TIMEOUT = 10                   # seconds, for the socket and to wait for a free session
+SMTP_CHECK_AFTER = 30               # seconds a session may be idle before it's checked with NOOP
+SMTP_MAX_MESSAGES = 100             # messages per session before it's replaced
+
+# Attachments, see attachments.py
+ATTACHMENT_DIR = 'attachments'              # where the attachments wait until their email is sent
+ATTACHMENT_MAX_SIZE = 25 * 1024 * 1024      # bytes, all the attachments of an email
+ATTACHMENT_CACHE_DIR = 'attachment_cache'   # base64 encodings of the attachments, by content hash
+ATTACHMENT_CACHE_SIZE = 512 * 1024 * 1024   # bytes, the least recently used encodings are deleted beyond
+
+# Templates of the personalized emails, see email_templates.py
+TEMPLATE_PATH = 'templates.db'
+TEMPLATE_CACHE_SIZE = 1000          # compiled template versions kept in memory
+
+# Priority lanes of the deliveries, see scheduler.py. A lane has slots (deliveries at a time), a weight (its share
+# of the slots under load), a deadline (seconds an email may wait for a slot) and max_waiting (emails waiting at most)
+LANES = {'transactional': {'slots': 12, 'weight': 4, 'deadline': 10, 'max_waiting': 64},
+         'bulk': {'slots': 8, 'weight': 1, 'deadline': 60, 'max_waiting': 4}}
+SCHEDULER_CONCURRENCY = 12          # deliveries at a time in a process, below SERVER_THREADS so a thread is left for the waiting emails
+DEFAULT_LANE = 'transactional'      # lane of the emails without a priority
+BATCH_LANE = 'bulk'                 # and of the /batch emails without one
+SENDER_WEIGHTS = {}                 # from_email -> its share within a lane, 1 by default
+
+# Pre-forked server, see server.py
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 5000
+SERVER_WORKERS = None               # worker processes, None for one per CPU
+SERVER_THREADS = 16                 # requests a worker serves at a time
+SERVER_MAX_REQUESTS = 10000         # requests a worker serves before it's replaced, 0 for never
+SERVER_MAX_REQUESTS_JITTER = 0.1    # up to this share more, so the workers are not all replaced at once
+SERVER_GRACEFUL_TIMEOUT = 30        # seconds a stopping worker has to finish its requests
+SERVER_BACKLOG = 128                # connections waiting to be accepted
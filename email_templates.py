@@ -0,0 +1,197 @@
+'''
+Templates of the personalized emails.
+
+A template is a subject, a text content and an optional html with merge fields, {{name}}, filled in
+with the template_vars of each recipient. Saving a template again makes a new version, an email names
+the version it's sent with so that a queued or retried email keeps it.
+
+The templates are compiled once into fragments, the literal pieces between the fields, and kept in
+an LRU cache keyed by (template id, version), rendering only joins the fragments with the values.
+Mandrill and Mailgun render the templates themselves: they get the template rewritten once in their
+syntax (handlebars, %recipient.name%) and the variables of each recipient, so a batch sharing a
+template is one call with no email rendered here. The SMTP relay gets the emails rendered locally.
+The values are HTML escaped in the html, like Mandrill's handlebars does.
+'''
+from collections import OrderedDict
+import cgi, re, sqlite3, threading, time, config
+
+FIELD_PATTERN = re.compile(r'\{\{\s*([A-Za-z][A-Za-z0-9_]*)\s*\}\}')
+
+# how the provider template languages write a field, in the text and in the html
+NATIVE_SYNTAX = {
+    # ours, the template as saved
+    'saved': (u'{{%s}}', u'{{%s}}'),
+    # triple braces in the text, Mandrill's handlebars escapes the double braced values
+    'handlebars': (u'{{{%s}}}', u'{{%s}}'),
+    # Mailgun doesn't escape, the html gets the escaped values under their own names
+    'mailgun': (u'%%recipient.%s%%', u'%%recipient.%s__html%%'),
+}
+
+
+def escape(value):
+    return cgi.escape(value, quote=True)
+
+
+class Fragments(object):
+    ''' A compiled template text: the literal pieces, with a field name between each two '''
+    __slots__ = ('literals', 'fields', 'escape')
+
+    def __init__(self, text, escape=False):
+        pieces = FIELD_PATTERN.split(text)
+        self.literals = pieces[0::2]
+        self.fields = pieces[1::2]
+        self.escape = escape
+
+    def render(self, values):
+        if self.escape:
+            values = dict((field, escape(values.get(field, u''))) for field in self.fields)
+        return self.join(values)
+
+    def join(self, values):
+        parts = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            parts.append(values.get(field, u''))
+            parts.append(literal)
+        return u''.join(parts)
+
+    def rewrite(self, field_format):
+        ''' The text with the fields written as field_format % name '''
+        return self.join(dict((field, field_format % field) for field in self.fields))
+
+
+class CompiledTemplate(object):
+    ''' A version of a template, compiled '''
+    __slots__ = ('template_id', 'version', 'subject', 'content', 'html', 'fields', '_native')
+
+    def __init__(self, template_id, version, subject, content, html=None):
+        self.template_id = template_id
+        self.version = version
+        self.subject = Fragments(subject)
+        self.content = Fragments(content)
+        self.html = Fragments(html, escape=True) if html else None
+        self.fields = sorted(set(self.subject.fields + self.content.fields + (self.html.fields if self.html else [])))
+        self._native = {}
+
+    def sources(self):
+        ''' (subject, content, html) as saved '''
+        return self.native('saved')
+
+    def render(self, values):
+        ''' (subject, content, html) of the email to a recipient with these template_vars '''
+        values = clean_values(values)
+        return (self.subject.render(values), self.content.render(values),
+                self.html.render(values) if self.html else None)
+
+    def native(self, syntax):
+        ''' (subject, content, html) in a provider's template syntax (see NATIVE_SYNTAX), worked out once '''
+        sources = self._native.get(syntax)
+        if sources is None:
+            text_format, html_format = NATIVE_SYNTAX[syntax]
+            sources = self._native[syntax] = (self.subject.rewrite(text_format), self.content.rewrite(text_format),
+                                              self.html.rewrite(html_format) if self.html else None)
+        return sources
+
+    def mailgun_variables(self, values):
+        ''' The recipient-variables of a recipient, every field has a value or Mailgun would leave it as is '''
+        values = clean_values(values)
+        variables = dict((field, values.get(field, u'')) for field in self.fields)
+        for field in (self.html.fields if self.html else ()):
+            variables[field + '__html'] = escape(variables[field])
+        return variables
+
+    def mandrill_variables(self, values):
+        ''' The merge_vars of a recipient '''
+        values = clean_values(values)
+        return [{'name': field, 'content': values[field]} for field in self.fields if field in values]
+
+
+def clean_values(values):
+    # the numbers of a JSON body are merged as text
+    return dict((name, value if isinstance(value, basestring) else unicode(value)) for name, value in (values or {}).items())
+
+
+def check_values(values):
+    ''' Whether template_vars is a dict of names to strings or numbers '''
+    return isinstance(values, dict) and all(isinstance(name, basestring) and isinstance(value, (basestring, int, long, float))
+                                            and not isinstance(value, bool) for name, value in values.items())
+
+
+class TemplateStore(object):
+    ''' The versions of the templates in sqlite, the compiled ones in an LRU cache '''
+
+    def __init__(self, path=None, cache_size=None):
+        self.path = path or config.TEMPLATE_PATH
+        self.cache_size = cache_size or config.TEMPLATE_CACHE_SIZE
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()     # (template id, version) -> CompiledTemplate
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS templates (
+                                template_id TEXT NOT NULL,
+                                version INTEGER NOT NULL,
+                                subject TEXT NOT NULL,
+                                content TEXT NOT NULL,
+                                html TEXT,
+                                created_at REAL NOT NULL,
+                                UNIQUE (template_id, version))''')
+
+    def save(self, template_id, subject, content, html=None):
+        ''' Store a new version of a template, returns its version '''
+        with self._lock:
+            # one statement, so that the processes saving the same template at once get different versions
+            cursor = self._conn.execute('''INSERT INTO templates (template_id, version, subject, content, html, created_at)
+                                           SELECT ?, COALESCE(MAX(version), 0) + 1, ?, ?, ?, ? FROM templates WHERE template_id = ?''',
+                                        (template_id, subject, content, html or None, time.time(), template_id))
+            return self._conn.execute("SELECT version FROM templates WHERE rowid = ?", (cursor.lastrowid,)).fetchone()[0]
+
+    def latest_version(self, template_id):
+        with self._lock:
+            return self._conn.execute("SELECT MAX(version) FROM templates WHERE template_id = ?", (template_id,)).fetchone()[0]
+
+    def get(self, template_id, version=None):
+        ''' The CompiledTemplate of a version, the latest one by default, or None if there's no such template '''
+        if version is None:
+            version = self.latest_version(template_id)
+            if version is None:
+                return None
+        key = (template_id, version)
+        with self._lock:
+            template = self._cache.pop(key, None)
+            if template is not None:
+                self.hits += 1
+                self._cache[key] = template
+                return template
+            self.misses += 1
+            row = self._conn.execute("SELECT subject, content, html FROM templates WHERE template_id = ? AND version = ?",
+                                     key).fetchone()
+        if row is None:
+            return None
+        template = CompiledTemplate(template_id, version, *row)
+        with self._lock:
+            self._cache[key] = template
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return template
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._cache), 'max_size': self.cache_size, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_template_store = None
+_template_store_lock = threading.Lock()
+
+
+def get_template_store():
+    ''' The process wide template store, opened on first use '''
+    global _template_store
+    with _template_store_lock:
+        if _template_store is None:
+            _template_store = TemplateStore()
+        return _template_store
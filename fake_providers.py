@@ -0,0 +1,243 @@
+'''
+Local stand-ins for the Mandrill messages/send and Mailgun messages APIs and for an SMTP relay,
+used by bench.py and the tests.
+
+Each fake answers like the real API, after a latency drawn from its distribution, and can be
+told to fail a share of the calls or to be down during some time windows.
+'''
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
+from smtpd import SMTPServer, SMTPChannel
+from urlparse import parse_qs
+from StringIO import StringIO
+import asyncore, cgi, json, math, random, socket, threading, time, uuid, mandrill, config
+
+MANDRILL = 'mandrill'
+MAILGUN = 'mailgun'
+
+
+def fixed_latency(seconds):
+    return lambda rng: seconds
+
+
+def lognormal_latency(median, p99):
+    ''' A long tailed latency with the given median and 99th percentile, in seconds '''
+    mu = math.log(median)
+    sigma = (math.log(p99) - mu) / 2.326     # z-score of the 99th percentile
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+def parse_latency(spec):
+    ''' "0.05" for a fixed latency, "0.05:0.5" for a lognormal one with that median and p99 '''
+    if ':' in spec:
+        median, p99 = spec.split(':')
+        return lognormal_latency(float(median), float(p99))
+    return fixed_latency(float(spec))
+
+
+def parse_outages(spec):
+    ''' "10-20,40-45" -> [(10, 20), (40, 45)], seconds since the fake was started '''
+    if not spec:
+        return []
+    return [tuple(float(bound) for bound in window.split('-')) for window in spec.split(',')]
+
+
+class FakeProviderServer(ThreadingMixIn, HTTPServer):
+    ''' A fake Mandrill or Mailgun API on a local port
+
+    Args:
+        kind: MANDRILL or MAILGUN
+        latency: a function of a random.Random returning the seconds to wait before answering
+        error_rate: share of the calls answered with a server error
+        outages: (start, end) windows in seconds since start() during which every call fails
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, kind, latency=fixed_latency(0), error_rate=0.0, outages=(), seed=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeProviderHandler)
+        self.kind = kind
+        self.latency = latency
+        self.error_rate = error_rate
+        self.outages = list(outages)
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.last_message = None    # the message of the last call, for the tests
+        self._lock = threading.Lock()
+        self._thread = None
+        self._handlers = []     # (thread, connection) of each client connection
+        self.started_at = None
+
+    @property
+    def url(self):
+        if self.kind == MANDRILL:
+            return 'http://127.0.0.1:%s/api/1.0/' % self.server_port
+        return 'http://127.0.0.1:%s/v3/example.com/messages' % self.server_port
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,), name="fake-%s" % self.kind)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stop serving and wait for the handler threads, the clients' keep-alive connections are closed '''
+        self.shutdown()
+        self.server_close()
+        with self._lock:
+            handlers, self._handlers = self._handlers, []
+        for thread, connection in handlers:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for thread, connection in handlers:
+            thread.join()
+        self._thread.join()
+
+    def process_request(self, request, client_address):
+        # like ThreadingMixIn, keeping the thread so that stop() can wait for it
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        with self._lock:
+            self._handlers = [handler for handler in self._handlers if handler[0].is_alive()]
+            self._handlers.append((thread, request))
+        thread.start()
+
+    def next_call(self):
+        ''' Draw the latency and fate of a call, returns (latency, fails) '''
+        with self._lock:
+            self.calls += 1
+            elapsed = time.time() - self.started_at
+            fails = any(start <= elapsed < end for start, end in self.outages) or self.rng.random() < self.error_rate
+            if fails:
+                self.errors += 1
+            return self.latency(self.rng), fails
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the response goes out in one write: unbuffered, its small writes wait on Nagle and the client's delayed
+    # ACK, about 40ms a call on a keep-alive connection
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        latency, fails = self.server.next_call()
+        time.sleep(latency)
+        if self.server.kind == MANDRILL:
+            self.mandrill(body, fails)
+        else:
+            self.mailgun(body, fails)
+
+    def mandrill(self, body, fails):
+        if not self.path.endswith('/messages/send.json'):
+            return self.answer(500, {'status': 'error', 'code': 5, 'name': 'Unknown_Url', 'message': 'unknown url'})
+        if fails:
+            return self.answer(500, {'status': 'error', 'code': -99, 'name': 'ServiceUnavailable',
+                                     'message': 'Service Temporarily Unavailable'})
+        message = self.server.last_message = json.loads(body)['message']
+        self.answer(200, [{'email': recipient['email'], 'status': 'sent', 'reject_reason': None, '_id': uuid.uuid4().hex}
+                          for recipient in message['to']])
+
+    def mailgun(self, body, fails):
+        if fails:
+            return self.answer(503, {'message': 'Service Unavailable'})
+        if self.headers.getheader('Content-Type', '').startswith('multipart/form-data'):
+            form = cgi.FieldStorage(StringIO(body), self.headers, environ={'REQUEST_METHOD': 'POST'})
+            fields = dict((field.name, []) for field in form.list)
+            for field in form.list:
+                fields[field.name].append((field.filename, field.value) if field.filename else field.value)
+        else:
+            fields = parse_qs(body)
+        self.server.last_message = fields
+        if not fields.get('to'):
+            return self.answer(400, {'message': "'to' parameter is missing"})
+        self.answer(200, {'id': '<%s@example.com>' % uuid.uuid4().hex, 'message': 'Queued. Thank you.'})
+
+    def answer(self, status_code, content):
+        data = json.dumps(content)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def use_fake_providers(mandrill_server, mailgun_server):
+    ''' Point the Mandrill client and the Mailgun calls at the fakes '''
+    saved = mandrill.ROOT, config.MAILGUN_MESSAGE_BASE_URL
+    mandrill.ROOT, config.MAILGUN_MESSAGE_BASE_URL = mandrill_server.url, mailgun_server.url
+    try:
+        yield
+    finally:
+        mandrill.ROOT, config.MAILGUN_MESSAGE_BASE_URL = saved
+
+
+class FakeSmtpServer(SMTPServer):
+    ''' An SMTP relay on a local port that keeps the messages it gets instead of delivering them
+
+    Args:
+        refused: recipient addresses answered with a 550 at RCPT
+        deferred: recipient addresses answered with a 451 at RCPT, like a greylisting relay
+    '''
+
+    def __init__(self, refused=(), deferred=()):
+        SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.refused = set(refused)
+        self.deferred = set(deferred)
+        self.messages = []
+        self.connections = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="fake-smtp")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        asyncore.close_all()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.connections += 1
+            FakeSmtpChannel(self, *pair)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.02, count=1)
+
+
+class FakeSmtpChannel(SMTPChannel):
+
+    def __init__(self, server, conn, addr):
+        SMTPChannel.__init__(self, server, conn, addr)
+        self.fake_server = server
+
+    def smtp_RCPT(self, arg):
+        address = self._SMTPChannel__getaddr('TO:', arg) if arg else None
+        if address in self.fake_server.refused:
+            self.push('550 5.1.1 %s: recipient address rejected: user unknown' % address)
+            return
+        if address in self.fake_server.deferred:
+            self.push('451 4.7.1 %s: recipient address rejected: greylisted, try again later' % address)
+            return
+        SMTPChannel.smtp_RCPT(self, arg)
@@ -0,0 +1,87 @@
+'''
+Shared, connection pooled HTTP sessions for the email providers.
+
+Each provider gets one requests.Session for the whole process so the TCP/TLS connection
+to Mandrill or Mailgun is kept alive and reused across messages, and every request made
+through it has a connect and read timeout.
+'''
+from requests.adapters import HTTPAdapter
+import requests, threading, config
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    ''' An HTTPAdapter that uses a default (connect, read) timeout for requests made without one '''
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def new_session(pool_size=None, connect_timeout=None, read_timeout=None):
+    ''' Create a session keeping up to pool_size keep-alive connections per host
+
+    The pool blocks when all the connections are in use instead of opening throwaway ones,
+    requests.Session and the urllib3 pools are safe to share between threads.
+    '''
+    timeout = (connect_timeout or config.HTTP_CONNECT_TIMEOUT, read_timeout or config.HTTP_READ_TIMEOUT)
+    adapter = TimeoutHTTPAdapter(timeout=timeout, pool_connections=1,
+                                 pool_maxsize=pool_size or config.HTTP_POOL_SIZE, pool_block=True)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(provider):
+    ''' The process wide session of a provider, created on first use '''
+    with _sessions_lock:
+        session = _sessions.get(provider)
+        if session is None:
+            session = _sessions[provider] = new_session()
+        return session
+
+
+def pool_stats():
+    ''' Connection pool usage of each provider session
+
+    Returns:
+        a dict keyed by provider name then by host::
+            connections (int): connections opened so far
+            requests (int): requests sent so far, requests - connections were sent on a reused connection
+            idle (int): connections currently kept alive in the pool
+    '''
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    stats = {}
+    for provider, session in sessions:
+        hosts = {}
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                hosts['%s://%s:%s' % (pool.scheme, pool.host, pool.port)] = {
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None)}
+        stats[provider] = hosts
+    return stats
+
+
+def reset():
+    ''' Forget the sessions, the next get_session() creates new ones
+
+    The sessions are not closed: in a forked process their sockets are still used by the parent.
+    '''
+    with _sessions_lock:
+        _sessions.clear()
@@ -0,0 +1,159 @@
+'''
+Ledger of the emails sent with an idempotency key.
+
+A client retrying POST / with the same idempotency key gets the stored result back instead of
+the email being sent again. The ledger is a sqlite table keyed by the idempotency key, fronted
+by an in-memory LRU of the most recent keys so a repeated key is answered without touching disk.
+Entries older than config.LEDGER_TTL are compacted away. A key still pending after
+config.LEDGER_PENDING_TIMEOUT was reserved by a process that died while sending, it can be reserved again.
+'''
+from collections import OrderedDict
+import hashlib, json, sqlite3, threading, time, config
+
+PENDING = 'pending'
+
+FIELDS = ('idempotency_key', 'message_hash', 'provider', 'provider_message_id', 'status', 'status_code', 'message', 'created_at')
+
+
+def message_hash(message_data, fields=('to_email', 'from_email', 'subject', 'content')):
+    ''' A digest of the email, used to tell a retry from a different email reusing the key '''
+    values = [message_data[field] for field in fields]
+    # the optional fields only count when they are set, so a plain email keeps the same digest
+    if message_data.get('html'):
+        values.append(message_data['html'])
+    if message_data.get('attachments'):
+        values.append([(attachment['name'], attachment['sha1']) for attachment in message_data['attachments']])
+    if message_data.get('template_id'):
+        values.append([message_data['template_id'], message_data.get('template_vars') or {}])
+    content = json.dumps(values)
+    return hashlib.sha1(content).hexdigest()
+
+
+class Ledger(object):
+
+    def __init__(self, path=None, ttl=None, cache_size=None, compact_every=None, pending_timeout=None, clock=time.time):
+        self.path = path or config.LEDGER_PATH
+        self.ttl = ttl or config.LEDGER_TTL
+        self.pending_timeout = pending_timeout or config.LEDGER_PENDING_TIMEOUT
+        self.cache_size = cache_size or config.LEDGER_CACHE_SIZE
+        self.compact_every = compact_every or config.LEDGER_COMPACT_EVERY
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()     # idempotency key -> record, only the final records
+        self._writes = 0
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS sends (
+                                idempotency_key TEXT PRIMARY KEY,
+                                message_hash TEXT NOT NULL,
+                                provider TEXT,
+                                provider_message_id TEXT,
+                                status TEXT NOT NULL,
+                                status_code INTEGER,
+                                message TEXT,
+                                created_at REAL NOT NULL) WITHOUT ROWID''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sends_created_at ON sends (created_at)")
+
+    def reserve(self, key, message_hash):
+        ''' Claim a key before sending its email
+
+        Returns:
+            None if the key is now reserved by the caller, otherwise the existing record of the key
+            (its status is PENDING while another request is still sending the email)
+        '''
+        with self._lock:
+            record = self._cached(key)
+            if record is not None:
+                return record
+            now = self.clock()
+            # an expired record of the key may not be compacted yet, and the created_at of a pending one is
+            # when it was reserved: still pending after the timeout, its request is taken for dead
+            self._conn.execute("DELETE FROM sends WHERE idempotency_key = ? AND (created_at <= ? OR (status = ? AND created_at <= ?))",
+                               (key, now - self.ttl, PENDING, now - self.pending_timeout))
+            cursor = self._conn.execute("INSERT OR IGNORE INTO sends (idempotency_key, message_hash, status, created_at) VALUES (?, ?, ?, ?)",
+                                        (key, message_hash, PENDING, now))
+            if cursor.rowcount == 1:
+                self._wrote()
+                return None
+            return self._select(key)
+
+    def complete(self, key, result):
+        ''' Store the final Result of a reserved key '''
+        with self._lock:
+            self._conn.execute("UPDATE sends SET provider = ?, provider_message_id = ?, status = ?, status_code = ?, message = ? WHERE idempotency_key = ?",
+                               (getattr(result, 'provider', None), getattr(result, 'message_id', None), result.status,
+                                result.status_code, result.message, key))
+            record = self._select(key)
+            if record is not None:
+                self._remember(record)
+            self._wrote()
+
+    def release(self, key):
+        ''' Drop a reservation whose email was not sent so that a retry with the key sends it '''
+        with self._lock:
+            self._conn.execute("DELETE FROM sends WHERE idempotency_key = ? AND status = ?", (key, PENDING))
+
+    def lookup(self, key):
+        ''' The record of a key, or None '''
+        with self._lock:
+            record = self._cached(key)
+            if record is None:
+                record = self._select(key)
+                if record is not None and record['status'] != PENDING:
+                    self._remember(record)
+            return record
+
+    def compact(self):
+        ''' Delete the records older than the ttl '''
+        with self._lock:
+            self._compact()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _cached(self, key):
+        record = self._cache.pop(key, None)
+        if record is None:
+            return None
+        if record['created_at'] <= self.clock() - self.ttl:
+            return None
+        self._cache[key] = record
+        return record
+
+    def _remember(self, record):
+        self._cache.pop(record['idempotency_key'], None)
+        self._cache[record['idempotency_key']] = record
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _select(self, key):
+        row = self._conn.execute("SELECT %s FROM sends WHERE idempotency_key = ? AND created_at > ?" % ', '.join(FIELDS),
+                                 (key, self.clock() - self.ttl)).fetchone()
+        return dict(zip(FIELDS, row)) if row is not None else None
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes >= self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        self._writes = 0
+        expired = self.clock() - self.ttl
+        self._conn.execute("DELETE FROM sends WHERE created_at <= ?", (expired,))
+        for key in [key for key, record in self._cache.items() if record['created_at'] <= expired]:
+            del self._cache[key]
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    ''' The process wide ledger, opened on first use '''
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger()
+        return _ledger
@@ -0,0 +1,212 @@
+'''
+Counters and latency histograms, rendered in the Prometheus text format by the /metrics end point.
+
+When config.METRICS_ENABLED is off, inc() and observe() return right away so the instrumentation
+only costs a function call and a flag check.
+
+The values are kept in the process, or after share() in a shared memory table that the processes
+forked afterwards (the workers of server.py) all add to, so that /metrics reports them all.
+'''
+from shared_memory import SharedSlots
+import bisect, json, threading, time, config
+
+enabled = config.METRICS_ENABLED
+
+# the shared table of share(), None while the values are kept in the process
+_shared = None
+SHARED_NAME_SIZE = 200
+
+# seconds, covers everything from a cached validation to a provider call hitting its read timeout
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def clock():
+    return time.time()
+
+
+def outcome(result):
+    ''' The outcome label of a Result: sent, rejected or error '''
+    if result.status == "success":
+        return "sent"
+    if result.status == "rejected":
+        return "rejected"
+    return "error"
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _label_text(self, key, extra=()):
+        pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                 for name, value in zip(self.labelnames, key) + list(extra)]
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        for key, value in self._items():
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _items(self):
+        if _shared is None:
+            with self._lock:
+                return sorted(self._values.items())
+        items = []
+        for name, values in _shared.items():
+            try:
+                name = json.loads(name)
+            except ValueError:
+                # cut at SHARED_NAME_SIZE
+                continue
+            if name[0] == self.name:
+                items.append((tuple(name[1:]), self._from_shared(values)))
+        return sorted(items)
+
+    def _shared_update(self, key, function):
+        # function(values) updates the list of floats of the key in the shared table in place
+        def update(values):
+            values = values or [0.0] * _shared.width
+            function(values)
+            return values
+        _shared.update(json.dumps([self.name] + list(key)), update)
+
+    def _shared_get(self, key):
+        values = _shared.get(json.dumps([self.name] + list(key)))
+        return None if values is None else self._from_shared(values)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        if _shared is not None:
+            def add(values):
+                values[0] += amount
+            self._shared_update(key, add)
+            return
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        if _shared is not None:
+            return self._shared_get(self._key(labels)) or 0
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _from_shared(self, values):
+        return int(values[0]) if values[0].is_integer() else values[0]
+
+    def _render_value(self, key, value):
+        return ['%s%s %s' % (self.name, self._label_text(key), value)]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        if _shared is not None:
+            def add(counts):
+                counts[bucket] += 1
+                counts[len(self.buckets) + 1] += value
+            self._shared_update(key, add)
+            return
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # a count per bucket, then the +Inf count and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def observe_since(self, start, **labels):
+        if enabled:
+            self.observe(clock() - start, **labels)
+
+    def count(self, **labels):
+        if _shared is not None:
+            counts = self._shared_get(self._key(labels))
+        else:
+            with self._lock:
+                counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def _from_shared(self, values):
+        counts = [int(count) for count in values[:len(self.buckets) + 1]]
+        return counts + [values[len(self.buckets) + 1]]
+
+    def _render_value(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (self.name, self._label_text(key, [('le', bound)]), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self._label_text(key), counts[-1]))
+        lines.append('%s_count%s %s' % (self.name, self._label_text(key), cumulative))
+        return lines
+
+
+def render():
+    ''' All the metrics in the Prometheus text exposition format '''
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    for metric in REGISTRY:
+        metric.clear()
+    if _shared is not None:
+        _shared.clear()
+
+
+def share(slots=1024):
+    ''' Keep the values in an anonymous shared memory table from now on, called before forking worker processes
+
+    The values counted so far in this process are dropped.
+    '''
+    global _shared
+    width = max(len(metric.buckets) + 2 if isinstance(metric, Histogram) else 1 for metric in REGISTRY)
+    _shared = SharedSlots(None, slots=slots, width=width, name_size=SHARED_NAME_SIZE)
+
+
+PROVIDER_SENDS = Counter('email_provider_sends_total', 'Calls to the email providers by outcome (sent, rejected or error)',
+                         ('provider', 'outcome'))
+PROVIDER_LATENCY = Histogram('email_provider_latency_seconds', 'Time spent in the email provider calls', ('provider',))
+FAILOVERS = Counter('email_failovers_total', 'Emails passed on to the next provider after a provider did not send them', ('provider',))
+REQUESTS = Counter('email_requests_total', 'Emails delivered through the providers by final outcome (sent, rejected or error)', ('outcome',))
+SUPPRESSED = Counter('email_suppressed_total', 'Emails rejected without calling a provider because the recipient is suppressed', ('reason',))
+INVALID_REQUESTS = Counter('email_invalid_requests_total', 'Send requests that did not pass the validation')
+STAGE_LATENCY = Histogram('email_stage_latency_seconds', 'Time spent validating the requests and delivering them through the providers',
+                          ('stage',))
+LANE_WAIT = Histogram('email_lane_wait_seconds', 'Time the emails waited for a delivery slot in their priority lane', ('lane',))
+LANE_BUSY = Counter('email_lane_busy_total', 'Emails given up without a delivery slot, the lane was full or the deadline passed',
+                    ('lane', 'reason'))
@@ -0,0 +1,80 @@
+'''
+Registry of the email provider clients.
+
+Nothing is created when the modules are imported: the provider settings are read from the
+environment (falling back to config.py) the first time they are needed, and each client is built
+on first use. reset() drops the clients so that a forked worker process builds its own instead of
+sharing the sockets of its parent.
+'''
+from smtp_pool import SmtpConnectionPool
+import os, threading, mandrill, config, http_session
+
+# settings that can be set in the environment instead of config.py
+SETTINGS = ('MANDRILL_API_KEY', 'MAILGUN_API_KEY', 'MAILGUN_MESSAGE_BASE_URL', 'SMTP_USERNAME', 'SMTP_PASSWORD')
+
+_settings_loaded = False
+_settings_lock = threading.Lock()
+
+
+def load_settings():
+    ''' Apply the environment overrides to config, only the first call reads the environment '''
+    global _settings_loaded
+    with _settings_lock:
+        if _settings_loaded:
+            return
+        for name in SETTINGS:
+            value = os.environ.get(name)
+            if value:
+                setattr(config, name, value)
+        _settings_loaded = True
+
+
+class ProviderRegistry(object):
+    ''' Provider name -> client, each client is made by its factory on first use '''
+
+    def __init__(self):
+        self._factories = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory):
+        with self._lock:
+            self._factories[name] = factory
+            self._clients.pop(name, None)
+
+    def get(self, name):
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                load_settings()
+                client = self._clients[name] = self._factories[name]()
+            return client
+
+    def reset(self):
+        ''' Forget the clients and their sessions, e.g. in a newly forked process '''
+        with self._lock:
+            self._clients.clear()
+        http_session.reset()
+
+
+class LazyClient(object):
+    ''' Stands for the client registered under a name, which is only created when an attribute is used '''
+
+    def __init__(self, name, registry):
+        self._name = name
+        self._registry = registry
+
+    def __getattr__(self, attribute):
+        return getattr(self._registry.get(self._name), attribute)
+
+
+def new_mandrill_client():
+    client = mandrill.Mandrill(config.MANDRILL_API_KEY)
+    # share the pooled keep-alive session (with timeouts) instead of the client's own session
+    client.session = http_session.get_session('mandrill')
+    return client
+
+
+registry = ProviderRegistry()
+registry.register('mandrill', new_mandrill_client)
+registry.register('smtp', SmtpConnectionPool)
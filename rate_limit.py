@@ -0,0 +1,174 @@
+'''
+Token bucket rate limits for the email providers and for each sender.
+
+Each provider gets a bucket matching its sending quota, and each from_email one of
+config.SENDER_RATE_LIMIT. A request over the limit either waits for a token, up to
+config.RATE_LIMIT_WAIT seconds, or is refused right away with the time to retry after.
+The buckets live in the process, or in config.RATE_LIMIT_STORE, a file that the worker
+processes map in memory to share them (see shared_memory.py). server.py shares them with its
+workers through an anonymous map when there's no such file. A bucket that is full again is the
+same as no bucket, its slot in the shared table goes to the next new key that needs one, and a key
+finding no room in the table is limited by a bucket of its process.
+'''
+from collections import OrderedDict
+from shared_memory import SharedSlots, TableFull
+import logging, threading, time, config
+
+logger = logging.getLogger('simple_email')
+
+# slots of the shared table looked at for a bucket, see SharedSlots
+MAX_PROBE = 32
+
+
+class RateLimited(Exception):
+    ''' Raised when a provider is over its rate limit '''
+
+    def __init__(self, name, retry_after):
+        super(RateLimited, self).__init__("%s is over its rate limit, retry after %.2fs" % (name, retry_after))
+        self.name = name
+        self.retry_after = retry_after
+
+
+class LocalStore(object):
+    ''' Bucket states kept in this process, same interface as SharedSlots
+
+    Only the max_size most recently used buckets are kept, a bucket that is dropped starts full again.
+    '''
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or config.RATE_LIMIT_STORE_SLOTS
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, name, function, expired=None):
+        with self._lock:
+            values = self._values[name] = function(self._values.pop(name, None))
+            if len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+            return values
+
+    def get(self, name):
+        with self._lock:
+            return self._values.get(name)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class TokenBucket(object):
+    ''' Holds up to `capacity` tokens, refilled at `rate` tokens per second
+
+    The state (the time the bucket is full again, last update time) is kept in the store under `name`, a
+    bucket that is full again can be dropped from the store. A request for more tokens than
+    the capacity, e.g. a large batch, goes through once the bucket is full and leaves it in debt: the
+    tokens it took over the capacity are refilled before the next request gets any.
+    '''
+
+    def __init__(self, name, rate, capacity, store, clock=time.time):
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.store = store
+        self.clock = clock
+
+    def take(self, tokens=1):
+        ''' Take tokens if there are enough
+
+        Returns:
+            0 if the tokens were taken, otherwise the seconds until there will be enough (nothing is taken)
+        '''
+        needed = min(tokens, self.capacity)
+        outcome = []
+
+        def refill(values):
+            now = self.clock()
+            full_at = now if values is None else max(values[0], now)
+            available = self.capacity - (full_at - now) * self.rate
+            if available >= needed:
+                full_at += tokens / self.rate
+                outcome.append(0)
+            else:
+                outcome.append((needed - available) / self.rate)
+            return [full_at, now]
+
+        self.store.update(self.name, refill, expired=lambda values: values[0] <= self.clock())
+        return outcome[0]
+
+
+class RateLimiter(object):
+    ''' The token buckets of the providers and senders
+
+    Args:
+        store: where the bucket states are kept, a LocalStore or SharedSlots, by default new_store() on first use
+        provider_limits: provider name -> (rate, capacity), defaults to config.PROVIDER_RATE_LIMITS
+        sender_limit: (rate, capacity) of each from_email, defaults to config.SENDER_RATE_LIMIT, None for no limit
+        wait: seconds a request may wait for tokens, defaults to config.RATE_LIMIT_WAIT
+    '''
+
+    def __init__(self, store=None, provider_limits=None, sender_limit=None, wait=None,
+                 clock=time.time, sleep=time.sleep):
+        self._store = store
+        self._store_lock = threading.Lock()
+        self.provider_limits = provider_limits if provider_limits is not None else config.PROVIDER_RATE_LIMITS
+        self.sender_limit = sender_limit if sender_limit is not None else config.SENDER_RATE_LIMIT
+        self.wait = wait if wait is not None else config.RATE_LIMIT_WAIT
+        self.clock = clock
+        self.sleep = sleep
+        # the buckets of the keys finding no room in a shared store
+        self._local_store = LocalStore()
+
+    @property
+    def store(self):
+        if self._store is None:
+            with self._store_lock:
+                if self._store is None:
+                    self._store = new_store()
+        return self._store
+
+    @store.setter
+    def store(self, store):
+        # e.g. server.py moves the buckets to shared memory before forking its workers
+        with self._store_lock:
+            self._store = store
+
+    def acquire_provider(self, provider_name, tokens=1):
+        ''' Take tokens from a provider's bucket, returns 0 or the seconds to retry after '''
+        limit = self.provider_limits.get(provider_name)
+        if limit is None:
+            return 0
+        return self._acquire(TokenBucket('provider:%s' % provider_name, limit[0], limit[1], self.store, self.clock), tokens)
+
+    def acquire_sender(self, from_email, tokens=1):
+        ''' Take tokens from a sender's bucket, returns 0 or the seconds to retry after '''
+        if self.sender_limit is None:
+            return 0
+        bucket = TokenBucket('sender:%s' % from_email.lower(), self.sender_limit[0], self.sender_limit[1], self.store, self.clock)
+        return self._acquire(bucket, tokens)
+
+    def _acquire(self, bucket, tokens):
+        deadline = self.clock() + self.wait
+        while True:
+            try:
+                retry_after = bucket.take(tokens)
+            except TableFull:
+                logger.warning("No room left for the rate limit of %s in the shared table, limiting it in this process", bucket.name)
+                bucket.store = self._local_store
+                continue
+            if retry_after == 0 or self.clock() + retry_after > deadline:
+                return retry_after
+            self.sleep(retry_after)
+
+    def reset(self):
+        self.store.clear()
+
+
+def new_store():
+    if config.RATE_LIMIT_STORE:
+        return shared_store(config.RATE_LIMIT_STORE)
+    return LocalStore()
+
+
+def shared_store(path=None):
+    ''' A store shared by the processes through the file at path, or with the processes forked after, when None '''
+    return SharedSlots(path, slots=config.RATE_LIMIT_STORE_SLOTS, max_probe=MAX_PROBE)
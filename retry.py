@@ -0,0 +1,32 @@
+'''
+Retries of the emails that failed for a reason that may go away by itself.
+
+A timeout, a 5xx from Mailgun, Mandrill being unavailable or a provider over its rate limit is
+retryable, a rejection like a hard bounce or a validation error is not. A retryable email is put
+back on the send queue after a capped exponential backoff with full jitter, so the retries of many
+emails failing at once are spread out instead of all hitting the providers again together, and it
+goes to whichever provider is healthy by then.
+'''
+import random, config
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# the other reasons (hard-bounce, spam, unsub, invalid-sender, ...) will not change on a retry
+RETRYABLE_REJECT_REASONS = ('soft-bounce',)
+
+
+def is_retryable(result):
+    ''' Whether sending the email again later may succeed '''
+    if result.status == "success":
+        return False
+    if result.status == "rejected":
+        return result.reject_reason in RETRYABLE_REJECT_REASONS
+    if result.retryable is not None:
+        return result.retryable
+    return result.status_code in RETRYABLE_STATUS_CODES
+
+
+def backoff_delay(attempt, base=None, cap=None, random=random.random):
+    ''' Seconds to wait before the given retry (1 for the first one), full jitter over the capped exponential backoff '''
+    base = base if base is not None else config.RETRY_BASE_DELAY
+    cap = cap if cap is not None else config.RETRY_MAX_DELAY
+    return random() * min(cap, base * 2 ** (attempt - 1))
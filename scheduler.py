@@ -0,0 +1,227 @@
+'''
+Priority lanes for the deliveries, so that a flood of bulk emails doesn't hold up the transactional ones.
+
+Each email has a priority, the lane it's delivered in (config.LANES): transactional by default, bulk
+by default for /batch. At most config.SCHEDULER_CONCURRENCY deliveries of the process run at a time,
+and at most `slots` of each lane, so bulk's cap leaves slots only the transactional emails can use.
+The deliveries over the limits wait for a slot:
+
+  * between the lanes, a free slot goes to the waiting lane that got the least for its weight
+    (stride scheduling), under load transactional gets `weight` slots for each bulk one
+  * within a lane, the senders (from_email) share the slots the same way, by config.SENDER_WEIGHTS,
+    so one sender's campaign doesn't hold up the emails of the others
+  * a sender's emails go by earliest deadline, the arrival plus the lane's `deadline`. An email still
+    waiting at its deadline is given up with a retryable 503 rather than sent late, and so is an email
+    arriving when `max_waiting` emails already wait in its lane, not to tie up the server threads
+
+The queued emails of send_queue.py don't go through the lanes, the queue hands them out to its workers
+the same way, by lane weight then by sender weight.
+'''
+from collections import OrderedDict
+from contextlib import contextmanager
+import heapq, itertools, threading, time, config, metrics
+
+
+class LaneBusy(Exception):
+    ''' Raised when an email gets no slot in its lane: too many are waiting, or it waited past its deadline '''
+
+    def __init__(self, lane, reason):
+        super(LaneBusy, self).__init__("no slot in the %s lane: %s" % (lane, reason))
+        self.lane = lane
+        self.reason = reason
+
+
+class FairShare(object):
+    ''' Stride scheduling: the turn goes to the flow that got the least so far for its weight
+
+    A flow that was idle starts again at the current virtual time instead of catching up.
+    '''
+
+    def __init__(self):
+        self.passes = {}
+        self.virtual_time = 0.0
+
+    def activate(self, flow):
+        self.passes[flow] = max(self.passes.get(flow, 0.0), self.virtual_time)
+
+    def pick(self, flows, weight):
+        return min(flows, key=lambda flow: (self.passes[flow], -weight(flow)))
+
+    def charge(self, flow, weight):
+        self.virtual_time = self.passes[flow]
+        self.passes[flow] += 1.0 / weight
+
+    def forget(self, flow):
+        self.passes.pop(flow, None)
+
+
+class Waiter(object):
+    __slots__ = ('lane', 'sender', 'deadline', 'arrived', 'granted')
+
+    def __init__(self, lane, sender, deadline, arrived):
+        self.lane = lane
+        self.sender = sender
+        self.deadline = deadline
+        self.arrived = arrived
+        self.granted = False
+
+
+class Lane(object):
+    ''' The waiting emails of a lane, by sender, and its slots in use '''
+
+    def __init__(self, name, slots, weight, deadline, max_waiting):
+        self.name = name
+        self.slots = slots
+        self.weight = weight
+        self.deadline = deadline
+        self.max_waiting = max_waiting
+        self.senders = OrderedDict()    # from_email -> heap of (deadline, seq, Waiter)
+        self.share = FairShare()
+        self.waiting = 0
+        self.active = 0
+        self.granted = 0
+        self.busy = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def push(self, waiter, seq):
+        queue = self.senders.get(waiter.sender)
+        if queue is None:
+            queue = self.senders[waiter.sender] = []
+            self.share.activate(waiter.sender)
+        heapq.heappush(queue, (waiter.deadline, seq, waiter))
+        self.waiting += 1
+
+    def pop(self):
+        sender = self.share.pick(self.senders, sender_weight)
+        self.share.charge(sender, sender_weight(sender))
+        queue = self.senders[sender]
+        waiter = heapq.heappop(queue)[2]
+        if not queue:
+            self._drop(sender)
+        self.waiting -= 1
+        return waiter
+
+    def remove(self, waiter):
+        queue = self.senders[waiter.sender]
+        queue[:] = [entry for entry in queue if entry[2] is not waiter]
+        heapq.heapify(queue)
+        if not queue:
+            self._drop(waiter.sender)
+        self.waiting -= 1
+
+    def stats(self):
+        return {'slots': self.slots, 'active': self.active, 'waiting': self.waiting, 'senders_waiting': len(self.senders),
+                'granted': self.granted, 'busy': self.busy,
+                'wait_avg': self.wait_total / self.granted if self.granted else 0.0, 'wait_max': self.wait_max}
+
+    def _drop(self, sender):
+        del self.senders[sender]
+        # the senders seen once don't pile up
+        self.share.forget(sender)
+
+
+def sender_weight(sender):
+    return config.SENDER_WEIGHTS.get(sender, 1)
+
+
+class LaneScheduler(object):
+    ''' Hands out the delivery slots of the process, see the module docstring
+
+    Args:
+        lanes: lane name -> {'slots', 'weight', 'deadline', 'max_waiting'}, defaults to config.LANES
+        concurrency: deliveries at a time, all lanes, defaults to config.SCHEDULER_CONCURRENCY
+    '''
+
+    def __init__(self, lanes=None, concurrency=None, clock=time.time):
+        self.lanes = dict((name, Lane(name, **settings)) for name, settings in (lanes or config.LANES).items())
+        self.concurrency = concurrency or config.SCHEDULER_CONCURRENCY
+        self.clock = clock
+        self.active = 0
+        self.share = FairShare()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._seq = itertools.count()
+
+    @contextmanager
+    def slot(self, lane, sender):
+        ''' Hold a slot of the lane for the duration of the block, raises LaneBusy when there's none in time '''
+        self.acquire(lane, sender)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def acquire(self, lane_name, sender):
+        lane = self.lanes[lane_name]
+        with self._changed:
+            if lane.waiting >= lane.max_waiting:
+                lane.busy += 1
+                metrics.LANE_BUSY.inc(lane=lane_name, reason='full')
+                raise LaneBusy(lane_name, "%s emails already waiting" % lane.waiting)
+            now = self.clock()
+            waiter = Waiter(lane_name, sender, now + lane.deadline, now)
+            if not lane.waiting:
+                self.share.activate(lane_name)
+            lane.push(waiter, next(self._seq))
+            self._dispatch()
+            while not waiter.granted:
+                remaining = waiter.deadline - self.clock()
+                if remaining <= 0:
+                    lane.remove(waiter)
+                    lane.busy += 1
+                    metrics.LANE_BUSY.inc(lane=lane_name, reason='deadline')
+                    raise LaneBusy(lane_name, "waited %.2fs" % (self.clock() - waiter.arrived))
+                self._changed.wait(remaining)
+            waited = self.clock() - waiter.arrived
+            lane.wait_total += waited
+            lane.wait_max = max(lane.wait_max, waited)
+        metrics.LANE_WAIT.observe(waited, lane=lane_name)
+
+    def release(self, lane_name):
+        with self._changed:
+            self.lanes[lane_name].active -= 1
+            self.active -= 1
+            self._dispatch()
+
+    def stats(self):
+        ''' The slots, queue depth and wait times of each lane '''
+        with self._lock:
+            return dict((name, lane.stats()) for name, lane in self.lanes.items())
+
+    def _dispatch(self):
+        # hand out the free slots, the waiters given one are woken up
+        granted = False
+        while self.active < self.concurrency:
+            ready = [name for name, lane in self.lanes.items() if lane.waiting and lane.active < lane.slots]
+            if not ready:
+                break
+            name = self.share.pick(ready, lambda name: self.lanes[name].weight)
+            lane = self.lanes[name]
+            self.share.charge(name, lane.weight)
+            waiter = lane.pop()
+            waiter.granted = True
+            lane.active += 1
+            lane.granted += 1
+            self.active += 1
+            granted = True
+        if granted:
+            self._changed.notify_all()
+
+
+_lane_scheduler = None
+_lane_scheduler_lock = threading.Lock()
+
+
+def get_lane_scheduler():
+    ''' The scheduler of the process, each worker of server.py has its own '''
+    global _lane_scheduler
+    with _lane_scheduler_lock:
+        if _lane_scheduler is None:
+            _lane_scheduler = LaneScheduler()
+        return _lane_scheduler
+
+
+def lane_of(message_data):
+    ''' The lane of an email, its priority or config.DEFAULT_LANE '''
+    return message_data.get('priority') or config.DEFAULT_LANE
@@ -0,0 +1,387 @@
+'''
+Durable local job queue and the worker pool that drains it.
+
+POST / can enqueue a validated message and return a job id right away instead of
+waiting for Mandrill/Mailgun, the workers then send it through deliver_email so
+the usual Mandrill -> Mailgun failover still applies. With config.RETRY_ENABLED, a job
+that failed for a transient reason is put back on the queue after a backoff (see retry.py),
+the time it's due is kept in the queue so that any worker process can take it then.
+A job queued with an idempotency key is sent at most once for the key, the worker reserves
+the key in the ledger (see ledger.py) when it sends the email.
+'''
+from simple_email import Result, ErrorResult, MESSAGE_FIELDS, OPTIONAL_FIELDS, deliver_email, deliver_in_lane, resolve_template, simple_validate_send_request, check_suppressed, check_sender_rate, send_once, stored_result
+from ledger import get_ledger, message_hash
+from retry import is_retryable, backoff_delay
+from scheduler import FairShare, lane_of, sender_weight
+import json, logging, sqlite3, threading, time, uuid, attachments, config
+
+logger = logging.getLogger('simple_email')
+
+QUEUED = 'queued'
+SENDING = 'sending'
+RETRYING = 'retrying'
+DONE = 'done'
+
+
+class QueuedResult(Result):
+    __slots__ = ('job_id',)
+
+    def __init__(self, job_id, status_code=202):
+        super(type(self), self).__init__(QUEUED, "Email queued, job id: %s" % job_id, status_code)
+        self.job_id = job_id
+
+    def to_dict(self):
+        result = super(type(self), self).to_dict()
+        result['job_id'] = self.job_id
+        return result
+
+
+# the (lane, sender) pairs with queued jobs, jumping from one to the next in the jobs_lane index
+# rather than reading all the queued jobs
+FLOWS_QUERY = '''WITH RECURSIVE flows(lane, sender) AS (
+                     SELECT * FROM (SELECT lane, sender FROM jobs WHERE state = :state ORDER BY lane, sender LIMIT 1)
+                     UNION ALL
+                     SELECT jobs.lane, jobs.sender FROM flows, jobs WHERE jobs.seq = COALESCE(
+                         (SELECT seq FROM jobs WHERE state = :state AND lane = flows.lane AND sender > flows.sender
+                          ORDER BY sender LIMIT 1),
+                         (SELECT seq FROM jobs WHERE state = :state AND lane > flows.lane ORDER BY lane, sender LIMIT 1)))
+                 SELECT lane, sender FROM flows'''
+
+
+class SendQueue(object):
+    ''' A job queue backed by sqlite so queued emails survive a restart
+
+    The jobs are handed out like the delivery slots of scheduler.py: a lane's turn by its weight, then
+    within the lane a sender's turn by config.SENDER_WEIGHTS, and a sender's jobs first in first out.
+
+    Jobs go through queued -> sending -> done, or back from sending to queued through
+    retrying once their retry is due. A worker claiming a job gets a lease of `lease` seconds
+    to send it: a job still "sending" after that was left by a process that died, and goes
+    back to "queued". The worker processes of server.py share the queue, and a reload starts
+    the new workers while the old ones finish their jobs, so nothing is taken back on open.
+    '''
+
+    def __init__(self, path=None, lease=None, clock=time.time):
+        self.path = path or config.SEND_QUEUE_PATH
+        self.lease = lease or config.SEND_QUEUE_LEASE
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                job_id TEXT UNIQUE NOT NULL,
+                                state TEXT NOT NULL,
+                                message TEXT NOT NULL,
+                                status TEXT,
+                                status_code INTEGER,
+                                result_message TEXT,
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                created_at REAL NOT NULL,
+                                updated_at REAL NOT NULL)''')
+        if 'attempts' not in [column[1] for column in self._conn.execute("PRAGMA table_info(jobs)")]:
+            # a queue created before the retries
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        if 'due_at' not in [column[1] for column in self._conn.execute("PRAGMA table_info(jobs)")]:
+            # a queue created before the retries were due in the queue, its retrying jobs are due now
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN due_at REAL")
+            self._conn.execute("UPDATE jobs SET due_at = 0 WHERE state = ?", (RETRYING,))
+        if 'lane' not in [column[1] for column in self._conn.execute("PRAGMA table_info(jobs)")]:
+            # a queue created before the priority lanes, its jobs go in the default lane
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN lane TEXT")
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN sender TEXT")
+            self._conn.execute("UPDATE jobs SET lane = ?, sender = '' WHERE lane IS NULL", (config.DEFAULT_LANE,))
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, seq)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_lane ON jobs (state, lane, sender, seq)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, due_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (state, updated_at)")
+        # the turns of the lanes, and of the senders of each lane
+        self._lanes = FairShare()
+        self._senders = {}
+
+    def put(self, message_data, state=QUEUED, idempotency_key=None):
+        ''' Add a message to the queue and return its job id
+
+        A job put in the SENDING state is claimed by the caller, like one returned by get(). The idempotency
+        key is kept with the message, get() returns it as its idempotency_key field.
+        '''
+        job_id = uuid.uuid4().hex
+        fields = MESSAGE_FIELDS + tuple(field for field in OPTIONAL_FIELDS if message_data.get(field))
+        message = dict((field, message_data[field]) for field in fields)
+        if idempotency_key:
+            message['idempotency_key'] = idempotency_key
+        message = json.dumps(message)
+        now = self.clock()
+        with self._lock:
+            self._conn.execute("INSERT INTO jobs (job_id, state, message, lane, sender, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (job_id, state, message, lane_of(message_data), message_data['from_email'], now, now))
+            self._not_empty.notify()
+        return job_id
+
+    def get(self, timeout=None):
+        ''' Claim the next queued job, see the class docstring, waiting up to timeout seconds for one
+
+        Returns:
+            a (job_id, message_data) tuple, or None if nothing was queued in time
+        '''
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._lock:
+            while True:
+                next_due = self._requeue_due()
+                row = self._next_job()
+                if row is not None:
+                    # the worker processes of server.py share the queue, the job may have been claimed by another one since
+                    cursor = self._conn.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE seq = ? AND state = ?",
+                                                (SENDING, self.clock(), row[0], QUEUED))
+                    if cursor.rowcount == 0:
+                        continue
+                    return row[1], json.loads(row[2])
+                remaining = None if deadline is None else deadline - self.clock()
+                if remaining is not None and remaining <= 0:
+                    return None
+                if next_due is not None:
+                    remaining = next_due - self.clock() if remaining is None else min(remaining, next_due - self.clock())
+                self._not_empty.wait(remaining)
+
+    def complete(self, job_id, result):
+        ''' Store the final result of a job '''
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET state = ?, status = ?, status_code = ?, result_message = ?, updated_at = ? WHERE job_id = ?",
+                               (DONE, result.status, result.status_code, result.message, self.clock(), job_id))
+
+    def retry(self, job_id, result, delay):
+        ''' Set a job aside after a failed attempt, it's back in the queue after delay seconds and keeps its place
+        ahead of the newer jobs. The result is kept in case it's the last attempt.
+        '''
+        now = self.clock()
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET state = ?, status = ?, status_code = ?, result_message = ?, attempts = attempts + 1, "
+                               "due_at = ?, updated_at = ? WHERE job_id = ?",
+                               (RETRYING, result.status, result.status_code, result.message, now + delay, now, job_id))
+            # the waiting workers work out when it's due
+            self._not_empty.notify_all()
+
+    def attempts(self, job_id):
+        ''' Number of failed attempts of a job so far '''
+        with self._lock:
+            return self._conn.execute("SELECT attempts FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def status(self, job_id):
+        ''' Look up a job, returns None for an unknown job id '''
+        with self._lock:
+            row = self._conn.execute("SELECT state, status, status_code, result_message, attempts FROM jobs WHERE job_id = ?",
+                                     (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {'job_id': job_id, 'state': row[0], 'status': row[1], 'status_code': row[2], 'message': row[3], 'attempts': row[4]}
+
+    def depth(self):
+        ''' Number of jobs waiting to be sent '''
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+
+    def lane_depths(self):
+        ''' Number of jobs waiting to be sent in each lane '''
+        with self._lock:
+            depths = dict((lane, 0) for lane in config.LANES)
+            depths.update(self._conn.execute("SELECT lane, COUNT(*) FROM jobs WHERE state = ? GROUP BY lane", (QUEUED,)).fetchall())
+            return depths
+
+    def _requeue_due(self):
+        # put back in the queue the retries that are due and the jobs whose lease is over,
+        # returns the time the next one is due, or None
+        now = self.clock()
+        due, claimed = self._conn.execute("SELECT (SELECT MIN(due_at) FROM jobs WHERE state = ?), (SELECT MIN(updated_at) FROM jobs WHERE state = ?)",
+                                          (RETRYING, SENDING)).fetchone()
+        if (due is not None and due <= now) or (claimed is not None and claimed <= now - self.lease):
+            self._conn.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE (state = ? AND due_at <= ?) OR (state = ? AND updated_at <= ?)",
+                               (QUEUED, now, RETRYING, now, SENDING, now - self.lease))
+            return self._requeue_due()
+        if claimed is not None:
+            due = min(due, claimed + self.lease) if due is not None else claimed + self.lease
+        return due
+
+    def _next_job(self):
+        # the (seq, job_id, message) row of the oldest job of the sender whose turn it is, in the lane whose turn it is
+        waiting = {}
+        for lane, sender in self._conn.execute(FLOWS_QUERY, {'state': QUEUED}):
+            waiting.setdefault(lane, []).append(sender)
+        lane = self._turn(self._lanes, waiting, lane_weight)
+        if lane is None:
+            return None
+        sender = self._turn(self._senders.setdefault(lane, FairShare()), waiting[lane], sender_weight)
+        return self._conn.execute("SELECT seq, job_id, message FROM jobs WHERE state = ? AND lane = ? AND sender = ? ORDER BY seq LIMIT 1",
+                                  (QUEUED, lane, sender)).fetchone()
+
+    def _turn(self, share, flows, weight):
+        # the flows with queued jobs take turns, one that ran out of jobs starts again at the current virtual time
+        for flow in [flow for flow in share.passes if flow not in flows]:
+            share.forget(flow)
+        if not flows:
+            return None
+        for flow in flows:
+            share.activate(flow)
+        flow = share.pick(flows, weight)
+        share.charge(flow, weight(flow))
+        return flow
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def lane_weight(lane):
+    # a lane taken out of config.LANES keeps getting its jobs sent
+    return config.LANES.get(lane, {}).get('weight', 1)
+
+
+class WorkerPool(object):
+    ''' A pool of threads that take jobs off a SendQueue and send them
+
+    Args:
+        retries: whether the jobs that failed for a transient reason are retried, defaults to config.RETRY_ENABLED
+    '''
+
+    def __init__(self, queue, size=None, send=deliver_email, poll_interval=1.0, retries=None):
+        self.queue = queue
+        self.size = size or config.SEND_QUEUE_WORKERS
+        self.send = send
+        self.poll_interval = poll_interval
+        self.retries = config.RETRY_ENABLED if retries is None else retries
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.size):
+            thread = threading.Thread(target=self._run, name="send-worker-%s" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        ''' Let the workers finish their current job and exit '''
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def retry_later(self, job_id, result):
+        ''' Schedule another attempt at a failed job
+
+        Returns:
+            False if the job is not retried, because the retries are off or it ran out of attempts
+        '''
+        if not self.retries:
+            return False
+        attempts = self.queue.attempts(job_id) + 1
+        if attempts > config.RETRY_MAX_ATTEMPTS:
+            return False
+        delay = backoff_delay(attempts)
+        logger.info("Retrying the email of job %s in %.1f seconds (attempt %s)", job_id, delay, attempts)
+        self.queue.retry(job_id, result, delay)
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            job = self.queue.get(timeout=self.poll_interval)
+            if job is None:
+                continue
+            job_id, message_data = job
+            idempotency_key = message_data.pop('idempotency_key', None)
+            try:
+                if idempotency_key:
+                    result = send_once(message_data, idempotency_key, self.send)
+                else:
+                    result = self.send(message_data)
+            except Exception:
+                logger.exception("Get an exception when sending the email of job %s!", job_id)
+                result = ErrorResult("Sorry! We cannot send email for now. Please try later.")
+                result.retryable = True
+            if not (is_retryable(result) and self.retry_later(job_id, result)):
+                self.queue.complete(job_id, result)
+                # the spooled attachments are kept until the job is done
+                attachments.remove(message_data.get('attachments'))
+
+
+_default_queue = None
+_default_pool = None
+_lookup_queue = None
+_default_lock = threading.Lock()
+
+
+def get_send_queue():
+    ''' The process wide queue, its workers are started on first use '''
+    return get_worker_pool().queue
+
+
+def get_worker_pool():
+    global _default_queue, _default_pool
+    with _default_lock:
+        if _default_queue is None:
+            _default_queue = SendQueue()
+            _default_pool = WorkerPool(_default_queue)
+            _default_pool.start()
+        return _default_pool
+
+
+def lookup_queue():
+    ''' The process wide queue to look the jobs up, a process whose workers aren't running doesn't start them '''
+    global _lookup_queue
+    with _default_lock:
+        if _default_queue is not None:
+            return _default_queue
+        if _lookup_queue is None:
+            _lookup_queue = SendQueue()
+        return _lookup_queue
+
+
+def stop_worker_pool(timeout=None):
+    ''' Let the workers of the process wide pool finish their jobs, if it was started '''
+    with _default_lock:
+        pool = _default_pool
+    if pool is not None:
+        pool.stop(timeout)
+
+
+def enqueue_email(message_data, idempotency_key=None):
+    ''' Validate a message and queue it for the workers
+
+    Returns:
+        a QueuedResult with the job id, the ErrorResult from validation, or the stored result of
+        an idempotency key already used
+    '''
+    message_data, result = resolve_template(message_data)
+    result = result or simple_validate_send_request(message_data) or check_suppressed(message_data)
+    if result is None and idempotency_key:
+        # the key is only reserved by the worker sending the email, a job queued twice with it is still sent once
+        record = get_ledger().lookup(idempotency_key)
+        if record is not None:
+            result = stored_result(record, message_hash(message_data))
+    result = result or check_sender_rate(message_data)
+    if result is not None:
+        return result
+    return QueuedResult(get_send_queue().put(message_data, idempotency_key=idempotency_key))
+
+
+def send_with_retries(message_data):
+    ''' Send a message now, and if it failed for a transient reason hand it to the queue to retry later
+
+    Returns:
+        the Result of the send, or a QueuedResult with the job id of the retries
+    '''
+    message_data, result = resolve_template(message_data)
+    result = result or simple_validate_send_request(message_data) or check_suppressed(message_data) or check_sender_rate(message_data)
+    if result is not None:
+        return result
+    result = deliver_in_lane(message_data, deliver_email)
+    if not is_retryable(result):
+        return result
+    pool = get_worker_pool()
+    # claimed by this process until its retry is scheduled, if it dies before the job is taken back once its lease is over
+    job_id = pool.queue.put(message_data, state=SENDING)
+    if not pool.retry_later(job_id, result):
+        pool.queue.complete(job_id, result)
+        return result
+    return QueuedResult(job_id)
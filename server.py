@@ -0,0 +1,302 @@
+'''
+Pre-forked production server for the Flask app of view.py.
+
+The master binds one listening socket, moves the shared state to shared memory and forks the
+worker processes, which all accept on that socket. Each worker serves up to config.SERVER_THREADS
+requests at a time and is replaced after about config.SERVER_MAX_REQUESTS requests.
+
+Shared by the workers: the circuit breakers of the providers, the rate limit buckets (unless
+config.RATE_LIMIT_STORE already puts them in a file), the metrics of /metrics and the suppression
+list's Bloom filter. Each worker has its own provider connections.
+
+Signals of the master:
+  TERM, INT  stop, the workers finish their current requests first
+  HUP        graceful reload: the master execs itself again on the same socket, starts new workers
+             with the new code and config, then stops the old ones
+
+Usage:
+  server.py [options]
+
+Options:
+  --host=HOST            address to listen on, defaults to config.SERVER_HOST
+  --port=PORT            port to listen on, defaults to config.SERVER_PORT
+  --workers=N            worker processes, defaults to config.SERVER_WORKERS
+  --max-requests=N       requests a worker serves before it's replaced, defaults to config.SERVER_MAX_REQUESTS
+'''
+from docopt import docopt
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from shared_memory import SharedSlots
+from circuit_breaker import SharedCircuitBreaker, SHARED_WIDTH
+from providers import registry
+import errno, fcntl, logging, multiprocessing, os, random, select, signal, socket, sys, threading, time
+import config, metrics, rate_limit, send_queue, simple_email, suppression
+
+logger = logging.getLogger('simple_email')
+
+# set for the new master by a graceful reload
+LISTEN_FD_ENV = 'EMAIL_SERVER_LISTEN_FD'
+OLD_WORKERS_ENV = 'EMAIL_SERVER_OLD_WORKERS'
+
+
+def share_state():
+    ''' Move the state the workers must agree on to anonymous shared memory, before forking them '''
+    if not config.RATE_LIMIT_STORE:
+        simple_email.rate_limiter.store = rate_limit.shared_store()
+    router = simple_email.provider_router
+    breakers = SharedSlots(None, slots=max(16, 2 * len(router.breakers)), width=SHARED_WIDTH)
+    router.breakers = dict((name, SharedCircuitBreaker(name, breakers)) for name in router.breakers)
+    metrics.share()
+    if config.SUPPRESSION_ENABLED:
+        suppression.share_bloom()
+
+
+class RequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.client_address[0], format % args)
+
+
+class WorkerServer(ThreadingMixIn, WSGIServer):
+    ''' A WSGI server on the listening socket of the master, serving up to `threads` requests at a time
+
+    A worker with all its threads busy stops accepting, the other workers take the new connections.
+    '''
+
+    def __init__(self, listener, app, threads):
+        WSGIServer.__init__(self, listener.getsockname(), RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        host, port = listener.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+        self.threads = threads
+        self.requests = 0
+        self._active = 0
+        self._idle = threading.Condition()
+
+    def handle_request(self):
+        # the listener is non-blocking, which BaseServer.handle_request would take for a zero timeout
+        try:
+            ready = select.select([self], [], [], self.timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            # accept() fails with EAGAIN, and nothing is served, when another worker took the connection
+            self._handle_request_noblock()
+
+    def process_request(self, request, client_address):
+        with self._idle:
+            while self._active >= self.threads:
+                self._idle.wait()
+            self._active += 1
+        self.requests += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._idle:
+                self._active -= 1
+                self._idle.notify_all()
+
+    def wait_idle(self, timeout):
+        ''' Wait up to timeout seconds for the requests in progress, returns whether they are done '''
+        deadline = time.time() + timeout
+        with self._idle:
+            while self._active:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+
+class Worker(object):
+    ''' The loop of a forked worker process '''
+
+    def __init__(self, listener, app, max_requests, threads, graceful_timeout):
+        self.listener = listener
+        self.app = app
+        self.max_requests = max_requests
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.stopping = False
+        self.master = os.getppid()
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # the clients and connections of the master are not ours, nor is its random state (retry jitter)
+        registry.reset()
+        random.seed()
+        server = WorkerServer(self.listener, self.app, self.threads)
+        server.timeout = 0.5
+        while not self.stopping and os.getppid() == self.master:
+            if self.max_requests and server.requests >= self.max_requests:
+                logger.info("Worker %s served %s requests, exiting to be replaced", os.getpid(), server.requests)
+                break
+            server.handle_request()
+        if not server.wait_idle(self.graceful_timeout):
+            logger.error("Worker %s exits with requests still in progress", os.getpid())
+        send_queue.stop_worker_pool(self.graceful_timeout)
+        return 0
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+
+class PreforkServer(object):
+    ''' The master process, see the module docstring
+
+    Args:
+        app: the WSGI application, loaded before forking so the workers share its memory
+    '''
+
+    def __init__(self, app, host=None, port=None, workers=None, max_requests=None, threads=None, graceful_timeout=None):
+        self.app = app
+        self.host = host or config.SERVER_HOST
+        self.port = port if port is not None else config.SERVER_PORT
+        self.worker_count = workers or config.SERVER_WORKERS or multiprocessing.cpu_count()
+        self.max_requests = max_requests if max_requests is not None else config.SERVER_MAX_REQUESTS
+        self.threads = threads or config.SERVER_THREADS
+        self.graceful_timeout = graceful_timeout if graceful_timeout is not None else config.SERVER_GRACEFUL_TIMEOUT
+        self.listener = self._listen()
+        self.workers = set()
+        self._signals = []
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def serve(self):
+        ''' Run the master until it's told to stop '''
+        share_state()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._signals.append('stop'))
+        signal.signal(signal.SIGINT, lambda signum, frame: self._signals.append('stop'))
+        signal.signal(signal.SIGHUP, lambda signum, frame: self._signals.append('reload'))
+        # only wakes the loop up to replace the worker
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        logger.info("Listening on %s:%s with %s workers", self.address[0], self.address[1], self.worker_count)
+        self.spawn_workers()
+        old_workers = os.environ.pop(OLD_WORKERS_ENV, None)
+        if old_workers:
+            # the workers of the master before the reload, they are still our children
+            self.stop_workers([int(pid) for pid in old_workers.split(',')])
+        while True:
+            self.reap_workers()
+            if self._signals:
+                if self._signals.pop(0) == 'stop':
+                    self.stop()
+                    return
+                self.reload()
+            self.spawn_workers()
+            # cut short by the signals
+            time.sleep(1.0)
+
+    def spawn_workers(self):
+        while len(self.workers) < self.worker_count:
+            # the workers don't all reach max_requests, and get replaced, at the same time
+            max_requests = self.max_requests + random.randint(0, int(self.max_requests * config.SERVER_MAX_REQUESTS_JITTER))
+            pid = os.fork()
+            if pid:
+                self.workers.add(pid)
+                continue
+            code = 1
+            try:
+                code = Worker(self.listener, self.app, max_requests, self.threads, self.graceful_timeout).run()
+            except Exception:
+                logger.exception("Worker %s crashed!", os.getpid())
+            finally:
+                os._exit(code)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            self.workers.discard(pid)
+
+    def stop_workers(self, pids):
+        ''' TERM the workers, and KILL the ones still there after the graceful timeout '''
+        for pid in pids:
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        pending = set(pids)
+        while pending and time.time() < deadline:
+            for pid in list(pending):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        pending.discard(pid)
+                except OSError:
+                    pending.discard(pid)
+            time.sleep(0.05)
+        for pid in pending:
+            logger.error("Killing worker %s, it did not stop within %ss", pid, self.graceful_timeout)
+            self._kill(pid, signal.SIGKILL)
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers.difference_update(pids)
+
+    def stop(self):
+        logger.info("Stopping %s workers", len(self.workers))
+        self.stop_workers(list(self.workers))
+        self.listener.close()
+
+    def reload(self):
+        ''' Exec the server again, the new master gets the socket and stops the current workers once its own run '''
+        logger.info("Reloading the server")
+        fd = self.listener.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+        os.environ[LISTEN_FD_ENV] = str(fd)
+        os.environ[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in self.workers)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def _listen(self):
+        fd = os.environ.pop(LISTEN_FD_ENV, None)
+        if fd is not None:
+            listener = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+            # fromfd made a copy
+            os.close(int(fd))
+        else:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.host, self.port))
+            listener.listen(config.SERVER_BACKLOG)
+        # the workers all wait on the socket, the ones that lose the race for a connection must not block in accept()
+        listener.setblocking(0)
+        return listener
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+def main(argv=None):
+    options = docopt(__doc__, argv=argv)
+    from view import app
+    simple_email.configure_logging()
+    server = PreforkServer(app, options['--host'], int(options['--port']) if options['--port'] else None,
+                           int(options['--workers'] or 0), int(options['--max-requests']) if options['--max-requests'] else None)
+    server.serve()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
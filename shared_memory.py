@@ -0,0 +1,141 @@
+'''
+Fixed size tables of float values in a memory map, shared by several processes.
+
+The map is either backed by a file, so unrelated processes opening the same path share it,
+or anonymous, in which case it is shared with the processes forked after it was created.
+'''
+from contextlib import contextmanager
+import fcntl, hashlib, mmap, multiprocessing, os, struct, threading
+
+EMPTY = 0
+
+
+class TableFull(Exception):
+    pass
+
+
+def encode_name(name):
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
+def slot_key(name):
+    ''' The non zero 64 bit key a name is stored under '''
+    return struct.unpack('<Q', hashlib.md5(encode_name(name)).digest()[:8])[0] or 1
+
+
+class SharedSlots(object):
+    ''' A hash table of slots, each slot holds `width` floats for a string key
+
+    Args:
+        path: the file backing the table, None for an anonymous map
+        slots: maximum number of keys
+        width: number of floats per key
+        name_size: bytes of the key's name stored with it so that items() can list them, 0 stores the hash only
+        max_probe: slots looked at for a key, a key is only stored that close to its hash, defaults to all of them
+    '''
+
+    def __init__(self, path=None, slots=1024, width=2, name_size=0, max_probe=None):
+        self.path = path
+        self.slots = slots
+        self.width = width
+        self.name_size = name_size
+        self.max_probe = min(max_probe or slots, slots)
+        self._slot = struct.Struct('<Q%sd%s' % (width, '%ss' % name_size if name_size else ''))
+        size = self._slot.size * slots
+        self._lock = threading.Lock()
+        if path is None:
+            self._fd = None
+            # a process shared lock for the anonymous map, flock on the file does the same for a file backed one
+            self._process_lock = multiprocessing.Lock()
+            self._map = mmap.mmap(-1, size)
+        else:
+            self._process_lock = None
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+
+    def update(self, name, function, expired=None):
+        ''' Atomically replace the values of a key by function(values)
+
+        function gets None for a key that is not in the table yet and returns the new values.
+        A key that is not in the table takes the slot of a key whose values are expired(values), if
+        there's one on its way, so that the keys no longer used don't fill the table up.
+
+        Returns:
+            what function returned
+        '''
+        key = slot_key(name)
+        with self._locked():
+            offset = self._find(key, expired)
+            stored_key, values = self._read(offset)
+            values = function(values if stored_key == key else None)
+            if self.name_size:
+                self._map[offset:offset + self._slot.size] = self._slot.pack(key, *(list(values) + [encode_name(name)]))
+            else:
+                self._map[offset:offset + self._slot.size] = self._slot.pack(key, *values)
+            return values
+
+    def get(self, name):
+        key = slot_key(name)
+        with self._locked():
+            try:
+                stored_key, values = self._read(self._find(key))
+            except TableFull:
+                return None
+            return values if stored_key == key else None
+
+    def items(self):
+        ''' (name, values) of every key in the table, only for a table storing the names '''
+        items = []
+        with self._locked():
+            for offset in range(0, self.slots * self._slot.size, self._slot.size):
+                unpacked = self._slot.unpack_from(self._map, offset)
+                if unpacked[0] != EMPTY:
+                    items.append((unpacked[-1].rstrip('\0').decode('utf-8', 'replace'), list(unpacked[1:self.width + 1])))
+        return items
+
+    def clear(self):
+        with self._locked():
+            self._map[:] = '\0' * len(self._map)
+
+    def close(self):
+        self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+
+    def _read(self, offset):
+        unpacked = self._slot.unpack_from(self._map, offset)
+        return unpacked[0], list(unpacked[1:self.width + 1])
+
+    def _find(self, key, expired=None):
+        # linear probing, returns the offset of the key's slot or of the slot it goes in: the first expired
+        # one on the way, or else the empty one ending the probe
+        start = key % self.slots
+        reusable = None
+        for i in range(self.max_probe):
+            offset = ((start + i) % self.slots) * self._slot.size
+            stored_key = struct.unpack_from('<Q', self._map, offset)[0]
+            if stored_key == key:
+                return offset
+            if stored_key == EMPTY:
+                return offset if reusable is None else reusable
+            if reusable is None and expired is not None and expired(self._read(offset)[1]):
+                reusable = offset
+        if reusable is not None:
+            return reusable
+        raise TableFull("the %s slots of the shared table around the key are in use" % self.max_probe)
+
+    @contextmanager
+    def _locked(self):
+        # the thread lock covers the threads of this process, the process lock or flock the other processes
+        with self._lock:
+            if self._process_lock is not None:
+                with self._process_lock:
+                    yield
+            else:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
@@ -1,88 +1,498 @@
 
 from __future__ import print_function
-from validate_email import validate_email
 from abc import ABCMeta, abstractmethod
-import mandrill, logging, requests, config
-mandrill_client = mandrill.Mandrill(config.MANDRILL_API_KEY)
+from collections import OrderedDict
+from circuit_breaker import ProviderRouter
+from rate_limit import RateLimiter, RateLimited
+from validation import MAX_SUBJECT_LENGTH, MAX_CONTENT_LENGTH
+from ledger import get_ledger, message_hash, PENDING
+from retry import is_retryable
+from suppression import get_suppression_list, SUPPRESS_REASONS
+from providers import registry, LazyClient, load_settings
+from smtp_pool import PoolTimeout
+from email_templates import get_template_store
+from scheduler import get_lane_scheduler, lane_of, LaneBusy
+from attachments import FilePart, Placeholders, StreamingBody, multipart_body, get_encoded_cache, MIME_LINE_LENGTH
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.header import Header
+from email.utils import make_msgid
+import mandrill, logging, requests, json, math, smtplib, socket, config, http_session, validation, metrics
+# created by the provider registry the first time it's used
+mandrill_client = LazyClient('mandrill', registry)
 
 
 class Result(object):
     # standardize the results from Mandrill and Mailgun
+    # slots keep the many short lived results small, the subclasses declare theirs too
+    __slots__ = ('status_code', 'status', 'message', 'provider', 'message_id', 'reject_reason', 'retryable')
+
     def __init__(self, status, message, status_code=400):
         self.status_code = status_code
         self.status = status
         self.message = message
+        # set on the results of a successful provider call, recorded in the ledger
+        self.provider = None
+        self.message_id = None
+        self.reject_reason = None
+        # whether a retry may succeed when the status code doesn't tell, see retry.py
+        self.retryable = None
+
+    def to_dict(self):
+        ''' The JSON schema of the results, the optional fields are only there when set '''
+        result = {'status': self.status, 'status_code': self.status_code, 'message': self.message}
+        if self.provider is not None:
+            result['provider'] = self.provider
+        if self.message_id is not None:
+            result['message_id'] = self.message_id
+        return result
 
 
 class SuccessResult(Result):
+    __slots__ = ()
+
     def __init__(self, message, status_code=200):
         super(type(self), self).__init__("success", message, status_code)
 
 
 class ErrorResult(Result):
+    __slots__ = ()
+
     def __init__(self, message, status_code=400):
         super(type(self), self).__init__("error", message, status_code)
 
 
+class RateLimitedResult(Result):
+    __slots__ = ('retry_after',)
+
+    def __init__(self, retry_after, status_code=429):
+        super(type(self), self).__init__("error", "Too many emails, please retry after %s seconds." % int(math.ceil(retry_after)), status_code)
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        result = super(type(self), self).to_dict()
+        result['retry_after'] = self.retry_after
+        return result
+
+
 logger = logging.getLogger('simple_email')
-logger.setLevel(logging.INFO)
-fh = logging.FileHandler('error.log')
-fh.setLevel(logging.ERROR)
-logger.addHandler(fh)
+_logging_configured = False
+
 
+def configure_logging(debug=None, log_file=None):
+    ''' Set up the logging of the service, called once at startup (later calls do nothing)
 
-MAX_SUBJECT_LENGTH = 1000
-MAX_CONTENT_LENGTH = 10000
+    Args:
+        debug: log everything to stderr too, defaults to config.LOG_DEBUG
+        log_file: where the errors are logged, defaults to config.LOG_FILE
+    '''
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
+    debug = config.LOG_DEBUG if debug is None else debug
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    fh = logging.FileHandler(log_file or config.LOG_FILE)
+    fh.setLevel(logging.ERROR)
+    logger.addHandler(fh)
+    if debug:
+        logger.addHandler(logging.StreamHandler())
+
+
+# the fields of message_data used to send an email
+MESSAGE_FIELDS = ('to_email', 'from_email', 'subject', 'content')
+# and the optional ones: html, an HTML alternative of content, attachments (a list of attachments.py dicts)
+# the template fields, see resolve_template, and priority, the lane of the email (see scheduler.py)
+OPTIONAL_FIELDS = ('html', 'attachments', 'template_id', 'template_version', 'template_vars', 'priority')
+TEMPLATE_FIELDS = ('template_id', 'template_version', 'template_vars')
 
 success_result_obj = SuccessResult("Email sent successfully!")
 
 
-def send_email(message_data):
-    result = simple_validate_send_request(message_data)
+def send_email(message_data, idempotency_key=None):
+    message_data, result = resolve_template(message_data)
+    result = result or simple_validate_send_request(message_data) or check_suppressed(message_data)
     if result is not None:
         return result
 
+    if idempotency_key:
+        return send_once(message_data, idempotency_key)
+
+    return check_sender_rate(message_data) or deliver_in_lane(message_data)
+
+
+def send_once(message_data, idempotency_key, send=None):
     '''
-    It's flexible to use task queue to makes asynchronous execution of email sending tasks
-    but I think it's overkill overkill for the purpose of this project and I don't have enough time to do that.
-    Here, it always try to use Mandrill to send the email first, and if there's something
-    wrong like Mandrill service is down, it will try to use Mailgun to send the email.
-    Note that the email may not send immediately, it could be just queue by by Mandrill or Mailgun
-    During the testing, Mailgun sometime has notable delays.
+    Send a validated message at most once for an idempotency key (see ledger.py).
+    A retry with the key gets the stored result back without calling any provider. Only the sent and rejected
+    results are stored, after an error the key is released so that the next retry sends the email.
+
+    Args:
+        send: sends the message, by default within the sender rate limit and the priority lanes
     '''
-    mandrill_result = MandrillEmail().send(message_data)
-    if mandrill_result.status == "success":
-        logger.debug("Returning result from mandrill:: status: %s, message: %s  " % (mandrill_result.status, mandrill_result.message))
-        return mandrill_result
+    ledger = get_ledger()
+    digest = message_hash(message_data)
+    record = ledger.reserve(idempotency_key, digest)
+    if record is not None:
+        return stored_result(record, digest)
+
+    try:
+        if send is not None:
+            result = send(message_data)
+        else:
+            result = check_sender_rate(message_data) or deliver_in_lane(message_data)
+    except Exception:
+        ledger.release(idempotency_key)
+        raise
+    if result.status in ("success", "rejected"):
+        ledger.complete(idempotency_key, result)
+    else:
+        ledger.release(idempotency_key)
+    return result
+
+
+def resolve_template(message_data, templates=None):
+    ''' Fill in the subject, content and html of a message sent with a template (email_templates.py)
 
-    mailgun_result = MailgunEmail().send(message_data)
+    The message gets the template as saved, and the template_version it's sent with when it doesn't name
+    one. The providers merge the template_vars of the recipient into it, see template_of.
 
-    if mailgun_result.status == "success":
-        logger.debug("Returning result from mailgun:: status: %s, message %s " % (mailgun_result.status, mailgun_result.message))
-        return mailgun_result
+    Args:
+        templates: an optional dict of the templates already looked up, by template_id
+
+    Returns:
+        (message_data, None), or (message_data, ErrorResult) when there's no such template
+    '''
+    template_id = message_data.get('template_id')
+    if not template_id:
+        return message_data, None
+    version = message_data.get('template_version')
+    template = templates.get((template_id, version)) if templates is not None else None
+    if template is None:
+        template = get_template_store().get(template_id, version)
+        if template is None:
+            return message_data, ErrorResult("unknown template %s" % template_id, 404)
+        if templates is not None:
+            templates[(template_id, version)] = template
+    message_data = dict(message_data, template_version=template.version)
+    message_data['subject'], message_data['content'], message_data['html'] = template.sources()
+    return message_data, None
+
+
+def template_of(message_data):
+    ''' The CompiledTemplate of a message, or None for a message sent without a template '''
+    if not message_data.get('template_id'):
+        return None
+    template = get_template_store().get(message_data['template_id'], message_data['template_version'])
+    if template is None:
+        raise LookupError("template %s version %s is gone" % (message_data['template_id'], message_data['template_version']))
+    return template
+
+
+def rendered(message_data):
+    ''' The message with its template merged, for the providers that don't render templates '''
+    template = template_of(message_data)
+    if template is None:
+        return message_data
+    message_data = dict(message_data)
+    message_data['subject'], message_data['content'], message_data['html'] = template.render(message_data.get('template_vars'))
+    return message_data
+
+
+def stored_result(record, digest):
+    # the answer to a repeated idempotency key, digest is the message_hash of the repeated email
+    if record['message_hash'] != digest:
+        return ErrorResult("idempotency key was already used for a different email", 422)
+    if record['status'] == PENDING:
+        return ErrorResult("email with this idempotency key is still being sent", 409)
+    return record_result(record)
+
+
+def record_result(record):
+    # the Result stored in a ledger record
+    result = Result(record['status'], record['message'], record['status_code'])
+    result.provider = record['provider']
+    result.message_id = record['provider_message_id']
+    return result
+
+
+def check_suppressed(message_data):
+    # returns a rejected Result, without calling any provider, when the recipient is on the suppression list
+    if not config.SUPPRESSION_ENABLED:
+        return None
+    record = get_suppression_list().check(message_data['to_email'])
+    if record is not None:
+        metrics.SUPPRESSED.inc(reason=record['reason'])
+        return rejected_result(message_data['to_email'], record['reason'])
+
+
+def suppress_recipient(email, result, provider_name):
+    ''' Record a recipient on the suppression list if the provider rejected it for good
+
+    Returns:
+        True if the recipient was suppressed, the next provider should not be tried then
+    '''
+    if not config.SUPPRESSION_ENABLED or result.reject_reason not in SUPPRESS_REASONS:
+        return False
+    get_suppression_list().add(email, result.reject_reason, provider_name)
+    return True
+
+
+def rejected_result(email, reason):
+    result = Result("rejected", "email to %s was rejected due to %s " % (email, reason))
+    result.reject_reason = reason
+    return result
+
+
+def check_sender_rate(message_data, emails=1):
+    # returns a RateLimitedResult when the sender is over config.SENDER_RATE_LIMIT, a batch is charged one
+    # token per email, the bucket goes in debt for a batch larger than the burst (see rate_limit.TokenBucket)
+    retry_after = rate_limiter.acquire_sender(message_data['from_email'], emails)
+    if retry_after:
+        return RateLimitedResult(retry_after)
+
+
+def deliver_in_lane(message_data, deliver=None):
+    ''' deliver_email (or deliver) once the email gets a delivery slot in its priority lane, see scheduler.py '''
+    try:
+        with get_lane_scheduler().slot(lane_of(message_data), message_data['from_email']):
+            return (deliver or deliver_email)(message_data)
+    except LaneBusy as e:
+        return lane_busy_result(e)
+
+
+def lane_busy_result(error):
+    logger.info("Giving up an email: %s", error)
+    result = ErrorResult("Sorry! We cannot send email for now. Please try later.", 503)
+    result.retryable = True
+    return result
+
+
+def deliver_email(message_data):
+    '''
+    Send an already validated message, this is shared by send_email and the workers of the send queue (see send_queue.py).
+    Providers are tried in the order given by provider_router: Mandrill first while both are healthy, the one with the
+    better recent error rate and latency otherwise. A provider whose circuit breaker is open (e.g. Mandrill service is down)
+    is skipped without calling it, so during an outage the email goes straight to the healthy provider.
+    Note that the email may not send immediately, it could be just queue by by Mandrill or Mailgun
+    During the testing, Mailgun sometime has notable delays.
+    '''
+    start = metrics.clock()
+    result = try_providers(message_data)
+    metrics.STAGE_LATENCY.observe_since(start, stage="delivery")
+    metrics.REQUESTS.inc(outcome=metrics.outcome(result))
+    return result
+
+
+def try_providers(message_data):
+    rejected = None
+    failed_provider = None
+    retry_after = None
+    retryable = False
+    for provider in provider_router.ranked():
+        if failed_provider is not None:
+            metrics.FAILOVERS.inc(provider=failed_provider.name)
+            failed_provider = None
+        try:
+            result = provider_router.send(provider, message_data)
+        except RateLimited as e:
+            # not calling a provider over its quota, it would only answer with a 429
+            retry_after = e.retry_after if retry_after is None else min(retry_after, e.retry_after)
+            continue
+        except Exception:
+            logger.exception("Get an exception when calling %s to send the email!", provider.name)
+            failed_provider = provider
+            retryable = True
+            continue
+        if result is None:
+            # half-open and all the probe calls are taken
+            retryable = True
+            continue
+        if result.status == "success":
+            logger.debug("Returning result from %s:: status: %s, message: %s  ", provider.name, result.status, result.message)
+            return result
+        if suppress_recipient(message_data['to_email'], result, provider.name):
+            # the other providers would reject the recipient too
+            return result
+        if result.status == "rejected" and rejected is None:
+            rejected = result
+        retryable = retryable or is_retryable(result)
+        failed_provider = provider
+
+    if rejected is not None:
+        logger.debug("Returning rejected result:: status: %s, message: %s  ", rejected.status, rejected.message)
+        return rejected
+
+    if retry_after is not None:
+        return RateLimitedResult(retry_after)
+
+    result = ErrorResult("Sorry! We cannot send email for now. Please try later.")
+    result.retryable = retryable
+    return result
+
+
+def send_batch(messages):
+    ''' Send many emails in one call
+
+    All the messages are validated first, then the valid ones with the same sender, subject and content
+    are grouped and sent with one provider call per group (up to config.BATCH_SIZE recipients each).
+    The messages sent with the same version of a template are grouped too, whatever their template_vars.
+    Each provider call is charged once to the sender's rate limit, and waits for a slot in the priority lane
+    of its messages, bulk unless they say otherwise.
+
+    Args:
+        messages: a list of message_data dicts, a missing field is treated as empty
+
+    Returns:
+        a list with the Result of each message, in the same order as messages
+    '''
+    templates = {}
+    resolved = [resolve_template(batch_message(message_data), templates) for message_data in messages]
+    messages = [message_data for message_data, _ in resolved]
+    # the ErrorResults of the unknown templates
+    results = [result for _, result in resolved]
+    start = metrics.clock()
+    errors = validation.check_messages(messages)
+    metrics.STAGE_LATENCY.observe_since(start, stage="validation")
+    metrics.INVALID_REQUESTS.inc(len(errors) - errors.count(None))
+    for index, message_data in enumerate(messages):
+        if results[index] is None:
+            results[index] = ErrorResult(errors[index]) if errors[index] is not None else check_suppressed(message_data)
+
+    groups = OrderedDict()
+    for index, message_data in enumerate(messages):
+        if results[index] is None:
+            key = (message_data['from_email'], message_data['subject'], message_data['content'], message_data.get('html'),
+                   message_data.get('template_id'), message_data.get('template_version'), message_data['priority'])
+            groups.setdefault(key, []).append(index)
+
+    for indexes in groups.values():
+        for chunk in batch_chunks(indexes, messages):
+            batch = [messages[i] for i in chunk]
+            # one provider call, the sender's bucket is charged once for it
+            rate_limited = check_sender_rate(batch[0], len(batch))
+            if rate_limited is not None:
+                for index in chunk:
+                    results[index] = rate_limited
+                continue
+            try:
+                with get_lane_scheduler().slot(lane_of(batch[0]), batch[0]['from_email']):
+                    batch_results = deliver_batch(batch)
+            except LaneBusy as e:
+                batch_results = [lane_busy_result(e)] * len(batch)
+            for index, result in zip(chunk, batch_results):
+                results[index] = result
+    return results
+
+
+def batch_message(message_data):
+    # the fields of a batch message, a missing field is treated as empty, the batches take no attachments
+    message = dict((field, message_data.get(field, "")) for field in MESSAGE_FIELDS)
+    for field in ('html',) + TEMPLATE_FIELDS:
+        if message_data.get(field):
+            message[field] = message_data[field]
+    message['priority'] = message_data.get('priority') or config.BATCH_LANE
+    return message
+
+
+def batch_chunks(indexes, messages):
+    # split a group into chunks of at most config.BATCH_SIZE messages, a recipient appears at most once
+    # per chunk so the per recipient results of the provider can be matched back to the messages
+    chunks = []
+    for index in indexes:
+        recipient = messages[index]['to_email'].lower()
+        for chunk, recipients in chunks:
+            if len(chunk) < config.BATCH_SIZE and recipient not in recipients:
+                break
+        else:
+            chunk, recipients = [], set()
+            chunks.append((chunk, recipients))
+        chunk.append(index)
+        recipients.add(recipient)
+    return [chunk for chunk, _ in chunks]
 
-    if mandrill_result.status == "rejected":
-        logger.debug("Returning result from mandrill:: status: %s, message: %s  " % (mandrill_result.status, mandrill_result.message))
-        return mandrill_result
 
-    return ErrorResult("Sorry! We cannot send email for now. Please try later.")
+def deliver_batch(batch):
+    '''
+    Send already validated messages that share the sender, subject and content, the batch counterpart of deliver_email.
+    The messages not sent by a provider are tried with the next one.
+    '''
+    start = metrics.clock()
+    results = [None] * len(batch)
+    pending = range(len(batch))
+    failed_provider = None
+    retry_after = None
+    for provider in provider_router.ranked():
+        if not pending:
+            break
+        if failed_provider is not None:
+            metrics.FAILOVERS.inc(len(pending), provider=failed_provider.name)
+            failed_provider = None
+        try:
+            provider_results = provider_router.send_batch(provider, [batch[i] for i in pending])
+        except RateLimited as e:
+            retry_after = e.retry_after if retry_after is None else min(retry_after, e.retry_after)
+            continue
+        except Exception:
+            logger.exception("Get an exception when calling %s to send the emails!", provider.name)
+            failed_provider = provider
+            continue
+        if provider_results is None:
+            continue
+        still_pending = []
+        for index, result in zip(pending, provider_results):
+            if result.status == "success" or suppress_recipient(batch[index]['to_email'], result, provider.name):
+                results[index] = result
+            else:
+                if result.status == "rejected" and results[index] is None:
+                    results[index] = result
+                still_pending.append(index)
+        pending = still_pending
+        failed_provider = provider
+
+    for index in pending:
+        if results[index] is None:
+            if retry_after is not None:
+                results[index] = RateLimitedResult(retry_after)
+            else:
+                results[index] = ErrorResult("Sorry! We cannot send email for now. Please try later.")
+    metrics.STAGE_LATENCY.observe_since(start, stage="delivery")
+    if metrics.enabled:
+        for result in results:
+            metrics.REQUESTS.inc(outcome=metrics.outcome(result))
+    return results
 
 
 class SimpleEmail(object):
     __metaclass__ = ABCMeta
 
-    def __init__(self, debug=False):
-        if debug:
-            logger.handlers = []
-            logger.addHandler(logging.StreamHandler())
-            logger.setLevel(logging.DEBUG)
+    @classmethod
+    def configured(cls):
+        ''' Whether the provider has what it needs in config to send emails '''
+        return True
 
     @abstractmethod
     def send(self, message):
         pass
 
+    def success_result(self, message_id=None):
+        # a result of its own rather than success_result_obj, it carries the provider's message id
+        result = SuccessResult("Email sent successfully!")
+        result.provider = self.name
+        result.message_id = message_id
+        return result
+
+    def send_batch(self, batch):
+        ''' Send messages sharing the sender, subject and content, returns a Result for each message
+
+        Providers with a bulk API override this, the default sends the messages one by one.
+        '''
+        return [self.send(message_data) for message_data in batch]
+
 
 class MailgunEmail(SimpleEmail):
+    name = 'mailgun'
 
     def send(self, message_data):
         ''' Send email using Mailgun
@@ -93,6 +503,8 @@ class MailgunEmail(SimpleEmail):
                 to_email (string): the email address of the recipient (only have one recipient for now)
                 content (string): full text content to be sent
                 subject (string): the message subject (optional)
+                html (string): an HTML alternative of content (optional)
+                attachments (list): attachment dicts of attachments.py, streamed as a multipart body (optional)
 
         Returns:
             a SuccessResult object for success and a ErrorResult object for failure
@@ -105,29 +517,81 @@ class MailgunEmail(SimpleEmail):
 
               All errors are caught and the responses are logged
         '''
+        data = self.form(message_data, message_data['to_email'])
+        if message_data.get('template_id'):
+            data["recipient-variables"] = self.recipient_variables([message_data])
+        result = self.post(data, message_data.get('attachments'))
+        if result.status_code == 400 and result.message.startswith("'to' parameter is not a valid address"):
+            # Mailgun refuses the recipient address itself
+            result.reject_reason = 'invalid'
+        return result
 
+    def send_batch(self, batch):
+        ''' Send the batch with one call to Mailgun (at most 1000 recipients)
 
+        Passing recipient-variables makes Mailgun send a separate email to each recipient instead of one
+        email listing all of them, they also hold the template_vars of each recipient. Mailgun accepts or refuses the batch as a whole so the same result is
+        returned for every message.
+        '''
+        data = self.form(batch[0], [message_data['to_email'] for message_data in batch])
+        data["recipient-variables"] = self.recipient_variables(batch)
+        result = self.post(data, batch[0].get('attachments'))
+        return [result] * len(batch)
+
+    def form(self, message_data, to):
+        subject, text, html = message_data['subject'], message_data['content'], message_data.get('html')
+        template = template_of(message_data)
+        if template is not None:
+            # Mailgun merges the recipient-variables
+            subject, text, html = template.native('mailgun')
+        data = {"from": message_data['from_email'],
+                "to": to,
+                "subject": subject,
+                "text": text}
+        if html:
+            data["html"] = html
+        return data
+
+    def recipient_variables(self, batch):
+        template = template_of(batch[0])
+        return json.dumps(dict((message_data['to_email'], template.mailgun_variables(message_data.get('template_vars'))
+                                if template is not None else {}) for message_data in batch))
+
+    def post(self, data, attachments=None):
         logger.debug("Starting to call Mailgun to send the email")
-        r = requests.post(
-            config.MAILGUN_MESSAGE_BASE_URL,
-            auth=("api", config.MAILGUN_API_KEY),
-            data={"from": message_data['from_email'],
-                  "to": message_data['to_email'],
-                  "subject": message_data['subject'],
-                  "text": message_data['content']})
+        headers = None
+        if attachments:
+            # a multipart body streaming the files, requests' files= would read them all into memory
+            data, content_type = multipart_body(data, attachments)
+            headers = {'Content-Type': content_type}
+        # Mailgun has no client in the registry, the environment overrides are applied here instead
+        load_settings()
+        try:
+            r = http_session.get_session('mailgun').post(
+                config.MAILGUN_MESSAGE_BASE_URL,
+                auth=("api", config.MAILGUN_API_KEY),
+                data=data, headers=headers)
+        except requests.RequestException as e:
+            return request_error_result("Mailgun", e)
         status_code = r.status_code
-        json_response = r.json()
-        response_message = json_response['message']
-        logger.debug("Getting result from calling Mailgun: response code: %s, message: %s " % (status_code,response_message))
+        try:
+            body = r.json()
+            response_message = body['message']
+        except (ValueError, KeyError, TypeError):
+            # e.g. an html error page from a proxy in front of Mailgun
+            body = {}
+            response_message = r.text
+        logger.debug("Getting result from calling Mailgun: response code: %s, message: %s ", status_code, response_message)
         if status_code == 200:
-            return success_result_obj
+            return self.success_result(body.get('id'))
         else:
-            logger.error("Getting an error from Mailgun: response code: %s, message: %s " % (status_code,response_message))
+            logger.error("Getting an error from Mailgun: response code: %s, message: %s ", status_code, response_message)
         return ErrorResult(response_message, status_code)
 
 
 
 class MandrillEmail(SimpleEmail):
+    name = 'mandrill'
 
     def send(self, message_data):
         ''' Send email using mandrill client lib
@@ -138,6 +602,8 @@ class MandrillEmail(SimpleEmail):
                 to_email (string): the email address of the recipient (only have one recipient for now)
                 content (string): full text content to be sent (optional)
                 subject (string): the message subject (optional)
+                html (string): an HTML alternative of content (optional)
+                attachments (list): attachment dicts of attachments.py, base64 encoded through the cache (optional)
 
         Returns:
             a SuccessResult object for success and a ErrorResult object for failure
@@ -170,45 +636,261 @@ class MandrillEmail(SimpleEmail):
 
               We catch all the Mandrill Errors and log them
         '''
+        results, error_result = self.call(self.build_message([message_data]), message_data.get('attachments'))
+        if error_result is not None:
+            return error_result
+        return self.to_result(results[0])
 
+    def send_batch(self, batch):
+        ''' Send the batch as one Mandrill message with a recipient per message
+
+        preserve_recipients is off so each recipient gets its own email without the other addresses.
+        Mandrill returns a status for each recipient, they are matched back to the messages by email address.
+        '''
+        message = self.build_message(batch)
+        message['preserve_recipients'] = False
+        results, error_result = self.call(message, batch[0].get('attachments'))
+        if error_result is not None:
+            return [error_result] * len(batch)
+        results_by_email = dict((result['email'].lower(), result) for result in results)
+        batch_results = []
+        for message_data in batch:
+            result = results_by_email.get(message_data['to_email'].lower())
+            if result is None:
+                logger.error("Get no result for %s when calling Mandrill to send the emails!", message_data['to_email'])
+                batch_results.append(ErrorResult("Get no result from Mandrill!"))
+            else:
+                batch_results.append(self.to_result(result))
+        return batch_results
+
+    def build_message(self, batch):
+        # one message to the recipients of the batch, which share everything but the recipient and template_vars
+        first = batch[0]
         message = {
-            'from_email': message_data['from_email'],
-            'subject': message_data['subject'],
-            'text': message_data['content'],
+            'from_email': first['from_email'],
+            'subject': first['subject'],
+            'text': first['content'],
             'to': [{'email': message_data['to_email'],
-                    'type': 'to'}]
+                    'type': 'to'} for message_data in batch]
         }
-        results = None
+        if first.get('html'):
+            message['html'] = first['html']
+        template = template_of(first)
+        if template is not None:
+            # Mandrill merges the merge_vars of each recipient
+            message['subject'], message['text'], html = template.native('handlebars')
+            if html:
+                message['html'] = html
+            message['merge_language'] = 'handlebars'
+            message['merge_vars'] = [{'rcpt': message_data['to_email'],
+                                      'vars': template.mandrill_variables(message_data.get('template_vars'))} for message_data in batch]
+        return message
+
+    def call(self, message, attachments=None):
+        ''' Call messages.send, returns the per recipient results or the ErrorResult of a failed call '''
         try:
             logger.debug("Starting to call Mandrill to send the email")
-            results = mandrill_client.messages.send(message=message, async=False, ip_pool='Main Pool')
-            logger.debug("Get result back from Mandrill: %s " % results)
+            if attachments:
+                results = self.send_with_attachments(message, attachments)
+            else:
+                results = mandrill_client.messages.send(message=message, async=False, ip_pool='Main Pool')
+            logger.debug("Get result back from Mandrill: %s ", results)
         except mandrill.Error as e:
             # Catch all Mandrill errors
             logger.exception("Get an exception when calling Mandrill to send the email!")
-            return ErrorResult(e.message)
+            return None, ErrorResult(e.message, mandrill_error_status_code(e))
+        except requests.RequestException as e:
+            return None, request_error_result("Mandrill", e)
+        return results, None
 
-        result = results[0]
-        if result['status'] == 'sent':
-            return success_result_obj
+    def send_with_attachments(self, message, attachments):
+        ''' messages/send with the attachments streamed from their cached base64 encodings
+
+        The client library would json.dumps the whole request, attachments included, in memory.
+        '''
+        cache = get_encoded_cache()
+        placeholders = Placeholders()
+        message = dict(message, attachments=[{'type': attachment['type'], 'name': attachment['name'],
+                                              'content': placeholders.add(FilePart(cache.path(attachment)))}
+                                             for attachment in attachments])
+        params = json.dumps({'key': mandrill_client.apikey, 'message': message, 'async': False, 'ip_pool': 'Main Pool'})
+        r = http_session.get_session('mandrill').post('%smessages/send.json' % mandrill.ROOT, data=StreamingBody(placeholders.splice(params)),
+                                                      headers={'content-type': 'application/json'})
+        result = r.json()
+        if r.status_code != requests.codes.ok:
+            raise mandrill_client.cast_error(result)
+        return result
+
+    def to_result(self, result):
+        # Mandrill may queue the emails of a large batch instead of sending them right away
+        if result['status'] in ('sent', 'queued'):
+            return self.success_result(result.get('_id'))
         elif result['status'] == 'rejected':
-            return Result(result['status'], "email to %s was rejected due to %s " % (result['email'], result['reject_reason']))
+            return rejected_result(result['email'], result['reject_reason'])
         else:
-            logger.error("Get an unexpected status:  %s when calling Mandrill to send the email!" % result['status'])
+            logger.error("Get an unexpected status:  %s when calling Mandrill to send the email!", result['status'])
             return Result(result['status'], "Get an unexpected status from Mandrill!")
 
 
+class SmtpEmail(SimpleEmail):
+    name = 'smtp'
+
+    @classmethod
+    def configured(cls):
+        return bool(config.SMTP_HOST)
+
+    def send(self, message_data):
+        ''' Send email through the SMTP relay of config.SMTP_HOST, on a pooled connection (see smtp_pool.py)
+
+        Args:
+            message_data: same as MandrillEmail.send
+
+        Returns:
+            a SuccessResult with the Message-ID for success, a rejected Result when the mailbox refuses the
+            email (550, 551 or 553 for good, 552 while it's full), a retryable 503 ErrorResult when the relay
+            can't take the recipient for now (4xx), and an ErrorResult otherwise
+        '''
+        return self.send_batch([message_data])[0]
+
+    def send_batch(self, batch):
+        ''' Send the messages one after the other on the same SMTP session
+
+        A session dropped by the relay while idle in the pool is only noticed when it's used,
+        the messages not sent yet are then tried once more on a new session.
+        '''
+        results = []
+        for attempt in range(2):
+            try:
+                with registry.get('smtp').connection() as connection:
+                    while len(results) < len(batch):
+                        results.append(self.deliver(connection, batch[len(results)]))
+                return results
+            except smtplib.SMTPServerDisconnected as e:
+                logger.info("The SMTP relay closed the connection: %s", e)
+                error = smtp_error_result(e)
+            except (smtplib.SMTPException, EnvironmentError, PoolTimeout) as e:
+                error = smtp_error_result(e)
+                break
+        return results + [error] * (len(batch) - len(results))
+
+    def deliver(self, connection, message_data):
+        # the relay gets the emails rendered
+        message_data = rendered(message_data)
+        message, placeholders = self.build_message(message_data)
+        message['Subject'] = Header(message_data['subject'], 'utf-8')
+        message['From'] = message_data['from_email']
+        message['To'] = message_data['to_email']
+        message['Message-ID'] = message_id = make_msgid()
+        try:
+            if placeholders is None:
+                connection.sendmail(message_data['from_email'], [message_data['to_email']], message.as_string())
+            else:
+                # the DATA lines are CRLF terminated and dot-stuffed like sendmail does, base64 lines never start with a dot
+                connection.sendmail_stream(message_data['from_email'], [message_data['to_email']],
+                                           StreamingBody(placeholders.splice(smtplib.quotedata(message.as_string()))))
+        except smtplib.SMTPRecipientsRefused as e:
+            code, reply = e.recipients.values()[0]
+            logger.error("The SMTP relay refused %s: %s %s", message_data['to_email'], code, reply)
+            if code in (550, 551, 553):
+                return rejected_result(message_data['to_email'], 'hard-bounce')
+            if code == 552:
+                return rejected_result(message_data['to_email'], 'soft-bounce')
+            if 400 <= code < 500:
+                # e.g. greylisting or the relay out of resources, nothing is known about the mailbox yet
+                result = ErrorResult("the SMTP relay can't take the recipient for now: %s" % reply, 503)
+                result.retryable = True
+                return result
+            return ErrorResult("the SMTP relay refused the recipient: %s" % reply)
+        except smtplib.SMTPSenderRefused as e:
+            logger.error("The SMTP relay refused the sender %s: %s %s", e.sender, e.smtp_code, e.smtp_error)
+            return ErrorResult("the SMTP relay refused the sender: %s" % e.smtp_error)
+        except smtplib.SMTPDataError as e:
+            logger.error("The SMTP relay refused the message: %s %s", e.smtp_code, e.smtp_error)
+            return ErrorResult("the SMTP relay refused the message: %s" % e.smtp_error, 503 if 400 <= e.smtp_code < 500 else 400)
+        return self.success_result(message_id)
+
+    def build_message(self, message_data):
+        ''' The MIME message, with placeholders for the attachments streamed from the encoded cache
+
+        Returns:
+            (message, Placeholders or None when there's no attachment)
+        '''
+        message = MIMEText(utf8(message_data['content']), 'plain', 'utf-8')
+        if message_data.get('html'):
+            alternative = MIMEMultipart('alternative')
+            alternative.attach(message)
+            alternative.attach(MIMEText(utf8(message_data['html']), 'html', 'utf-8'))
+            message = alternative
+        if not message_data.get('attachments'):
+            return message, None
+        cache = get_encoded_cache()
+        placeholders = Placeholders()
+        mixed = MIMEMultipart('mixed')
+        mixed.attach(message)
+        for attachment in message_data['attachments']:
+            part = MIMEBase(*attachment['type'].split('/', 1)) if '/' in attachment['type'] else MIMEBase('application', 'octet-stream')
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment', filename=mime_filename(attachment['name']))
+            part.set_payload(placeholders.add(FilePart(cache.path(attachment), MIME_LINE_LENGTH)))
+            mixed.attach(part)
+        return mixed, placeholders
+
+
+def utf8(text):
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def mime_filename(name):
+    # a non ASCII file name is RFC 2231 encoded
+    name = utf8(name)
+    try:
+        name.decode('ascii')
+    except UnicodeDecodeError:
+        return ('utf-8', '', name)
+    return name
+
+
+def smtp_error_result(error):
+    # the relay could not be reached or the session broke
+    logger.exception("Get an error when sending the email through the SMTP relay!")
+    if isinstance(error, socket.timeout):
+        return ErrorResult("SMTP relay timed out", 504)
+    return ErrorResult("cannot connect to the SMTP relay", 503)
+
+
+def mandrill_error_status_code(error):
+    # Mandrill being down or answering with an error it doesn't name is worth a retry, the named errors
+    # (ValidationError, Invalid_Key, ...) are not
+    if isinstance(error, mandrill.ServiceUnavailableError):
+        return 503
+    if type(error) is mandrill.Error:
+        return 502
+    return 400
+
+
+def request_error_result(provider_name, error):
+    # connection errors and timeouts talking to a provider, a hung socket is cut by the session timeouts
+    logger.exception("Get a connection error when calling %s to send the email!", provider_name)
+    if isinstance(error, requests.Timeout):
+        return ErrorResult("%s timed out" % provider_name, 504)
+    return ErrorResult("cannot connect to %s" % provider_name, 503)
+
+
 def simple_validate_send_request(message_data):
-    if not validate_email(message_data['to_email']):
-        return ErrorResult("invalid recipient email")
-    if not validate_email(message_data['from_email']):
-        return ErrorResult("invalid sender email")
-    if message_data['subject'] == "":
-        return ErrorResult("subject cannot be empty")
-    elif len(message_data['subject']) > MAX_SUBJECT_LENGTH:
-        return ErrorResult("subject cannot be more than %s characters" % MAX_SUBJECT_LENGTH)
-    if message_data['content'] == "":
-        return ErrorResult("content cannot be empty")
-    elif len(message_data['content']) > MAX_CONTENT_LENGTH:
-        return ErrorResult("content cannot be more than %s characters" % MAX_CONTENT_LENGTH)
+    # see validation.py, the address verdicts are cached
+    start = metrics.clock()
+    error = validation.check_message(message_data)
+    metrics.STAGE_LATENCY.observe_since(start, stage="validation")
+    if error is not None:
+        metrics.INVALID_REQUESTS.inc()
+        return ErrorResult(error)
+
+
+rate_limiter = RateLimiter()
+
+PROVIDERS = dict((provider.name, provider) for provider in (MandrillEmail, MailgunEmail, SmtpEmail))
 
+# providers in order of preference (config.PROVIDER_ORDER), the router skips the ones whose circuit breaker is open
+# or that are over their rate limit
+provider_router = ProviderRouter([PROVIDERS[name] for name in config.PROVIDER_ORDER if PROVIDERS[name].configured()],
+                                 rate_limiter=rate_limiter)
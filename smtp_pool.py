@@ -0,0 +1,197 @@
+'''
+A pool of persistent SMTP connections to the relay used by SmtpEmail.
+
+Opening an SMTP session costs a TCP connect, EHLO, STARTTLS and AUTH, several round trips before
+the first message. The pool keeps authenticated sessions open and hands them out for one or more
+messages each. A session that sat idle for a while is checked with NOOP before it's reused, since
+relays drop idle clients, and sessions are replaced after config.SMTP_MAX_MESSAGES messages.
+'''
+from contextlib import contextmanager
+import logging, smtplib, threading, time, config
+
+logger = logging.getLogger('simple_email')
+
+
+class PoolTimeout(Exception):
+    ''' Raised when no connection became free in time '''
+
+
+class PooledConnection(object):
+    def __init__(self, smtp, clock):
+        self.smtp = smtp
+        self.created_at = self.last_used = clock()
+        self.messages = 0
+
+    def sendmail(self, from_addr, to_addrs, message):
+        self.messages += 1
+        return self.smtp.sendmail(from_addr, to_addrs, message)
+
+    def sendmail_stream(self, from_addr, to_addrs, chunks):
+        ''' sendmail for a message given as chunks, already CRLF terminated and dot-stuffed
+
+        smtplib only sends a message held in one string, this writes the DATA a chunk at a time.
+        Raises the same exceptions as sendmail.
+        '''
+        self.messages += 1
+        smtp = self.smtp
+        smtp.ehlo_or_helo_if_needed()
+        code, reply = smtp.mail(from_addr)
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, reply, from_addr)
+        refused = {}
+        for to_addr in to_addrs:
+            code, reply = smtp.rcpt(to_addr)
+            if code not in (250, 251):
+                refused[to_addr] = (code, reply)
+        if len(refused) == len(to_addrs):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, reply = smtp.docmd('data')
+        if code != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, reply)
+        last = ''
+        for chunk in chunks:
+            smtp.send(chunk)
+            last = chunk
+        smtp.send('.\r\n' if last.endswith('\r\n') else '\r\n.\r\n')
+        code, reply = smtp.getreply()
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, reply)
+        return refused
+
+
+class SmtpConnectionPool(object):
+    ''' Up to `size` open SMTP sessions to one relay
+
+    Args:
+        host, port: the relay
+        username, password: AUTH credentials, no login without a username
+        starttls: upgrade the session to TLS before logging in
+        check_after: seconds of idleness after which a session is checked with NOOP before reuse
+        max_messages: messages sent on a session before it's closed and replaced
+    '''
+
+    def __init__(self, host=None, port=None, username=None, password=None, starttls=None, size=None, timeout=None,
+                 check_after=None, max_messages=None, smtp_class=smtplib.SMTP, clock=time.time):
+        self.host = host or config.SMTP_HOST
+        self.port = port or config.SMTP_PORT
+        self.username = username if username is not None else config.SMTP_USERNAME
+        self.password = password if password is not None else config.SMTP_PASSWORD
+        self.starttls = starttls if starttls is not None else config.SMTP_STARTTLS
+        self.size = size or config.SMTP_POOL_SIZE
+        self.timeout = timeout or config.SMTP_TIMEOUT
+        self.check_after = check_after if check_after is not None else config.SMTP_CHECK_AFTER
+        self.max_messages = max_messages or config.SMTP_MAX_MESSAGES
+        self.smtp_class = smtp_class
+        self.clock = clock
+        self._idle = []
+        self._open_count = 0        # connections open, idle or in use
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self.opened = 0
+        self.reused = 0
+        self.dropped = 0
+
+    @contextmanager
+    def connection(self):
+        ''' A PooledConnection for the duration of the block, it goes back to the pool unless the session broke '''
+        connection = self.acquire()
+        try:
+            yield connection
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError, EnvironmentError):
+            self.release(connection, broken=True)
+            raise
+        except Exception:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+        with self._available:
+            while not self._idle and self._open_count >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("no SMTP connection to %s became free within %ss" % (self.host, self.timeout))
+                self._available.wait(remaining)
+            connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                self._open_count += 1
+        if connection is not None:
+            if self._healthy(connection):
+                with self._lock:
+                    self.reused += 1
+                return connection
+            # replaced by a new connection, which takes its place in the count
+            self._close(connection)
+        try:
+            return self._open()
+        except Exception:
+            self._forget()
+            raise
+
+    def release(self, connection, broken=False):
+        connection.last_used = self.clock()
+        if broken or connection.messages >= self.max_messages:
+            self._close(connection)
+            self._forget()
+        else:
+            with self._available:
+                self._idle.append(connection)
+                self._available.notify()
+
+    def close(self):
+        ''' Quit the idle sessions, the ones in use are closed when released '''
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+        for connection in idle:
+            self._close(connection)
+
+    def stats(self):
+        with self._lock:
+            return {'open': self._open_count, 'idle': len(self._idle), 'opened': self.opened, 'reused': self.reused,
+                    'dropped': self.dropped}
+
+    def _open(self):
+        smtp = self.smtp_class(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.ehlo_or_helo_if_needed()
+            if self.starttls:
+                smtp.starttls()
+                smtp.ehlo()
+            if self.username:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        with self._lock:
+            self.opened += 1
+        return PooledConnection(smtp, self.clock)
+
+    def _healthy(self, connection):
+        if self.clock() - connection.last_used < self.check_after:
+            return True
+        try:
+            return connection.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, EnvironmentError):
+            logger.info("Dropping a stale SMTP connection to %s", self.host)
+            return False
+
+    def _forget(self):
+        # a connection was closed or could not be opened, its place is free
+        with self._available:
+            self._open_count -= 1
+            self._available.notify()
+
+    def _close(self, connection):
+        with self._lock:
+            self.dropped += 1
+        try:
+            connection.smtp.quit()
+        except (smtplib.SMTPException, EnvironmentError):
+            connection.smtp.close()
@@ -0,0 +1,216 @@
+'''
+Suppression list of the recipients the providers rejected for good.
+
+A recipient rejected for a hard bounce, a spam complaint, an unsubscribe or an invalid address is
+recorded here, and the next emails to it get a rejected result right away instead of going through
+the providers again. A soft bounce is transient and retried (see retry.py), it doesn't suppress the
+recipient; a soft-bounce record imported by hand is kept for config.SUPPRESSION_SOFT_BOUNCE_TTL seconds.
+
+The list is a sqlite table keyed by address, fronted by a Bloom filter of all the addresses in it:
+most recipients are not suppressed and the filter answers those with a few bit probes, only a
+possible hit is looked up in the table. After share_bloom(), the processes forked afterwards (the
+workers of server.py) use one filter in shared memory and see each other's additions.
+
+Usage:
+  suppression.py import <csv_file>
+  suppression.py export <csv_file>
+  suppression.py purge
+'''
+from docopt import docopt
+import sys, csv, ctypes, hashlib, math, mmap, multiprocessing, sqlite3, struct, threading, time, config
+
+# the reject reasons telling that the recipient will not get the emails, whatever the provider
+# (not soft-bounce: it is retried, see retry.RETRYABLE_REJECT_REASONS)
+SUPPRESS_REASONS = ('hard-bounce', 'spam', 'unsub', 'reject', 'invalid')
+
+FIELDS = ('email', 'reason', 'provider', 'created_at', 'expires_at')
+
+
+def suppression_ttl(reason):
+    ''' Seconds a recipient rejected for reason is suppressed, None for good '''
+    return config.SUPPRESSION_SOFT_BOUNCE_TTL if reason == 'soft-bounce' else None
+
+
+def bloom_size(capacity, error_rate=0.01):
+    ''' Bits of a Bloom filter holding capacity strings with that false positive rate '''
+    return int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+
+
+class SharedBloom(object):
+    ''' The bits of a Bloom filter in anonymous shared memory and the lock of the processes setting them '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.map = mmap.mmap(-1, (bloom_size(capacity) + 7) // 8)
+        self.bits = (ctypes.c_ubyte * len(self.map)).from_buffer(self.map)
+        self.lock = multiprocessing.Lock()
+
+
+_shared_bloom = None
+
+
+def share_bloom(capacity=None):
+    ''' Keep the Bloom filter of the suppression lists opened from now on in shared memory, called before forking workers '''
+    global _shared_bloom
+    _shared_bloom = SharedBloom(capacity or config.SUPPRESSION_BLOOM_CAPACITY)
+
+
+class BloomFilter(object):
+    ''' A set of strings that may answer yes for a string it doesn't hold (about error_rate of the time), never no for one it holds '''
+
+    def __init__(self, capacity, error_rate=0.01, bits=None):
+        self.size = bloom_size(capacity, error_rate)
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        # a bytearray, or a ctypes array of (size + 7) // 8 bytes over shared memory
+        self._bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        # double hashing, the k positions come from two 64 bit halves of one digest
+        first, second = struct.unpack('<QQ', hashlib.md5(value).digest())
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class SuppressionList(object):
+
+    def __init__(self, path=None, capacity=None, clock=time.time):
+        self.path = path or config.SUPPRESSION_PATH
+        self.capacity = capacity or config.SUPPRESSION_BLOOM_CAPACITY
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS suppressions (
+                                email TEXT PRIMARY KEY,
+                                reason TEXT NOT NULL,
+                                provider TEXT,
+                                created_at REAL NOT NULL,
+                                expires_at REAL) WITHOUT ROWID''')
+        shared = _shared_bloom if _shared_bloom is not None and _shared_bloom.capacity == self.capacity else None
+        self._shared_bloom = shared
+        # the processes sharing the filter set its bits under one lock, an |= on a byte is not atomic
+        self._bloom_lock = shared.lock if shared is not None else threading.Lock()
+        self._bloom = BloomFilter(self.capacity, bits=shared.bits if shared is not None else None)
+        self._load_bloom()
+
+    def check(self, email):
+        ''' The suppression record of a recipient, None if it is not suppressed '''
+        email = email.lower()
+        if email not in self._bloom:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT %s FROM suppressions WHERE email = ? AND (expires_at IS NULL OR expires_at > ?)"
+                                     % ', '.join(FIELDS), (email, self.clock())).fetchone()
+        return dict(zip(FIELDS, row)) if row is not None else None
+
+    def add(self, email, reason, provider=None):
+        self.add_many([(email, reason, provider)])
+
+    def add_many(self, records):
+        ''' Suppress many recipients in one transaction, records are (email, reason, provider) tuples
+
+        Returns:
+            the number of recipients added
+        '''
+        now = self.clock()
+        rows = []
+        for email, reason, provider in records:
+            ttl = suppression_ttl(reason)
+            rows.append((email.lower(), reason, provider, now, None if ttl is None else now + ttl))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO suppressions (%s) VALUES (?, ?, ?, ?, ?)" % ', '.join(FIELDS), rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            with self._bloom_lock:
+                for row in rows:
+                    self._bloom.add(row[0])
+        return len(rows)
+
+    def remove(self, email):
+        ''' Stop suppressing a recipient, the Bloom filter keeps it until the next purge '''
+        with self._lock:
+            self._conn.execute("DELETE FROM suppressions WHERE email = ?", (email.lower(),))
+
+    def purge_expired(self):
+        ''' Delete the expired records and rebuild the Bloom filter without the addresses removed since '''
+        with self._lock:
+            self._conn.execute("DELETE FROM suppressions WHERE expires_at IS NOT NULL AND expires_at <= ?", (self.clock(),))
+        self._load_bloom()
+
+    def import_csv(self, csv_file):
+        ''' Add the recipients of a CSV file with email and reason columns (provider is optional)
+
+        Returns:
+            the number of recipients added
+        '''
+        return self.add_many((row['email'], row['reason'], row.get('provider') or None) for row in csv.DictReader(csv_file))
+
+    def export_csv(self, csv_file):
+        ''' Write the suppressed recipients to a CSV file, in the format import_csv reads '''
+        writer = csv.writer(csv_file)
+        writer.writerow(FIELDS)
+        with self._lock:
+            rows = self._conn.execute("SELECT %s FROM suppressions WHERE expires_at IS NULL OR expires_at > ? ORDER BY email"
+                                      % ', '.join(FIELDS), (self.clock(),)).fetchall()
+        for row in rows:
+            writer.writerow(['' if value is None else value for value in row])
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _load_bloom(self):
+        bloom = BloomFilter(self.capacity)
+        # the table is read under the bloom lock so that no address added meanwhile by another process is lost
+        with self._lock, self._bloom_lock:
+            for (email,) in self._conn.execute("SELECT email FROM suppressions"):
+                bloom.add(email)
+            if self._shared_bloom is not None:
+                self._shared_bloom.map[:] = str(bloom._bits)
+            else:
+                self._bloom = bloom
+
+
+_suppression_list = None
+_suppression_lock = threading.Lock()
+
+
+def get_suppression_list():
+    ''' The process wide suppression list, opened on first use '''
+    global _suppression_list
+    with _suppression_lock:
+        if _suppression_list is None:
+            _suppression_list = SuppressionList()
+        return _suppression_list
+
+
+def main(argv=None):
+    options = docopt(__doc__, argv=argv)
+    suppressions = get_suppression_list()
+    if options['import']:
+        with open(options['<csv_file>'], 'rb') as f:
+            print "%s recipients imported" % suppressions.import_csv(f)
+    elif options['export']:
+        with open(options['<csv_file>'], 'wb') as f:
+            print "%s recipients exported" % suppressions.export_csv(f)
+    else:
+        suppressions.purge_expired()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
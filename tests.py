@@ -1,7 +1,27 @@
-from simple_email import MandrillEmail, MailgunEmail, simple_validate_send_request, ErrorResult, Result
+from simple_email import MandrillEmail, MailgunEmail, SmtpEmail, simple_validate_send_request, ErrorResult, Result
 from view import app
 from mandrill import ValidationError
-import unittest, mock, simple_email
+from send_queue import SendQueue, WorkerPool, QueuedResult
+from circuit_breaker import CircuitBreaker, SharedCircuitBreaker, ProviderRouter, CLOSED, OPEN, HALF_OPEN, SHARED_WIDTH
+from async_email import SendFuture, AsyncMandrillEmail, send_email_async
+from validation import AddressCache, check_messages
+from rate_limit import RateLimiter, RateLimited, LocalStore, TokenBucket
+from shared_memory import SharedSlots
+from ledger import Ledger, PENDING, message_hash
+from retry import is_retryable, backoff_delay
+from fake_providers import FakeProviderServer, FakeSmtpServer, MANDRILL, MAILGUN, use_fake_providers
+from smtp_pool import SmtpConnectionPool, PoolTimeout
+from providers import ProviderRegistry, LazyClient
+from suppression import BloomFilter, SuppressionList
+from attachments import EncodedCache, FilePart, StreamingBody, multipart_body, spool
+from email_templates import CompiledTemplate, TemplateStore
+from scheduler import LaneScheduler, LaneBusy
+from server import PreforkServer
+from StringIO import StringIO
+from validate_email import validate_email
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import unittest, mock, mandrill, config, bench, async_email, providers, logging, simple_email, send_queue, attachments, suppression, email_templates, scheduler, base64, email, signal, validation, metrics, http_session, requests, tempfile, shutil, os, time, threading, json
 
 valid_message = {
     'to_email': 'dawen.uiuc@gmail.com',
@@ -98,6 +118,49 @@ class ViewTests(unittest.TestCase):
         assert "content cannot be empty" in result.data
 
 
+class JsonApiTests(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+
+    @mock.patch('view.send_email')
+    def test_send_message(self, send_email):
+        send_email.return_value = MandrillEmail().success_result('abc123')
+        response = self.app.post('/v1/messages', data=json.dumps(valid_message), content_type='application/json',
+                                 headers={'Idempotency-Key': 'key'})
+        assert response.status_code == 200
+        assert response.mimetype == 'application/json'
+        assert json.loads(response.data) == {'status': 'success', 'status_code': 200, 'message': 'Email sent successfully!',
+                                             'provider': 'mandrill', 'message_id': 'abc123'}
+        assert send_email.call_args[0] == (valid_message, 'key')
+
+    def test_real_status_codes(self):
+        response = self.app.post('/v1/messages', data=json.dumps(message_with_empty_subject), content_type='application/json')
+        assert response.status_code == 400
+        assert json.loads(response.data)['message'] == 'subject cannot be empty'
+        response = self.app.post('/v1/messages', data=json.dumps([valid_message]), content_type='application/json')
+        assert response.status_code == 400
+        response = self.app.post('/v1/messages', data=json.dumps(dict(valid_message, subject=1)), content_type='application/json')
+        assert response.status_code == 400
+
+    def test_content_negotiation(self):
+        response = self.app.post('/', data=message_with_empty_subject, headers={'Accept': 'application/json'})
+        assert response.mimetype == 'application/json'
+        assert json.loads(response.data)['message'] == 'subject cannot be empty'
+        response = self.app.post('/', data=json.dumps(message_with_empty_subject), content_type='application/json')
+        assert json.loads(response.data)['status_code'] == 400
+        response = self.app.post('/', data=message_with_empty_subject, headers={'Accept': 'text/html,*/*;q=0.8'})
+        assert response.mimetype == 'text/html'
+        assert response.status_code == 400
+        assert "subject cannot be empty" in response.data
+
+    def test_result_slots(self):
+        result = ErrorResult("error message")
+        with self.assertRaises(AttributeError):
+            result.extra = 1
+        assert not hasattr(result, '__dict__')
+        assert QueuedResult('job-1').to_dict()['job_id'] == 'job-1'
+
+
 class MailgunAndMandrillTests(unittest.TestCase):
 
     def test_mailgun_send(self):
@@ -208,6 +271,1541 @@ def test_both_mailgun_mandrill_error(mandrill_send, mailgun_send, validator):
 
 
 
+class SendQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = SendQueue(os.path.join(self.tmp_dir, 'queue.db'))
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_and_get_in_order(self):
+        first = self.queue.put(valid_message)
+        second = self.queue.put(message_with_empty_subject)
+        assert self.queue.depth() == 2
+        assert self.queue.get(timeout=0) == (first, valid_message)
+        assert self.queue.get(timeout=0)[0] == second
+        assert self.queue.get(timeout=0) is None
+        assert self.queue.status(first)['state'] == send_queue.SENDING
+
+    def test_sending_jobs_are_requeued_after_lease(self):
+        clock = FakeClock()
+        job_id = self.queue.put(valid_message)
+        self.queue.get(timeout=0)
+        self.queue.close()
+        # another process opening the queue doesn't take back a job being sent
+        self.queue = SendQueue(os.path.join(self.tmp_dir, 'queue.db'), lease=60, clock=clock)
+        clock.now = time.time() + 59
+        assert self.queue.get(timeout=0) is None
+        clock.now += 2
+        assert self.queue.get(timeout=0) == (job_id, valid_message)
+        assert self.queue.status(job_id)['state'] == send_queue.SENDING
+
+    def test_retries_are_due_in_the_queue(self):
+        clock = FakeClock()
+        clock.now = time.time()
+        job_id = self.queue.put(valid_message)
+        self.queue.get(timeout=0)
+        self.queue.retry(job_id, ErrorResult("Mandrill timed out", 504), 30)
+        self.queue.close()
+        self.queue = SendQueue(os.path.join(self.tmp_dir, 'queue.db'), clock=clock)
+        assert self.queue.get(timeout=0) is None
+        assert self.queue.status(job_id)['state'] == send_queue.RETRYING
+        clock.now += 31
+        assert self.queue.get(timeout=0) == (job_id, valid_message)
+        assert self.queue.attempts(job_id) == 1
+
+    def test_worker_pool_drains_queue(self):
+        # the workers call send at the same time, Mock.call_count is not thread safe but list.append is
+        sent = []
+        send = lambda message_data: sent.append(message_data) or simple_email.success_result_obj
+        job_ids = [self.queue.put(valid_message) for i in range(5)]
+        pool = WorkerPool(self.queue, size=2, send=send, poll_interval=0.05)
+        pool.start()
+        for i in range(100):
+            if all(self.queue.status(job_id)['state'] == send_queue.DONE for job_id in job_ids):
+                break
+            time.sleep(0.02)
+        pool.stop()
+        assert len(sent) == 5
+        job = self.queue.status(job_ids[0])
+        assert job['status'] == 'success'
+        assert job['status_code'] == 200
+        assert job['message'] == "Email sent successfully!"
+
+    def test_unknown_job(self):
+        assert self.queue.status('missing') is None
+
+    @mock.patch.object(send_queue, 'get_worker_pool')
+    def test_job_end_point_does_not_start_workers(self, get_worker_pool):
+        job_id = self.queue.put(valid_message)
+        client = app.test_client()
+        assert client.get('/jobs/%s' % job_id).status_code == 404
+        with mock.patch.object(config, 'SEND_ASYNC', True), \
+                mock.patch.object(config, 'SEND_QUEUE_PATH', os.path.join(self.tmp_dir, 'queue.db')), \
+                mock.patch.object(send_queue, '_default_queue', None), mock.patch.object(send_queue, '_lookup_queue', None):
+            assert json.loads(client.get('/jobs/%s' % job_id).data)['state'] == send_queue.QUEUED
+            assert client.get('/jobs/missing').status_code == 404
+            send_queue._lookup_queue.close()
+        assert get_worker_pool.call_count == 0
+
+    def test_jobs_are_shared_by_lane_then_sender(self):
+        for i in range(4):
+            self.queue.put(dict(valid_message, from_email='a@gmail.com', priority='bulk', subject='a%s' % i))
+        for i in range(2):
+            self.queue.put(dict(valid_message, from_email='b@gmail.com', priority='bulk', subject='b%s' % i))
+        for i in range(4):
+            self.queue.put(dict(valid_message, from_email='c@gmail.com', subject='c%s' % i))
+        assert self.queue.lane_depths() == {'transactional': 4, 'bulk': 6}
+        subjects = [self.queue.get(timeout=0)[1]['subject'] for i in range(10)]
+        # transactional has 4 turns for each bulk one, the bulk senders take turns
+        assert subjects == ['c0', 'a0', 'c1', 'c2', 'c3', 'b0', 'a1', 'b1', 'a2', 'a3']
+        assert self.queue.lane_depths() == {'transactional': 0, 'bulk': 0}
+
+
+@mock.patch.object(send_queue, 'get_send_queue')
+def test_enqueue_email(get_send_queue):
+    get_send_queue.return_value.put.return_value = 'job-1'
+    result = send_queue.enqueue_email(valid_message)
+    assert isinstance(result, QueuedResult)
+    assert result.status_code == 202
+    assert result.job_id == 'job-1'
+
+    result = send_queue.enqueue_email(message_with_empty_subject)
+    assert result.message == 'subject cannot be empty'
+    assert get_send_queue.return_value.put.call_count == 1
+
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('mandrill', window=60, min_calls=4, error_rate=0.5, slow_call_duration=5,
+                                      slow_call_rate=0.8, open_duration=30, half_open_calls=2, clock=self.clock)
+
+    def test_trips_on_error_rate(self):
+        for success in (True, False, True):
+            self.breaker.record(success, 0.1)
+        assert self.breaker.state == CLOSED
+        assert self.breaker.health() == 1.0
+        self.breaker.record(False, 0.1)
+        assert self.breaker.state == OPEN
+        assert not self.breaker.allow_request()
+        assert self.breaker.health() == 0.0
+
+    def test_trips_on_slow_calls(self):
+        for i in range(4):
+            self.breaker.record(True, 6)
+        assert self.breaker.state == OPEN
+
+    def test_old_calls_leave_the_window(self):
+        for i in range(3):
+            self.breaker.record(False, 0.1)
+        self.clock.now += 61
+        self.breaker.record(False, 0.1)
+        assert self.breaker.state == CLOSED
+        assert self.breaker.stats()['failures'] == 1
+
+    def test_half_open_probes(self):
+        for i in range(4):
+            self.breaker.record(False, 0.1)
+        self.clock.now += 30
+        assert self.breaker.state == HALF_OPEN
+        assert self.breaker.allow_request()
+        assert self.breaker.allow_request()
+        assert not self.breaker.allow_request()
+        self.breaker.record(True, 0.1)
+        assert self.breaker.state == HALF_OPEN
+        self.breaker.record(True, 0.1)
+        assert self.breaker.state == CLOSED
+
+    def test_failed_probe_opens_again(self):
+        for i in range(4):
+            self.breaker.record(False, 0.1)
+        self.clock.now += 30
+        assert self.breaker.allow_request()
+        self.breaker.record(False, 0.1)
+        assert self.breaker.state == OPEN
+
+
+class ProviderRouterTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+
+    def tearDown(self):
+        simple_email.provider_router.reset()
+
+    def test_prefers_mandrill_while_healthy(self):
+        assert simple_email.provider_router.ranked() == [MandrillEmail, MailgunEmail]
+
+    def test_ranks_by_health(self):
+        router = ProviderRouter([MandrillEmail, MailgunEmail],
+                                breaker_factory=lambda name: CircuitBreaker(name, min_calls=4, error_rate=0.9))
+        for success in (True, False, False, True):
+            router.breakers['mandrill'].record(success, 0.1)
+        assert router.ranked() == [MailgunEmail, MandrillEmail]
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_skips_tripped_provider(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = ErrorResult("mandrill error message")
+        mailgun_send.return_value = simple_email.success_result_obj
+        for i in range(simple_email.config.BREAKER_MIN_CALLS):
+            assert_success_result(simple_email.deliver_email(valid_message))
+        assert simple_email.provider_router.breakers['mandrill'].state == OPEN
+        calls = mandrill_send.call_count
+        assert_success_result(simple_email.deliver_email(valid_message))
+        assert mandrill_send.call_count == calls
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_exception_fails_over(self, mandrill_send, mailgun_send):
+        mandrill_send.side_effect = ValueError("connection reset")
+        mailgun_send.return_value = simple_email.success_result_obj
+        assert_success_result(simple_email.deliver_email(valid_message))
+        assert simple_email.provider_router.breakers['mandrill'].stats()['failures'] == 1
+
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        body = '{"message": "Queued. Thank you."}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class HttpSessionTests(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/v2/example.com/messages' % self.server.server_port
+
+    def tearDown(self):
+        for session in http_session._sessions.values():
+            session.close()
+        http_session._sessions.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        with mock.patch.object(simple_email.config, 'MAILGUN_MESSAGE_BASE_URL', self.url):
+            for i in range(3):
+                assert_success_result(MailgunEmail().send(valid_message))
+        stats = http_session.pool_stats()['mailgun']['http://127.0.0.1:%s' % self.server.server_port]
+        assert stats['requests'] == 3
+        assert stats['connections'] == 1
+        assert stats['idle'] == 1
+
+    def test_default_timeout(self):
+        session = http_session.new_session(connect_timeout=1, read_timeout=2)
+        adapter = session.get_adapter(self.url)
+        assert adapter.timeout == (1, 2)
+        request = requests.Request('POST', self.url, data={}).prepare()
+        with mock.patch('requests.adapters.HTTPAdapter.send') as send:
+            adapter.send(request, timeout=None)
+            assert send.call_args[1]['timeout'] == (1, 2)
+            adapter.send(request, timeout=5)
+            assert send.call_args[1]['timeout'] == 5
+
+    def test_mailgun_timeout(self):
+        session = mock.Mock()
+        session.post.side_effect = requests.Timeout("read timed out")
+        with mock.patch.object(http_session, 'get_session', return_value=session):
+            result = MailgunEmail().send(valid_message)
+        assert result.status == "error"
+        assert result.message == "Mailgun timed out"
+        assert result.status_code == 504
+
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        simple_email.provider_router.reset()
+
+    @mock.patch("simple_email.mandrill_client.messages.send")
+    def test_send_batch_groups_messages(self, send):
+        other_content = dict(valid_message, to_email='uber@gmail.com', content='other content')
+        messages = [valid_message, message_with_empty_subject, dict(valid_message, to_email='someone@gmail.com'), other_content]
+        send.side_effect = [
+            [{'status': 'sent', 'email': 'someone@gmail.com', '_id': '2', 'reject_reason': None},
+             {'status': 'rejected', 'email': 'dawen.uiuc@gmail.com', '_id': '1', 'reject_reason': 'hard-bounce'}],
+            [{'status': 'queued', 'email': 'uber@gmail.com', '_id': '3', 'reject_reason': None}]]
+        with mock.patch.object(MailgunEmail, 'send_batch', return_value=[ErrorResult("mailgun error message")]):
+            results = simple_email.send_batch(messages)
+        assert send.call_count == 2
+        message = send.call_args_list[0][1]['message']
+        assert [recipient['email'] for recipient in message['to']] == ['dawen.uiuc@gmail.com', 'someone@gmail.com']
+        assert message['preserve_recipients'] is False
+        assert results[0].status == 'rejected'
+        assert results[1].message == 'subject cannot be empty'
+        assert_success_result(results[2])
+        assert_success_result(results[3])
+
+    @mock.patch.object(MandrillEmail, 'send_batch')
+    def test_failed_messages_go_to_next_provider(self, mandrill_send_batch):
+        mandrill_send_batch.side_effect = lambda batch: [ErrorResult("mandrill error message")] * len(batch)
+        with mock.patch.object(MailgunEmail, 'post', return_value=simple_email.success_result_obj) as post:
+            results = simple_email.send_batch([valid_message, dict(valid_message, to_email='someone@gmail.com')])
+        assert [result.status for result in results] == ['success', 'success']
+        data = post.call_args[0][0]
+        assert data['to'] == ['dawen.uiuc@gmail.com', 'someone@gmail.com']
+        assert json.loads(data['recipient-variables']) == {'dawen.uiuc@gmail.com': {}, 'someone@gmail.com': {}}
+
+    def test_duplicate_recipients_are_split(self):
+        messages = [valid_message, valid_message, dict(valid_message, to_email='someone@gmail.com')]
+        assert simple_email.batch_chunks([0, 1, 2], messages) == [[0, 2], [1]]
+        with mock.patch.object(simple_email.config, 'BATCH_SIZE', 1):
+            assert simple_email.batch_chunks([0, 1, 2], messages) == [[0], [1], [2]]
+
+    @mock.patch('view.send_batch')
+    def test_batch_endpoint(self, send_batch):
+        send_batch.return_value = [simple_email.success_result_obj, ErrorResult("invalid sender email")]
+        response = self.app.post('/batch', data=json.dumps({'messages': [valid_message, message_with_empty_from_email]}),
+                                 content_type='application/json')
+        assert response.status_code == 200
+        assert json.loads(response.data)['results'] == [
+            {'status': 'success', 'status_code': 200, 'message': 'Email sent successfully!'},
+            {'status': 'error', 'status_code': 400, 'message': 'invalid sender email'}]
+
+        response = self.app.post('/batch', data=json.dumps({'messages': 'x'}), content_type='application/json')
+        assert response.status_code == 400
+
+    @mock.patch('view.send_batch')
+    def test_batch_endpoint_checks_each_message(self, send_batch):
+        send_batch.return_value = [simple_email.success_result_obj]
+        messages = [dict(valid_message, to_email=5), dict(valid_message, subject=None), valid_message,
+                    dict(valid_message, priority=['bulk']), dict(valid_message, template_id=['welcome']), 'x']
+        response = self.app.post('/batch', data=json.dumps({'messages': messages}), content_type='application/json')
+        assert response.status_code == 200
+        assert [result['status_code'] for result in json.loads(response.data)['results']] == [400, 400, 200, 400, 400, 400]
+        assert send_batch.call_args[0][0] == [dict((field, valid_message[field]) for field in simple_email.MESSAGE_FIELDS)]
+
+
+
+def slow_result(result, delay):
+    def send(message_data):
+        time.sleep(delay)
+        return result
+    return send
+
+
+class AsyncEmailTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+
+    def tearDown(self):
+        simple_email.provider_router.reset()
+
+    def test_future_callbacks(self):
+        future = SendFuture()
+        seen = []
+        future.add_done_callback(lambda f: seen.append(f.result()))
+        assert not future.done()
+        assert future.result(timeout=0) is None
+        future.set_result(simple_email.success_result_obj)
+        future.add_done_callback(lambda f: seen.append(f.result()))
+        assert future.done()
+        assert seen == [simple_email.success_result_obj] * 2
+
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_provider_send_async(self, mandrill_send):
+        mandrill_send.return_value = simple_email.success_result_obj
+        assert_success_result(AsyncMandrillEmail().send_async(valid_message).result(timeout=5))
+
+    def test_validation_error(self):
+        assert send_email_async(message_with_empty_subject).result(timeout=0).message == 'subject cannot be empty'
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_failover_without_hedging(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = ErrorResult("mandrill error message")
+        mailgun_send.return_value = simple_email.success_result_obj
+        assert_success_result(send_email_async(valid_message).result(timeout=5))
+        assert mandrill_send.call_count == 1
+        assert mailgun_send.call_count == 1
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_no_hedge_when_primary_is_fast(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = simple_email.success_result_obj
+        assert_success_result(send_email_async(valid_message, hedge_after=0.2).result(timeout=5))
+        time.sleep(0.3)
+        assert mailgun_send.call_count == 0
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_hedges_slow_primary(self, mandrill_send, mailgun_send):
+        slow_success = simple_email.SuccessResult("sent by mandrill")
+        mandrill_send.side_effect = slow_result(slow_success, 0.5)
+        mailgun_send.return_value = simple_email.success_result_obj
+        start = time.time()
+        assert_success_result(send_email_async(valid_message, hedge_after=0.05).result(timeout=5))
+        assert time.time() - start < 0.5
+        assert mailgun_send.call_count == 1
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_waiting_for_a_thread_is_not_hedged(self, mandrill_send, mailgun_send):
+        mandrill_send.side_effect = slow_result(simple_email.success_result_obj, 0.03)
+        with mock.patch('async_email.executor', async_email.SendExecutor(size=2)), \
+                mock.patch.object(async_email, 'check_sender_rate', return_value=None):
+            futures = [send_email_async(valid_message, hedge_after=0.1) for i in range(40)]
+            for future in futures:
+                assert_success_result(future.result(timeout=5))
+        assert mandrill_send.call_count == 40
+        assert mailgun_send.call_count == 0
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_hedged_send_bookkeeping(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = simple_email.rejected_result('dawen.uiuc@gmail.com', 'hard-bounce')
+        with mock.patch.object(config, 'SUPPRESSION_ENABLED', True), \
+                mock.patch.object(simple_email, 'get_suppression_list') as get_suppression_list, \
+                mock.patch.object(async_email, 'check_suppressed', return_value=None):
+            result = send_email_async(valid_message, hedge_after=0.5).result(timeout=5)
+        assert result.reject_reason == 'hard-bounce'
+        get_suppression_list.return_value.add.assert_called_with('dawen.uiuc@gmail.com', 'hard-bounce', 'mandrill')
+        assert mailgun_send.call_count == 0
+
+        mandrill_send.return_value = ErrorResult("mandrill error message")
+        mailgun_send.return_value = simple_email.success_result_obj
+        with mock.patch.object(metrics, 'enabled', True):
+            failovers = metrics.FAILOVERS.value(provider='mandrill')
+            sent = metrics.REQUESTS.value(outcome='sent')
+            assert_success_result(send_email_async(valid_message).result(timeout=5))
+            assert metrics.FAILOVERS.value(provider='mandrill') == failovers + 1
+            assert metrics.REQUESTS.value(outcome='sent') == sent + 1
+        assert scheduler.get_lane_scheduler().stats()['transactional']['active'] == 0
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_both_providers_fail(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = Result('rejected', 'rejected due to spam')
+        mailgun_send.side_effect = slow_result(ErrorResult("mailgun error message"), 0.1)
+        result = send_email_async(valid_message, hedge_after=0.01).result(timeout=5)
+        assert result.status == 'rejected'
+        assert mandrill_send.call_count == 1
+        assert mailgun_send.call_count == 1
+
+
+
+class ValidationTests(unittest.TestCase):
+    def test_same_verdicts_as_validate_email(self):
+        cache = AddressCache(size=100)
+        for address in ['dawen.uiuc@gmail.com', 'xx', '', 'Uber', 'a@b', '"quoted name"@example.com', 'a b@example.com', 'x@-.com']:
+            assert cache.is_valid(address) == validate_email(address)
+
+    def test_lru_cache(self):
+        cache = AddressCache(size=2)
+        cache.is_valid('a@example.com')
+        cache.is_valid('b@example.com')
+        cache.is_valid('a@example.com')
+        cache.is_valid('c@example.com')
+        assert cache.stats() == {'size': 2, 'max_size': 2, 'hits': 1, 'misses': 3}
+        cache.is_valid('b@example.com')
+        assert cache.stats()['misses'] == 4
+        cache.is_valid('c@example.com')
+        assert cache.stats()['hits'] == 2
+
+    def test_check_messages(self):
+        messages = [valid_message, message_with_invalid_to_email, message_with_invalid_from_email, message_with_empty_subject,
+                    message_with_empty_too_long_subject, message_with_empty_content, message_with_empty_too_long_content]
+        assert check_messages(messages) == [None, 'invalid recipient email', 'invalid sender email', 'subject cannot be empty',
+                                            'subject cannot be more than 1000 characters', 'content cannot be empty',
+                                            'content cannot be more than 10000 characters']
+
+    def test_send_request_uses_cache(self):
+        with mock.patch.object(validation, 'address_cache', AddressCache(size=10)):
+            simple_validate_send_request(valid_message)
+            simple_validate_send_request(valid_message)
+            assert validation.address_cache.stats()['hits'] == 2
+
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        metrics.clear()
+        simple_email.provider_router.reset()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        metrics.clear()
+        simple_email.provider_router.reset()
+
+    def test_render(self):
+        counter = metrics.Counter('test_total', 'A test counter', ('provider',))
+        histogram = metrics.Histogram('test_seconds', 'A test histogram', buckets=(0.1, 1))
+        try:
+            counter.inc(provider='mandrill')
+            counter.inc(2, provider='mandrill')
+            histogram.observe(0.1)
+            histogram.observe(0.5)
+            histogram.observe(3)
+            assert counter.render() == ['# HELP test_total A test counter', '# TYPE test_total counter',
+                                        'test_total{provider="mandrill"} 3']
+            assert histogram.render()[2:] == ['test_seconds_bucket{le="0.1"} 1', 'test_seconds_bucket{le="1"} 2',
+                                              'test_seconds_bucket{le="+Inf"} 3', 'test_seconds_sum 3.6', 'test_seconds_count 3']
+        finally:
+            metrics.REGISTRY.remove(counter)
+            metrics.REGISTRY.remove(histogram)
+
+    @mock.patch.object(metrics, 'enabled', False)
+    def test_disabled(self):
+        metrics.REQUESTS.inc(outcome='sent')
+        metrics.STAGE_LATENCY.observe(1, stage='validation')
+        assert metrics.REQUESTS.value(outcome='sent') == 0
+        assert metrics.STAGE_LATENCY.count(stage='validation') == 0
+        assert self.app.get('/metrics').status_code == 404
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_send_email_is_instrumented(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = ErrorResult("mandrill error message")
+        mailgun_send.return_value = simple_email.success_result_obj
+        assert_success_result(simple_email.send_email(valid_message))
+        simple_email.send_email(message_with_empty_subject)
+        assert metrics.PROVIDER_SENDS.value(provider='mandrill', outcome='error') == 1
+        assert metrics.PROVIDER_SENDS.value(provider='mailgun', outcome='sent') == 1
+        assert metrics.PROVIDER_LATENCY.count(provider='mandrill') == 1
+        assert metrics.FAILOVERS.value(provider='mandrill') == 1
+        assert metrics.REQUESTS.value(outcome='sent') == 1
+        assert metrics.INVALID_REQUESTS.value() == 1
+        assert metrics.STAGE_LATENCY.count(stage='validation') == 2
+        assert metrics.STAGE_LATENCY.count(stage='delivery') == 1
+
+        response = self.app.get('/metrics')
+        assert response.status_code == 200
+        assert 'email_failovers_total{provider="mandrill"} 1' in response.data
+
+
+
+class RateLimitTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        simple_email.provider_router.reset()
+
+    def tearDown(self):
+        simple_email.provider_router.reset()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket('test', rate=2, capacity=3, store=LocalStore(), clock=self.clock)
+        assert [bucket.take() for i in range(4)] == [0, 0, 0, 0.5]
+        self.clock.now += 0.5
+        assert bucket.take() == 0
+        assert bucket.take(2) == 1.0
+        self.clock.now += 10
+        assert bucket.take(3) == 0
+
+    def test_wait_within_deadline(self):
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            self.clock.now += seconds
+
+        limiter = RateLimiter(LocalStore(), provider_limits={'mandrill': (1, 1)}, sender_limit=(1, 1), wait=1.5,
+                              clock=self.clock, sleep=sleep)
+        assert limiter.acquire_provider('mandrill') == 0
+        assert limiter.acquire_provider('mandrill') == 0
+        assert sleeps == [1.0]
+        assert limiter.acquire_provider('mailgun') == 0
+        limiter.wait = 0
+        assert limiter.acquire_sender('uber@gmail.com') == 0
+        assert limiter.acquire_sender('Uber@gmail.com') == 1.0
+
+    def test_shared_store(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'buckets')
+            first, second = SharedSlots(path, slots=8), SharedSlots(path, slots=8)
+            TokenBucket('sender:uber@gmail.com', 1, 2, first, clock=self.clock).take(2)
+            assert TokenBucket('sender:uber@gmail.com', 1, 2, second, clock=self.clock).take() == 1.0
+            assert second.get('sender:uber@gmail.com') == [self.clock.now + 2, self.clock.now]
+            assert second.get('sender:other@gmail.com') is None
+            first.close()
+            second.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_full_shared_store(self):
+        store = SharedSlots(None, slots=8)
+        limiter = RateLimiter(store, provider_limits={}, sender_limit=(1, 2), wait=0, clock=self.clock)
+        for i in range(8):
+            assert limiter.acquire_sender('sender%s@gmail.com' % i, 2) == 0
+        # no room in the table, the new sender is limited in the process
+        assert limiter.acquire_sender('new@gmail.com', 2) == 0
+        assert limiter.acquire_sender('new@gmail.com') == 1.0
+        assert store.get('sender:new@gmail.com') is None
+        # the buckets full again give their slots to the new keys
+        self.clock.now += 2
+        assert limiter.acquire_sender('other@gmail.com', 2) == 0
+        assert limiter.acquire_sender('other@gmail.com') == 1.0
+        assert store.get('sender:other@gmail.com') == [self.clock.now + 2, self.clock.now]
+
+    def test_sender_limit(self):
+        limiter = RateLimiter(LocalStore(), provider_limits={}, sender_limit=(1, 1), wait=0)
+        with mock.patch.object(simple_email, 'rate_limiter', limiter), \
+                mock.patch.object(simple_email, 'deliver_email', return_value=simple_email.success_result_obj):
+            assert_success_result(simple_email.send_email(valid_message))
+            result = simple_email.send_email(valid_message)
+        assert result.status == 'error'
+        assert result.status_code == 429
+        assert result.retry_after > 0
+        assert result.to_dict()['retry_after'] == result.retry_after
+
+    @mock.patch.object(MandrillEmail, 'send_batch')
+    def test_batch_larger_than_sender_burst(self, mandrill_send_batch):
+        mandrill_send_batch.side_effect = lambda batch: [simple_email.success_result_obj] * len(batch)
+        limiter = RateLimiter(LocalStore(), provider_limits={}, sender_limit=(5, 20), wait=0)
+        messages = [dict(valid_message, to_email='user%s@gmail.com' % i) for i in range(100)]
+        with mock.patch.object(simple_email, 'rate_limiter', limiter):
+            results = simple_email.send_batch(messages)
+            assert [result.status for result in results] == ['success'] * 100
+            # the burst is used up, the next batch waits
+            assert simple_email.send_batch(messages[:2])[0].status_code == 429
+
+    def test_large_batch_is_charged_in_full(self):
+        limiter = RateLimiter(LocalStore(), provider_limits={'mandrill': (10, 100)}, sender_limit=(5, 20), wait=0, clock=self.clock)
+        assert limiter.acquire_sender('uber@gmail.com', 1000) == 0
+        assert limiter.acquire_provider('mandrill', 1000) == 0
+        # the 980 emails over the burst are paid back first, 196s at 5 per second, then 1 more
+        assert limiter.acquire_sender('uber@gmail.com') == 196.2
+        assert limiter.acquire_provider('mandrill') == 90.1
+        self.clock.now += 100
+        assert limiter.acquire_provider('mandrill') == 0
+        # a batch waits for a full bucket
+        assert limiter.acquire_sender('uber@gmail.com', 1000) == 100.0
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_provider_limit(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = simple_email.success_result_obj
+        mailgun_send.return_value = simple_email.success_result_obj
+        limiter = RateLimiter(LocalStore(), provider_limits={'mandrill': (1, 1), 'mailgun': (1, 1)}, sender_limit=(100, 100), wait=0)
+        with mock.patch.object(simple_email.provider_router, 'rate_limiter', limiter):
+            results = [simple_email.deliver_email(valid_message) for i in range(3)]
+        assert mandrill_send.call_count == 1
+        assert mailgun_send.call_count == 1
+        assert_success_result(results[1])
+        assert results[2].status_code == 429
+
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_open_breaker_takes_no_token(self, mandrill_send):
+        mandrill_send.return_value = simple_email.success_result_obj
+        # one token, and a tenth of one by the time the breaker is half-open
+        limiter = RateLimiter(LocalStore(), provider_limits={'mandrill': (0.01, 1)}, wait=0, clock=self.clock)
+        breaker = CircuitBreaker('mandrill', open_duration=10, half_open_calls=1, clock=self.clock)
+        router = ProviderRouter([MandrillEmail], breaker_factory=lambda name: breaker, rate_limiter=limiter)
+        breaker._trip(self.clock())
+        assert router.send(MandrillEmail, valid_message) is None
+        self.clock.now += 10
+        assert_success_result(router.send(MandrillEmail, valid_message))
+        # the half-open breaker's probe is given back when the provider is over its rate limit
+        breaker._trip(self.clock())
+        self.clock.now += 10
+        self.assertRaises(RateLimited, router.send, MandrillEmail, valid_message)
+        assert breaker.allow_request()
+        assert mandrill_send.call_count == 1
+
+
+
+class LedgerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.ledger = Ledger(os.path.join(self.tmp_dir, 'ledger.db'), ttl=60, clock=self.clock)
+        self.get_ledger = mock.patch.object(simple_email, 'get_ledger', return_value=self.ledger)
+        self.get_ledger.start()
+
+    def tearDown(self):
+        self.get_ledger.stop()
+        self.ledger.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reserve_and_complete(self):
+        digest = message_hash(valid_message)
+        assert self.ledger.reserve('key', digest) is None
+        assert self.ledger.reserve('key', digest)['status'] == PENDING
+        result = MandrillEmail().success_result('abc123')
+        self.ledger.complete('key', result)
+        record = self.ledger.lookup('key')
+        assert record['provider'] == 'mandrill'
+        assert record['provider_message_id'] == 'abc123'
+        assert record['status'] == 'success'
+        assert record['message_hash'] == digest
+
+    def test_release(self):
+        self.ledger.reserve('key', message_hash(valid_message))
+        self.ledger.release('key')
+        assert self.ledger.lookup('key') is None
+
+    def test_stale_reservation_is_reclaimed(self):
+        digest = message_hash(valid_message)
+        self.ledger.pending_timeout = 10
+        assert self.ledger.reserve('key', digest) is None
+        self.clock.now += 9
+        assert self.ledger.reserve('key', digest)['status'] == PENDING
+        self.clock.now += 2
+        assert self.ledger.reserve('key', digest) is None
+        assert self.ledger.reserve('key', digest)['created_at'] == self.clock.now
+        self.ledger.complete('key', simple_email.success_result_obj)
+        self.clock.now += 11
+        assert self.ledger.reserve('key', digest)['status'] == 'success'
+
+    def test_expired_keys_are_compacted(self):
+        digest = message_hash(valid_message)
+        self.ledger.reserve('key', digest)
+        self.ledger.complete('key', simple_email.success_result_obj)
+        self.clock.now += 61
+        assert self.ledger.lookup('key') is None
+        assert self.ledger.reserve('key', digest) is None
+        self.ledger.reserve('other', digest)
+        self.clock.now += 61
+        self.ledger.compact()
+        assert self.ledger._conn.execute("SELECT COUNT(*) FROM sends").fetchone()[0] == 0
+
+    @mock.patch("simple_email.mandrill_client.messages.send")
+    def test_repeated_key_is_not_sent_again(self, mandrill_send):
+        mandrill_send.side_effect = success_response_side_effect()
+        first = simple_email.send_email(valid_message, 'key')
+        second = simple_email.send_email(valid_message, 'key')
+        assert mandrill_send.call_count == 1
+        assert_success_result(second)
+        assert second.provider == first.provider == 'mandrill'
+        assert second.message_id == first.message_id == '857366672c72487eb94fb5ce3f3675d3'
+
+    def test_key_reuse(self):
+        self.ledger.reserve('key', message_hash(valid_message))
+        assert simple_email.send_email(valid_message, 'key').status_code == 409
+        other_message = dict(valid_message, subject='another subject')
+        assert simple_email.send_email(other_message, 'key').status_code == 422
+
+    def test_error_releases_key(self):
+        with mock.patch.object(simple_email, 'deliver_email', return_value=ErrorResult("failed", 503)):
+            simple_email.send_email(valid_message, 'key')
+        assert self.ledger.lookup('key') is None
+
+    def test_queued_email_is_sent_once_per_key(self):
+        queue = SendQueue(os.path.join(self.tmp_dir, 'queue.db'))
+        send = mock.Mock(return_value=MandrillEmail().success_result('abc123'))
+        with mock.patch.object(send_queue, 'get_ledger', return_value=self.ledger), \
+                mock.patch.object(send_queue, 'get_send_queue', return_value=queue):
+            job_ids = [send_queue.enqueue_email(valid_message, 'key').job_id for i in range(2)]
+            pool = WorkerPool(queue, size=1, send=send, poll_interval=0.05)
+            pool.start()
+            for i in range(100):
+                if all(queue.status(job_id)['state'] == send_queue.DONE for job_id in job_ids):
+                    break
+                time.sleep(0.02)
+            pool.stop()
+            assert send.call_count == 1
+            assert send.call_args[0][0] == valid_message
+            assert [queue.status(job_id)['status'] for job_id in job_ids] == ['success', 'success']
+            result = send_queue.enqueue_email(valid_message, 'key')
+            assert result.message_id == 'abc123'
+            assert send_queue.enqueue_email(dict(valid_message, subject='another subject'), 'key').status_code == 422
+        queue.close()
+
+    @mock.patch('view.enqueue_email', return_value=QueuedResult('job-1'))
+    def test_async_send_keeps_key(self, enqueue_email):
+        with mock.patch.object(config, 'SEND_ASYNC', True):
+            app.test_client().post('/', data=valid_message, headers={'Idempotency-Key': 'key'})
+        assert enqueue_email.call_args[0][1] == 'key'
+
+    def test_lookup_end_point(self):
+        self.ledger.reserve('key', message_hash(valid_message))
+        self.ledger.complete('key', MailgunEmail().success_result('<id@mailgun>'))
+        client = app.test_client()
+        with mock.patch('view.get_ledger', return_value=self.ledger):
+            assert json.loads(client.get('/sends/key').data)['provider_message_id'] == '<id@mailgun>'
+            assert client.get('/sends/unknown').status_code == 404
+
+
+class RetryTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+
+    def tearDown(self):
+        simple_email.provider_router.reset()
+
+    def test_classification(self):
+        assert not is_retryable(simple_email.success_result_obj)
+        assert not is_retryable(ErrorResult("subject cannot be empty"))
+        assert is_retryable(ErrorResult("Mailgun timed out", 504))
+        assert is_retryable(simple_email.RateLimitedResult(1))
+        rejected = MandrillEmail().to_result({'status': 'rejected', 'email': 'dawen.uiuc@gmail.com', 'reject_reason': 'hard-bounce'})
+        assert not is_retryable(rejected)
+        rejected.reject_reason = 'soft-bounce'
+        assert is_retryable(rejected)
+
+    @mock.patch("simple_email.mandrill_client.messages.send")
+    def test_mandrill_errors(self, mandrill_send):
+        mandrill_send.side_effect = mandrill.ServiceUnavailableError("down for maintenance")
+        assert is_retryable(MandrillEmail().send(valid_message))
+        mandrill_send.side_effect = invalid_from_email_side_effect()
+        assert not is_retryable(MandrillEmail().send(valid_message))
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_failed_delivery_is_retryable(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = ErrorResult("Mandrill timed out", 504)
+        mailgun_send.return_value = ErrorResult("mailgun error message")
+        assert is_retryable(simple_email.deliver_email(valid_message))
+        mandrill_send.return_value = ErrorResult("mandrill error message")
+        assert not is_retryable(simple_email.deliver_email(valid_message))
+
+    def test_backoff(self):
+        assert backoff_delay(1, base=2, cap=30, random=lambda: 1.0) == 2
+        assert backoff_delay(3, base=2, cap=30, random=lambda: 1.0) == 8
+        assert backoff_delay(10, base=2, cap=30, random=lambda: 1.0) == 30
+        assert backoff_delay(10, base=2, cap=30, random=lambda: 0.5) == 15
+
+    def test_worker_pool_retries(self):
+        tmp_dir = tempfile.mkdtemp()
+        queue = SendQueue(os.path.join(tmp_dir, 'queue.db'))
+        send = mock.Mock(side_effect=[ErrorResult("Mandrill timed out", 504), simple_email.success_result_obj])
+        pool = WorkerPool(queue, size=1, send=send, poll_interval=0.05, retries=True)
+        try:
+            with mock.patch.object(config, 'RETRY_BASE_DELAY', 0.01):
+                job_id = queue.put(valid_message)
+                pool.start()
+                for i in range(100):
+                    if queue.status(job_id)['state'] == send_queue.DONE:
+                        break
+                    time.sleep(0.02)
+        finally:
+            pool.stop()
+            queue.close()
+            shutil.rmtree(tmp_dir)
+        assert send.call_count == 2
+
+    def test_send_with_retries(self):
+        pool = mock.Mock()
+        pool.queue.put.return_value = 'job-1'
+        with mock.patch.object(send_queue, 'get_worker_pool', return_value=pool), \
+                mock.patch.object(send_queue, 'deliver_email', return_value=ErrorResult("Mailgun timed out", 504)):
+            result = send_queue.send_with_retries(valid_message)
+            assert isinstance(result, QueuedResult)
+            assert pool.queue.put.call_args[1]['state'] == send_queue.SENDING
+            pool.retry_later.return_value = False
+            assert send_queue.send_with_retries(valid_message).status_code == 504
+
+
+class FakeProvidersTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+        self.mandrill_server = FakeProviderServer(MANDRILL).start()
+        self.mailgun_server = FakeProviderServer(MAILGUN).start()
+
+    def tearDown(self):
+        self.mandrill_server.stop()
+        self.mailgun_server.stop()
+        simple_email.provider_router.reset()
+
+    def test_send_through_fakes(self):
+        with use_fake_providers(self.mandrill_server, self.mailgun_server):
+            result = simple_email.send_email(valid_message)
+            assert_success_result(result)
+            assert result.provider == 'mandrill'
+            assert len(result.message_id) == 32
+            assert_success_result(MailgunEmail().send(valid_message))
+        assert self.mandrill_server.calls == self.mailgun_server.calls == 1
+
+    def test_failover_to_mailgun(self):
+        self.mandrill_server.error_rate = 1.0
+        with use_fake_providers(self.mandrill_server, self.mailgun_server):
+            result = simple_email.send_email(valid_message)
+        assert result.provider == 'mailgun'
+        assert result.message_id.endswith('@example.com>')
+        assert self.mandrill_server.errors == 1
+
+    def test_outage(self):
+        self.mailgun_server.outages = [(0, 60)]
+        with use_fake_providers(self.mandrill_server, self.mailgun_server):
+            result = MailgunEmail().send(valid_message)
+        assert result.status_code == 503
+        assert is_retryable(result)
+
+    def test_zero_latency_round_trip(self):
+        # on a keep-alive connection, so the calls after the first would wait on delayed ACKs if the answer was split
+        session = requests.Session()
+        session.post(self.mailgun_server.url, data={'to': 'dawen.uiuc@gmail.com'})
+        durations = []
+        for i in range(5):
+            start = time.time()
+            assert session.post(self.mailgun_server.url, data={'to': 'dawen.uiuc@gmail.com'}).status_code == 200
+            durations.append(time.time() - start)
+        session.close()
+        assert sorted(durations)[2] < 0.02
+
+    def test_bench_report(self):
+        report = bench.run('send_email', requests=20, concurrency=4,
+                           mandrill_server=self.mandrill_server, mailgun_server=self.mailgun_server)
+        assert report['outcomes'] == {'success': 20}
+        assert report['latency_p50'] <= report['latency_p99'] <= report['latency_max']
+        assert report['failover_rate'] == 0.0
+        assert report['provider_calls'] == {'mandrill': 20, 'mailgun': 0}
+        assert json.loads(json.dumps(report)) == report
+
+    @mock.patch.object(metrics, 'enabled', False)
+    def test_bench_failover_rate(self):
+        self.mandrill_server.error_rate = 1.0
+        report = bench.run('send_email', requests=4, concurrency=1,
+                           mandrill_server=self.mandrill_server, mailgun_server=self.mailgun_server)
+        assert report['outcomes'] == {'success': 4}
+        # the breaker has not tripped after 4 calls, each email failed over
+        assert report['failover_rate'] == 1.0
+        assert not metrics.enabled
+
+    def test_stop_closes_the_connections(self):
+        session = requests.Session()
+        assert session.post(self.mailgun_server.url, data={'to': 'dawen.uiuc@gmail.com'}).status_code == 200
+        handlers = [thread for thread, connection in self.mailgun_server._handlers]
+        self.mailgun_server.stop()
+        assert handlers and not [thread for thread in handlers if thread.is_alive()]
+        session.close()
+
+
+class ProviderRegistryTests(unittest.TestCase):
+    def test_clients_are_created_on_first_use(self):
+        factory = mock.Mock(side_effect=lambda: mock.Mock())
+        registry = ProviderRegistry()
+        registry.register('mandrill', factory)
+        client = LazyClient('mandrill', registry)
+        assert factory.call_count == 0
+        client.messages.send(message={})
+        client.messages.send(message={})
+        assert factory.call_count == 1
+        with mock.patch.object(http_session, 'reset') as reset_sessions:
+            registry.reset()
+        assert reset_sessions.call_count == 1
+        client.messages
+        assert factory.call_count == 2
+
+    def test_settings_from_environment(self):
+        with mock.patch.object(providers, '_settings_loaded', False), \
+                mock.patch.dict(os.environ, {'MAILGUN_API_KEY': 'key-from-env'}), \
+                mock.patch.object(config, 'MAILGUN_API_KEY', 'key-from-config'):
+            providers.load_settings()
+            assert config.MAILGUN_API_KEY == 'key-from-env'
+            os.environ['MAILGUN_API_KEY'] = 'changed'
+            providers.load_settings()
+            assert config.MAILGUN_API_KEY == 'key-from-env'
+
+    def test_mailgun_uses_settings_from_environment(self):
+        with mock.patch.object(providers, '_settings_loaded', False), \
+                mock.patch.dict(os.environ, {'MAILGUN_API_KEY': 'key-from-env', 'MAILGUN_MESSAGE_BASE_URL': 'http://env/messages'}), \
+                mock.patch.object(config, 'MAILGUN_API_KEY', 'key-from-config'), \
+                mock.patch.object(config, 'MAILGUN_MESSAGE_BASE_URL', 'http://config/messages'), \
+                mock.patch.object(http_session.get_session('mailgun'), 'post', side_effect=requests.ConnectionError) as post:
+            MailgunEmail().post({'to': 'dawen.uiuc@gmail.com'})
+        assert post.call_args[0][0] == 'http://env/messages'
+        assert post.call_args[1]['auth'] == ('api', 'key-from-env')
+
+    def test_configure_logging_once(self):
+        tmp_dir = tempfile.mkdtemp()
+        handlers = list(simple_email.logger.handlers)
+        try:
+            with mock.patch.object(simple_email, '_logging_configured', False):
+                simple_email.configure_logging(debug=False, log_file=os.path.join(tmp_dir, 'error.log'))
+                simple_email.configure_logging(debug=True, log_file=os.path.join(tmp_dir, 'other.log'))
+                added = [handler for handler in simple_email.logger.handlers if handler not in handlers]
+                assert len(added) == 1
+                assert added[0].level == logging.ERROR
+                assert simple_email.logger.level == logging.INFO
+        finally:
+            for handler in simple_email.logger.handlers[:]:
+                if handler not in handlers:
+                    simple_email.logger.removeHandler(handler)
+                    handler.close()
+            shutil.rmtree(tmp_dir)
+
+
+class SuppressionTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.suppressions = SuppressionList(os.path.join(self.tmp_dir, 'suppression.db'), capacity=1000, clock=self.clock)
+        self.patches = [mock.patch.object(config, 'SUPPRESSION_ENABLED', True),
+                        mock.patch.object(simple_email, 'get_suppression_list', return_value=self.suppressions)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.suppressions.close()
+        shutil.rmtree(self.tmp_dir)
+        simple_email.provider_router.reset()
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('user%s@gmail.com' % i)
+        assert all('user%s@gmail.com' % i in bloom for i in range(1000))
+        false_positives = sum(1 for i in range(10000) if 'other%s@gmail.com' % i in bloom)
+        assert false_positives < 300
+
+    def test_check(self):
+        assert self.suppressions.check('dawen.uiuc@gmail.com') is None
+        self.suppressions.add('Dawen.Uiuc@gmail.com', 'hard-bounce', 'mandrill')
+        record = self.suppressions.check('dawen.uiuc@GMAIL.com')
+        assert record['reason'] == 'hard-bounce'
+        assert record['expires_at'] is None
+        self.suppressions.remove('dawen.uiuc@gmail.com')
+        assert self.suppressions.check('dawen.uiuc@gmail.com') is None
+
+    def test_soft_bounces_expire(self):
+        self.suppressions.add('dawen.uiuc@gmail.com', 'soft-bounce')
+        assert self.suppressions.check('dawen.uiuc@gmail.com') is not None
+        self.clock.now += config.SUPPRESSION_SOFT_BOUNCE_TTL
+        assert self.suppressions.check('dawen.uiuc@gmail.com') is None
+        self.suppressions.purge_expired()
+        assert 'dawen.uiuc@gmail.com' not in self.suppressions._bloom
+
+    def test_import_export(self):
+        imported = StringIO("email,reason\nuber@gmail.com,unsub\ndawen.uiuc@gmail.com,spam\n")
+        assert self.suppressions.import_csv(imported) == 2
+        exported = StringIO()
+        assert self.suppressions.export_csv(exported) == 2
+        other = SuppressionList(os.path.join(self.tmp_dir, 'other.db'), capacity=1000, clock=self.clock)
+        assert other.import_csv(StringIO(exported.getvalue())) == 2
+        assert other.check('uber@gmail.com')['reason'] == 'unsub'
+        other.close()
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch("simple_email.mandrill_client.messages.send")
+    def test_rejected_recipient_is_suppressed(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = [{'status': 'rejected', 'email': 'dawen.uiuc@gmail.com', '_id': '1', 'reject_reason': 'hard-bounce'}]
+        result = simple_email.send_email(valid_message)
+        assert result.status == 'rejected'
+        assert mailgun_send.call_count == 0
+        assert self.suppressions.check('dawen.uiuc@gmail.com')['provider'] == 'mandrill'
+        result = simple_email.send_email(valid_message)
+        assert result.status == 'rejected'
+        assert result.reject_reason == 'hard-bounce'
+        assert mandrill_send.call_count == 1
+
+    @mock.patch("simple_email.mandrill_client.messages.send")
+    def test_soft_bounce_is_not_suppressed(self, mandrill_send):
+        mandrill_send.return_value = [{'status': 'rejected', 'email': 'dawen.uiuc@gmail.com', '_id': '1', 'reject_reason': 'soft-bounce'}]
+        result = async_email.AsyncMandrillEmail().send_async(valid_message).result(5)
+        assert is_retryable(result)
+        assert self.suppressions.check('dawen.uiuc@gmail.com') is None
+
+    @mock.patch("simple_email.mandrill_client.messages.send")
+    def test_async_rejected_recipient_is_suppressed(self, mandrill_send):
+        mandrill_send.return_value = [{'status': 'rejected', 'email': 'dawen.uiuc@gmail.com', '_id': '1', 'reject_reason': 'spam'}]
+        async_email.AsyncMandrillEmail().send_async(valid_message).result(5)
+        assert self.suppressions.check('dawen.uiuc@gmail.com')['reason'] == 'spam'
+
+    def test_mailgun_invalid_recipient(self):
+        with mock.patch.object(MailgunEmail, 'post', return_value=ErrorResult("'to' parameter is not a valid address. please check documentation")):
+            result = MailgunEmail().send(valid_message)
+        assert result.reject_reason == 'invalid'
+
+
+class SmtpTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+        self.server = FakeSmtpServer(refused=['bounce@example.com'], deferred=['greylisted@example.com']).start()
+        self.clock = FakeClock()
+        self.pool = SmtpConnectionPool('127.0.0.1', self.server.port, username='', starttls=False, size=2, timeout=1,
+                                       check_after=30, clock=self.clock)
+        self.patch = mock.patch.dict(providers.registry._clients, {'smtp': self.pool})
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.pool.close()
+        self.server.stop()
+        simple_email.provider_router.reset()
+
+    def test_send_reuses_the_connection(self):
+        result = SmtpEmail().send(valid_message)
+        assert_success_result(result)
+        assert result.provider == 'smtp'
+        assert_success_result(SmtpEmail().send(valid_message))
+        assert self.pool.stats()['opened'] == 1
+        assert self.pool.stats()['reused'] == 1
+        assert self.server.connections == 1
+        mailfrom, rcpttos, data = self.server.messages[0]
+        assert rcpttos == ['dawen.uiuc@gmail.com']
+        assert 'Message-ID: %s' % result.message_id in data
+
+    def test_batch_and_refused_recipient(self):
+        bounce = dict(valid_message, to_email='bounce@example.com')
+        results = SmtpEmail().send_batch([valid_message, bounce, valid_message])
+        assert [result.status for result in results] == ['success', 'rejected', 'success']
+        assert results[1].reject_reason == 'hard-bounce'
+        assert len(self.server.messages) == 2
+        assert self.pool.stats()['opened'] == 1
+
+    def test_deferred_recipient_is_retryable(self):
+        result = SmtpEmail().send(dict(valid_message, to_email='greylisted@example.com'))
+        assert result.status == 'error'
+        assert result.status_code == 503
+        assert is_retryable(result)
+        assert not self.server.messages
+
+    def test_stale_connection_is_replaced(self):
+        assert_success_result(SmtpEmail().send(valid_message))
+        self.pool._idle[0].smtp.sock.close()
+        # noticed by the NOOP check after a long idle time
+        self.clock.now += 60
+        assert_success_result(SmtpEmail().send(valid_message))
+        assert self.pool.stats()['opened'] == 2
+        # or when sending, the message is then sent again on a new connection
+        self.pool._idle[0].smtp.sock.close()
+        assert_success_result(SmtpEmail().send(valid_message))
+        assert self.pool.stats()['opened'] == 3
+        assert len(self.server.messages) == 3
+
+    def test_pool_timeout(self):
+        self.pool.timeout = 0.1
+        first, second = self.pool.acquire(), self.pool.acquire()
+        self.assertRaises(PoolTimeout, self.pool.acquire)
+        self.pool.release(first)
+        assert self.pool.acquire() is first
+        self.pool.release(first)
+        self.pool.release(second, broken=True)
+        assert self.pool.stats() == {'open': 1, 'idle': 1, 'opened': 2, 'reused': 1, 'dropped': 1}
+
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_failover_to_smtp(self, mandrill_send):
+        mandrill_send.return_value = ErrorResult("mandrill error message", 503)
+        router = ProviderRouter([MandrillEmail, SmtpEmail])
+        with mock.patch.object(simple_email, 'provider_router', router):
+            result = simple_email.deliver_email(valid_message)
+        assert_success_result(result)
+        assert result.provider == 'smtp'
+
+
+class AttachmentTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = EncodedCache(os.path.join(self.tmp_dir, 'cache'), max_bytes=10 ** 6)
+        self.patches = [mock.patch.object(config, 'ATTACHMENT_DIR', os.path.join(self.tmp_dir, 'spool')),
+                        mock.patch.object(attachments, '_encoded_cache', self.cache)]
+        for patch in self.patches:
+            patch.start()
+        self.data = os.urandom(200000)
+        self.attachment = spool(StringIO(self.data), 'report.pdf', 'application/pdf')
+        self.message = dict(valid_message, html='<p>content to send</p>', attachments=[self.attachment])
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmp_dir)
+        simple_email.provider_router.reset()
+
+    def test_streaming_body(self):
+        assert self.attachment['size'] == len(self.data)
+        encoded = base64.b64encode(self.data)
+        lines = FilePart(self.cache.path(self.attachment), 76)
+        body = StreamingBody(['head', lines, u'tail'])
+        assert len(body) == len('head') + len(lines) + len('tail')
+        content = ''.join(iter(lambda: body.read(8192), ''))
+        assert content == 'head' + '\r\n'.join(encoded[i:i + 76] for i in range(0, len(encoded), 76)) + 'tail'
+        assert len(content) == len(body)
+
+    def test_encoded_cache(self):
+        path = self.cache.path(self.attachment)
+        assert open(path).read() == base64.b64encode(self.data)
+        assert self.cache.path(self.attachment) == path
+        assert self.cache.stats() == {'hits': 1, 'misses': 1}
+        other = spool(StringIO(os.urandom(800000)), 'other.bin')
+        self.cache.path(other)
+        # over max_bytes, the least recently used encoding is gone
+        assert not os.path.exists(path)
+
+    def test_mandrill_and_mailgun(self):
+        mandrill_server = FakeProviderServer(MANDRILL).start()
+        mailgun_server = FakeProviderServer(MAILGUN).start()
+        try:
+            with use_fake_providers(mandrill_server, mailgun_server):
+                assert_success_result(MandrillEmail().send(self.message))
+                assert_success_result(MailgunEmail().send(self.message))
+        finally:
+            mandrill_server.stop()
+            mailgun_server.stop()
+        sent = mandrill_server.last_message
+        assert sent['html'] == self.message['html']
+        assert sent['attachments'] == [{'type': 'application/pdf', 'name': 'report.pdf', 'content': base64.b64encode(self.data)}]
+        sent = mailgun_server.last_message
+        assert sent['html'] == [self.message['html']]
+        assert sent['attachment'] == [('report.pdf', self.data)]
+
+    def test_smtp(self):
+        server = FakeSmtpServer().start()
+        pool = SmtpConnectionPool('127.0.0.1', server.port, username='', starttls=False, timeout=1)
+        try:
+            with mock.patch.dict(providers.registry._clients, {'smtp': pool}):
+                assert_success_result(SmtpEmail().send(self.message))
+        finally:
+            pool.close()
+            server.stop()
+        message = email.message_from_string(server.messages[0][2])
+        text, attachment = message.get_payload()
+        assert [part.get_content_type() for part in text.get_payload()] == ['text/plain', 'text/html']
+        assert attachment.get_filename() == 'report.pdf'
+        assert attachment.get_payload(decode=True) == self.data
+
+    @mock.patch.object(MailgunEmail, 'send')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_json_attachments(self, mandrill_send, mailgun_send):
+        mandrill_send.return_value = simple_email.success_result_obj
+        body = dict(valid_message, attachments=[{'name': 'report.pdf', 'type': 'application/pdf', 'content': base64.b64encode(self.data)}])
+        response = app.test_client().post('/v1/messages', data=json.dumps(body), content_type='application/json')
+        assert response.status_code == 200
+        sent = mandrill_send.call_args[0][0]['attachments'][0]
+        assert sent['sha1'] == self.attachment['sha1']
+        # removed once sent
+        assert not os.path.exists(sent['path'])
+        body['attachments'][0]['content'] = 'not base64!'
+        response = app.test_client().post('/v1/messages', data=json.dumps(body), content_type='application/json')
+        assert response.status_code == 400
+
+    def test_headers_cannot_be_injected(self):
+        spooled = spool(StringIO('data'), u'r\xe9port"\r\nX-Injected: 1.pdf', 'text/plain\r\nX-Injected: 1')
+        assert spooled['name'] == u'r\xe9port"X-Injected: 1.pdf'
+        assert spooled['type'] == 'application/octet-stream'
+        # an attachment spooled before the names were cleaned
+        unclean = dict(spooled, name='report.pdf\r\n\r\n--boundary', type='text/plain\r\nX-Injected: 1')
+        body, content_type = multipart_body({}, [spooled, unclean])
+        lines = ''.join(iter(lambda: body.read(8192), '')).split('\r\n')
+        assert lines[1] == 'Content-Disposition: form-data; name="attachment"; ' \
+                           'filename="r?port_X-Injected: 1.pdf"; filename*=utf-8\'\'r%C3%A9port%22X-Injected%3A%201.pdf'
+        assert lines[2] == 'Content-Type: application/octet-stream'
+        assert lines[6] == 'Content-Disposition: form-data; name="attachment"; ' \
+                           'filename="report.pdf--boundary"; filename*=utf-8\'\'report.pdf--boundary'
+        assert lines[7] == 'Content-Type: application/octet-stream'
+        assert not [line for line in lines if line.startswith('X-Injected') or line == '--boundary']
+
+    def test_validation(self):
+        assert simple_validate_send_request(self.message) is None
+        with mock.patch.object(config, 'ATTACHMENT_MAX_SIZE', 1000):
+            assert_error_result(simple_validate_send_request(self.message), "attachments cannot be more than 1000 bytes in total")
+
+
+def in_child(function):
+    # run function in a forked process and wait for it, returns its exit status
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            function()
+            code = 0
+        finally:
+            os._exit(code)
+    return os.waitpid(pid, 0)[1]
+
+
+class PreforkTests(unittest.TestCase):
+    def test_shared_breaker(self):
+        clock = FakeClock()
+        breaker = SharedCircuitBreaker('mandrill', SharedSlots(None, slots=16, width=SHARED_WIDTH), min_calls=4, error_rate=0.5,
+                                       open_duration=30, half_open_calls=2, clock=clock)
+        assert in_child(lambda: [breaker.record(False, 0.1) for i in range(4)]) == 0
+        # tripped by the calls of the other process
+        assert breaker.state == OPEN
+        assert breaker.health() == 0.0
+        clock.now += 30
+        assert breaker.state == HALF_OPEN
+        assert breaker.allow_request() and breaker.allow_request()
+        assert not breaker.allow_request()
+        breaker.record(True, 0.1)
+        breaker.record(True, 0.1)
+        assert breaker.stats() == {'state': CLOSED, 'calls': 0, 'failures': 0, 'slow_calls': 0}
+        # the window expires a bucket at a time
+        breaker.record(False, 0.1)
+        clock.now += config.BREAKER_WINDOW
+        assert breaker.stats()['calls'] == 0
+
+    def test_shared_metrics(self):
+        with mock.patch.object(metrics, '_shared', None), mock.patch.object(metrics, 'enabled', True):
+            metrics.share()
+            metrics.FAILOVERS.inc(provider='mandrill')
+            assert in_child(lambda: (metrics.FAILOVERS.inc(provider='mandrill'),
+                                     metrics.PROVIDER_LATENCY.observe(0.2, provider='mailgun'))) == 0
+            assert metrics.FAILOVERS.value(provider='mandrill') == 2
+            assert metrics.PROVIDER_LATENCY.count(provider='mailgun') == 1
+            text = metrics.render()
+            assert 'email_failovers_total{provider="mandrill"} 2\n' in text
+            assert 'email_provider_latency_seconds_bucket{provider="mailgun",le="0.25"} 1\n' in text
+
+    def test_shared_suppression_filter(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'suppression.db')
+        try:
+            with mock.patch.object(suppression, '_shared_bloom', None):
+                suppression.share_bloom(1000)
+                suppressions = SuppressionList(path, capacity=1000)
+                assert suppressions.check('dawen.uiuc@gmail.com') is None
+                assert in_child(lambda: SuppressionList(path, capacity=1000).add('dawen.uiuc@gmail.com', 'spam')) == 0
+                assert suppressions.check('dawen.uiuc@gmail.com')['reason'] == 'spam'
+                suppressions.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_shared_queue_jobs_are_claimed_once(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'queue.db')
+        try:
+            queue = SendQueue(path)
+            job_ids = [queue.put(valid_message) for i in range(300)]
+            children = []
+            for i in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        child_queue = SendQueue(path)
+                        with open(os.path.join(tmp_dir, 'claimed-%s' % i), 'w') as claimed:
+                            for job in iter(lambda: child_queue.get(timeout=0), None):
+                                claimed.write(job[0] + '\n')
+                    finally:
+                        os._exit(0)
+                children.append(pid)
+            for pid in children:
+                os.waitpid(pid, 0)
+            claimed = []
+            for i in range(4):
+                with open(os.path.join(tmp_dir, 'claimed-%s' % i)) as lines:
+                    claimed.extend(lines.read().split())
+            assert sorted(claimed) == sorted(job_ids)
+            queue.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_workers_are_replaced(self):
+        server = PreforkServer(app, '127.0.0.1', 0, workers=2, max_requests=1, threads=2, graceful_timeout=5)
+        port = server.address[1]
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve()
+            finally:
+                os._exit(0)
+        server.listener.close()
+        try:
+            session = requests.Session()
+            session.trust_env = False
+            workers = set()
+            for i in range(4):
+                response = session.get('http://127.0.0.1:%s/stats' % port, timeout=10)
+                assert response.status_code == 200
+                workers.add(response.json()['worker'])
+            # one request per worker
+            assert len(workers) == 4
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            assert os.waitpid(pid, 0)[1] == 0
+
+
+class TemplateTests(unittest.TestCase):
+    def setUp(self):
+        simple_email.provider_router.reset()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = TemplateStore(os.path.join(self.tmp_dir, 'templates.db'), cache_size=2)
+        self.patch = mock.patch.object(email_templates, '_template_store', self.store)
+        self.patch.start()
+        self.store.save('welcome', u'Hi {{name}}', u'Your code is {{ code }}, {{name}}.', u'<p>Hi {{name}}</p>')
+        self.messages = [dict(valid_message, template_id='welcome', template_vars={'name': 'Ann & Bob', 'code': 42}),
+                         dict(valid_message, to_email='someone@gmail.com', template_id='welcome', template_vars={'name': 'Cy'})]
+
+    def tearDown(self):
+        self.patch.stop()
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+        simple_email.provider_router.reset()
+
+    def test_render(self):
+        template = CompiledTemplate('welcome', 1, u'Hi {{name}}', u'{{name}}: {{code}}', u'<p>{{name}}</p>')
+        assert template.fields == ['code', 'name']
+        assert template.render({'name': 'Ann & Bob', 'code': 42}) == (u'Hi Ann & Bob', u'Ann & Bob: 42', u'<p>Ann &amp; Bob</p>')
+        assert template.render({}) == (u'Hi ', u': ', u'<p></p>')
+        assert template.native('handlebars') == (u'Hi {{{name}}}', u'{{{name}}}: {{{code}}}', u'<p>{{name}}</p>')
+        assert template.native('mailgun')[2] == u'<p>%recipient.name__html%</p>'
+        assert template.mailgun_variables({'name': '<Ann>'}) == {'name': '<Ann>', 'name__html': '&lt;Ann&gt;', 'code': ''}
+
+    def test_versions_and_cache(self):
+        assert self.store.save('welcome', u'Hello {{name}}', u'content') == 2
+        assert self.store.get('welcome').sources() == (u'Hello {{name}}', u'content', None)
+        assert self.store.get('welcome', 1).sources()[0] == u'Hi {{name}}'
+        assert self.store.get('welcome', 2) is self.store.get('welcome')
+        assert self.store.get('other') is None
+        assert self.store.stats() == {'size': 2, 'max_size': 2, 'hits': 2, 'misses': 2}
+
+    def test_batch_merged_by_the_providers(self):
+        mandrill_server = FakeProviderServer(MANDRILL).start()
+        mailgun_server = FakeProviderServer(MAILGUN).start()
+        try:
+            with use_fake_providers(mandrill_server, mailgun_server):
+                results = simple_email.send_batch(self.messages)
+                mailgun_results = MailgunEmail().send_batch([simple_email.resolve_template(message_data)[0] for message_data in self.messages])
+        finally:
+            mandrill_server.stop()
+            mailgun_server.stop()
+        for result in results + mailgun_results:
+            assert_success_result(result)
+        # one call for both recipients, with the template in handlebars
+        assert mandrill_server.calls == 1
+        sent = mandrill_server.last_message
+        assert sent['subject'] == 'Hi {{{name}}}'
+        assert sent['merge_language'] == 'handlebars'
+        assert sent['merge_vars'] == [{'rcpt': 'dawen.uiuc@gmail.com', 'vars': [{'name': 'code', 'content': '42'}, {'name': 'name', 'content': 'Ann & Bob'}]},
+                                      {'rcpt': 'someone@gmail.com', 'vars': [{'name': 'name', 'content': 'Cy'}]}]
+        sent = mailgun_server.last_message
+        assert sent['subject'] == ['Hi %recipient.name%']
+        assert json.loads(sent['recipient-variables'][0])['someone@gmail.com'] == {'name': 'Cy', 'name__html': 'Cy', 'code': ''}
+
+    def test_smtp_renders(self):
+        server = FakeSmtpServer().start()
+        pool = SmtpConnectionPool('127.0.0.1', server.port, username='', starttls=False, timeout=1)
+        try:
+            with mock.patch.dict(providers.registry._clients, {'smtp': pool}):
+                assert_success_result(SmtpEmail().send(simple_email.resolve_template(self.messages[0])[0]))
+        finally:
+            pool.close()
+            server.stop()
+        message = email.message_from_string(server.messages[0][2])
+        assert message['Subject'] == 'Hi Ann & Bob'
+        text, html = message.get_payload()
+        assert text.get_payload(decode=True) == 'Your code is 42, Ann & Bob.'
+        assert html.get_payload(decode=True) == '<p>Hi Ann &amp; Bob</p>'
+
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_endpoints(self, mandrill_send):
+        mandrill_send.return_value = simple_email.success_result_obj
+        client = app.test_client()
+        response = client.put('/templates/welcome', data=json.dumps({'subject': 'Hello {{name}}', 'content': 'content'}),
+                              content_type='application/json')
+        assert response.status_code == 201
+        assert json.loads(response.data) == {'template_id': 'welcome', 'version': 2}
+        response = client.put('/templates/welcome', data=json.dumps({'subject': '', 'content': 'content'}), content_type='application/json')
+        assert response.status_code == 400
+        assert json.loads(client.get('/templates/welcome?version=1').data)['fields'] == ['code', 'name']
+
+        body = {'to_email': 'dawen.uiuc@gmail.com', 'from_email': 'uber@gmail.com', 'template_id': 'welcome', 'template_vars': {'name': 'Ann'}}
+        response = client.post('/v1/messages', data=json.dumps(body), content_type='application/json')
+        assert response.status_code == 200
+        sent = mandrill_send.call_args[0][0]
+        assert (sent['subject'], sent['template_version'], sent['template_vars']) == (u'Hello {{name}}', 2, {'name': 'Ann'})
+        response = client.post('/v1/messages', data=json.dumps(dict(body, template_id='other')), content_type='application/json')
+        assert response.status_code == 404
+        response = client.post('/v1/messages', data=json.dumps(dict(body, template_vars=['Ann'])), content_type='application/json')
+        assert json.loads(response.data)['message'] == 'template_vars must be an object of strings or numbers'
+
+
+class SchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = LaneScheduler({'transactional': {'slots': 2, 'weight': 3, 'deadline': 10, 'max_waiting': 10},
+                                        'bulk': {'slots': 2, 'weight': 1, 'deadline': 0.2, 'max_waiting': 3}}, concurrency=1)
+        self.order = []
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def queue_up(self, lane, sender, name):
+        # a thread waiting for a slot, it records its name when it gets one
+        waiting = self.scheduler.stats()[lane]['waiting']
+        def send():
+            with self.scheduler.slot(lane, sender):
+                self.order.append(name)
+        thread = threading.Thread(target=send)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        while self.scheduler.stats()[lane]['waiting'] == waiting:
+            time.sleep(0.001)
+
+    def run_queued(self, lane):
+        self.scheduler.release(lane)
+        for thread in self.threads:
+            thread.join(5)
+
+    def test_lanes_share_by_weight(self):
+        self.scheduler.acquire('bulk', 'news@example.com')
+        for i in range(3):
+            self.queue_up('bulk', 'news@example.com', 'b%s' % i)
+        for i in range(6):
+            self.queue_up('transactional', 'shop@example.com', 't%s' % i)
+        self.run_queued('bulk')
+        assert self.order == ['t0', 't1', 't2', 't3', 'b0', 't4', 't5', 'b1', 'b2']
+        stats = self.scheduler.stats()
+        assert (stats['transactional']['granted'], stats['bulk']['granted'], stats['bulk']['waiting']) == (6, 4, 0)
+        assert stats['bulk']['wait_max'] >= stats['bulk']['wait_avg'] > 0
+
+    def test_senders_take_turns(self):
+        self.scheduler.acquire('transactional', 'a@example.com')
+        for i in range(3):
+            self.queue_up('transactional', 'a@example.com', 'a%s' % i)
+        self.queue_up('transactional', 'b@example.com', 'b0')
+        self.run_queued('transactional')
+        assert self.order == ['a0', 'b0', 'a1', 'a2']
+
+    def test_busy_lane(self):
+        self.scheduler.acquire('transactional', 'a@example.com')
+        start = time.time()
+        self.assertRaises(LaneBusy, self.scheduler.acquire, 'bulk', 'a@example.com')
+        assert time.time() - start >= 0.2
+        for i in range(3):
+            self.queue_up('bulk', 'a@example.com', 'b%s' % i)
+        # the lane is full, no waiting
+        self.assertRaises(LaneBusy, self.scheduler.acquire, 'bulk', 'a@example.com')
+        assert self.scheduler.stats()['bulk']['busy'] == 2
+
+    @mock.patch.object(MailgunEmail, 'send_batch')
+    @mock.patch.object(MandrillEmail, 'send_batch')
+    @mock.patch.object(MandrillEmail, 'send')
+    def test_send_in_lanes(self, mandrill_send, mandrill_send_batch, mailgun_send_batch):
+        mandrill_send.return_value = simple_email.success_result_obj
+        mandrill_send_batch.side_effect = lambda batch: [simple_email.success_result_obj] * len(batch)
+        simple_email.provider_router.reset()
+        with mock.patch.object(scheduler, '_lane_scheduler', self.scheduler):
+            assert_success_result(simple_email.send_email(valid_message))
+            results = simple_email.send_batch([valid_message, dict(valid_message, to_email='someone@gmail.com'),
+                                               dict(valid_message, priority='transactional')])
+            assert [result.status for result in results] == ['success'] * 3
+            assert_error_result(simple_email.send_email(dict(valid_message, priority='urgent')),
+                                "priority must be one of bulk, transactional")
+            stats = json.loads(app.test_client().get('/stats').data)['lanes']
+        simple_email.provider_router.reset()
+        assert (stats['transactional']['granted'], stats['bulk']['granted']) == (2, 1)
+
+
 def success_response_side_effect():
     return [[{u'status': u'sent', u'_id': u'857366672c72487eb94fb5ce3f3675d3', u'email': u'dawen.uiuc@gmail.com', u'reject_reason': None}]]
 
@@ -249,13 +1847,14 @@ testCase1 = unittest.FunctionTestCase(test_using_mailgun)
 testCase2 = unittest.FunctionTestCase(test_using_mandrill)
 testCase3 = unittest.FunctionTestCase(test_rejected_status)
 testCase4 = unittest.FunctionTestCase(test_both_mailgun_mandrill_error)
+testCase5 = unittest.FunctionTestCase(test_enqueue_email)
+
+
+def load_tests(loader, tests, pattern):
+    # unittest.main() runs the test functions along with the TestCase classes, pytest collects them itself
+    tests.addTests([testCase0, testCase1, testCase2, testCase3, testCase4, testCase5])
+    return tests
+
 
 if __name__ == '__main__':
-    test_suite = unittest.TestSuite()
-    test_suite.addTest(testCase0)
-    test_suite.addTest(testCase1)
-    test_suite.addTest(testCase2)
-    test_suite.addTest(testCase3)
-    test_suite.addTest(testCase4)
-    unittest.TextTestRunner().run(test_suite)
-    unittest.main()
\ No newline at end of file
+    unittest.main()
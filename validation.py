@@ -0,0 +1,139 @@
+'''
+Validation of the send requests.
+
+Addresses are checked against the RFC 2822 addr-spec grammar of validate_email, compiled once,
+and the verdicts of recently seen addresses are kept in an LRU cache since the same senders and
+recipients come back all the time.
+'''
+from collections import OrderedDict
+from validate_email import VALID_ADDRESS_REGEXP
+import re, threading, config, email_templates
+
+MAX_SUBJECT_LENGTH = 1000
+MAX_CONTENT_LENGTH = 10000
+MAX_HTML_LENGTH = 100000
+
+# same grammar as validate_email(), which recompiles or looks it up on every call
+ADDRESS_PATTERN = re.compile(VALID_ADDRESS_REGEXP)
+
+
+class AddressCache(object):
+    ''' A thread safe LRU cache of address verdicts '''
+
+    def __init__(self, size=None):
+        self.size = size or config.VALIDATION_CACHE_SIZE
+        self._verdicts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_valid(self, address):
+        with self._lock:
+            verdict = self._verdicts.pop(address, None)
+            if verdict is not None:
+                self.hits += 1
+                self._verdicts[address] = verdict
+                return verdict
+            self.misses += 1
+        verdict = ADDRESS_PATTERN.match(address) is not None
+        with self._lock:
+            self._verdicts[address] = verdict
+            if len(self._verdicts) > self.size:
+                self._verdicts.popitem(last=False)
+        return verdict
+
+    def clear(self):
+        with self._lock:
+            self._verdicts.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._verdicts), 'max_size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+address_cache = AddressCache()
+
+
+def check_message(message_data, verdicts=None):
+    ''' Validate one message
+
+    Args:
+        message_data: same as send_email
+        verdicts: an optional dict of address -> verdict already worked out, see check_messages
+
+    Returns:
+        the error message, or None if the message is valid
+    '''
+    if verdicts is None:
+        to_valid = address_cache.is_valid(message_data['to_email'])
+        from_valid = to_valid and address_cache.is_valid(message_data['from_email'])
+    else:
+        to_valid = verdicts[message_data['to_email']]
+        from_valid = verdicts[message_data['from_email']]
+    if not to_valid:
+        return "invalid recipient email"
+    if not from_valid:
+        return "invalid sender email"
+    subject = message_data['subject']
+    if subject == "":
+        return "subject cannot be empty"
+    elif len(subject) > MAX_SUBJECT_LENGTH:
+        return "subject cannot be more than %s characters" % MAX_SUBJECT_LENGTH
+    content = message_data['content']
+    if content == "":
+        return "content cannot be empty"
+    elif len(content) > MAX_CONTENT_LENGTH:
+        return "content cannot be more than %s characters" % MAX_CONTENT_LENGTH
+    html = message_data.get('html')
+    if html and len(html) > MAX_HTML_LENGTH:
+        return "html cannot be more than %s characters" % MAX_HTML_LENGTH
+    priority = message_data.get('priority')
+    if priority and priority not in config.LANES:
+        return "priority must be one of %s" % ', '.join(sorted(config.LANES))
+    values = message_data.get('template_vars')
+    if values:
+        if not email_templates.check_values(values):
+            return "template_vars must be an object of strings or numbers"
+        if sum(len(unicode(value)) for value in values.values()) > MAX_CONTENT_LENGTH:
+            return "template_vars cannot be more than %s characters in total" % MAX_CONTENT_LENGTH
+    attachments = message_data.get('attachments')
+    if attachments and sum(attachment['size'] for attachment in attachments) > config.ATTACHMENT_MAX_SIZE:
+        return "attachments cannot be more than %s bytes in total" % config.ATTACHMENT_MAX_SIZE
+
+
+def check_template(subject, content, html=None):
+    ''' Validate a template before it's saved
+
+    Returns:
+        the error message, or None if the template is valid
+    '''
+    if not isinstance(subject, basestring) or subject == "":
+        return "subject cannot be empty"
+    elif len(subject) > MAX_SUBJECT_LENGTH:
+        return "subject cannot be more than %s characters" % MAX_SUBJECT_LENGTH
+    if not isinstance(content, basestring) or content == "":
+        return "content cannot be empty"
+    elif len(content) > MAX_CONTENT_LENGTH:
+        return "content cannot be more than %s characters" % MAX_CONTENT_LENGTH
+    if html is not None and not isinstance(html, basestring):
+        return "html must be a string"
+    if html and len(html) > MAX_HTML_LENGTH:
+        return "html cannot be more than %s characters" % MAX_HTML_LENGTH
+
+
+def check_messages(messages):
+    ''' Validate a list of messages in one pass
+
+    Each distinct address of the batch is checked once, then every message is checked against those verdicts.
+
+    Returns:
+        a list with the error message (or None) of each message, in the same order
+    '''
+    addresses = set()
+    for message_data in messages:
+        addresses.add(message_data['to_email'])
+        addresses.add(message_data['from_email'])
+    verdicts = dict((address, address_cache.is_valid(address)) for address in addresses)
+    return [check_message(message_data, verdicts) for message_data in messages]
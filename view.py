@@ -1,7 +1,20 @@
-from flask import Flask, request, render_template
-from simple_email import send_email
+from flask import Flask, Response, request, render_template, jsonify, abort
+from simple_email import send_email, send_batch, provider_router, configure_logging, ErrorResult, MESSAGE_FIELDS
+from send_queue import enqueue_email, send_with_retries, lookup_queue, QueuedResult
+from ledger import get_ledger
+from email_templates import get_template_store
+from scheduler import get_lane_scheduler
+from providers import registry
+from io import BytesIO
+import base64, json, os, config, http_session, validation, metrics, attachments
 
 app = Flask(__name__)
+# refuse the requests too large to be an email before reading them, base64 in a JSON body is a third larger than the files
+app.config['MAX_CONTENT_LENGTH'] = 2 * config.ATTACHMENT_MAX_SIZE
+
+@app.before_first_request
+def startup():
+    configure_logging()
 
 @app.route('/')
 def index():
@@ -9,10 +22,179 @@ def index():
 
 @app.route('/', methods=['POST'])
 def send():
-    result = send_email(request.form)
+    if request.mimetype == 'application/json':
+        return send_message()
+    # a client retrying after a timeout passes the same key so that the email is not sent twice
+    result = dispatch(form_message(), request.headers.get('Idempotency-Key') or request.form.get('idempotency_key'))
+    if wants_json():
+        return json_response(result.to_dict(), result.status_code)
     # hide the technical errors for normal email users by just returning a
     # user friendly message
-    return render_template('index.html', message = result.message)
+    return render_template('index.html', message = result.message), result.status_code
+
+@app.route('/v1/messages', methods=['POST'])
+def send_message():
+    # JSON body with the same fields as the POST / form, answered with the result and its status code
+    message_data = json_message(request.json)
+    if message_data is None:
+        return json_response({'status': 'error', 'status_code': 400, 'message': 'expecting a JSON object with string fields'}, 400)
+    result = dispatch(message_data, request.headers.get('Idempotency-Key'))
+    return json_response(result.to_dict(), result.status_code)
+
+def dispatch(message_data, idempotency_key=None):
+    result = None
+    try:
+        if config.SEND_ASYNC:
+            result = enqueue_email(message_data, idempotency_key)
+        elif config.RETRY_ENABLED and not idempotency_key:
+            # with a key the client does the retries, retrying here too could send the email twice
+            result = send_with_retries(message_data)
+        else:
+            result = send_email(message_data, idempotency_key)
+        return result
+    finally:
+        if not isinstance(result, QueuedResult):
+            # the workers remove the attachments of the queued emails once they are done with them
+            attachments.remove(message_data.get('attachments'))
+
+def form_message():
+    # the form fields, plus the uploaded files spooled to disk (werkzeug keeps the large uploads in temporary files)
+    uploads = [upload for upload in request.files.getlist('attachments') if upload.filename]
+    if not uploads:
+        return request.form
+    message_data = request.form.to_dict()
+    message_data['attachments'] = [attachments.spool(upload.stream, upload.filename, upload.mimetype) for upload in uploads]
+    return message_data
+
+def wants_json():
+    # API clients posting the form to / get JSON, browsers (and */*) keep getting the page
+    return request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+
+def json_message(body):
+    # the message fields of a JSON body, a missing field is treated as empty like in the form
+    message_data = json_fields(body)
+    if message_data is None:
+        return None
+    if body.get('attachments'):
+        message_data['attachments'] = json_attachments(body['attachments'])
+        if message_data['attachments'] is None:
+            return None
+    return message_data
+
+def json_fields(body):
+    # the fields of a JSON message but the attachments, None when one has the wrong type
+    if not isinstance(body, dict):
+        return None
+    message_data = dict((field, body.get(field, "")) for field in MESSAGE_FIELDS)
+    if not all(isinstance(value, basestring) for value in message_data.values()):
+        return None
+    if body.get('html'):
+        if not isinstance(body['html'], basestring):
+            return None
+        message_data['html'] = body['html']
+    if body.get('priority'):
+        if not isinstance(body['priority'], basestring):
+            return None
+        message_data['priority'] = body['priority']
+    if body.get('template_id'):
+        # the subject, content and html come from the template, see simple_email.resolve_template
+        version = body.get('template_version', 0)
+        if not isinstance(body['template_id'], basestring) or not isinstance(version, (int, long)) or isinstance(version, bool):
+            return None
+        for field in ('template_id', 'template_version', 'template_vars'):
+            if body.get(field):
+                message_data[field] = body[field]
+    return message_data
+
+def json_attachments(files):
+    # the attachments of a JSON body, in Mandrill's format: [{"name": ..., "type": ..., "content": base64}, ...]
+    if not isinstance(files, list) or not all(isinstance(f, dict) and isinstance(f.get('name'), basestring)
+                                              and isinstance(f.get('type', ''), basestring)
+                                              and isinstance(f.get('content'), basestring) for f in files):
+        return None
+    spooled = []
+    try:
+        for f in files:
+            spooled.append(attachments.spool(BytesIO(base64.b64decode(f['content'])), f['name'], f.get('type')))
+    except (TypeError, ValueError):
+        # not base64
+        attachments.remove(spooled)
+        return None
+    return spooled
+
+def json_response(data, status_code=200):
+    # compact JSON, jsonify indents its output
+    return Response(json.dumps(data, separators=(',', ':')), status=status_code, mimetype='application/json')
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    # JSON body: {"messages": [message, ...]}, each message has the same fields as the POST / form
+    body = request.json
+    messages = body.get('messages') if isinstance(body, dict) else None
+    if not isinstance(messages, list):
+        return jsonify(status='error', message='expecting a JSON body with a list of messages'), 400
+    # a message that isn't an object or has a field of the wrong type gets its own error, the others are still sent
+    messages = [json_fields(message) for message in messages]
+    sent = iter(send_batch([message for message in messages if message is not None]))
+    results = [next(sent) if message is not None else ErrorResult('expecting a JSON object with string fields')
+               for message in messages]
+    return jsonify(results=[result.to_dict() for result in results])
+
+@app.route('/templates/<template_id>', methods=['PUT'])
+def save_template(template_id):
+    # JSON body: {"subject": ..., "content": ..., "html": ...}, saved as a new version of the template
+    body = request.json
+    if not isinstance(body, dict):
+        return json_response({'status': 'error', 'status_code': 400, 'message': 'expecting a JSON object'}, 400)
+    error = validation.check_template(body.get('subject'), body.get('content'), body.get('html'))
+    if error is not None:
+        return json_response({'status': 'error', 'status_code': 400, 'message': error}, 400)
+    version = get_template_store().save(template_id, body['subject'], body['content'], body.get('html'))
+    return json_response({'template_id': template_id, 'version': version}, 201)
+
+@app.route('/templates/<template_id>')
+def template(template_id):
+    # the latest version of a template, or the one of ?version=
+    found = get_template_store().get(template_id, request.args.get('version', type=int))
+    if found is None:
+        abort(404)
+    subject, content, html = found.sources()
+    return jsonify(template_id=template_id, version=found.version, subject=subject, content=content, html=html,
+                   fields=found.fields)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if not (config.SEND_ASYNC or config.RETRY_ENABLED):
+        # nothing is queued
+        abort(404)
+    job = lookup_queue().status(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+@app.route('/sends/<idempotency_key>')
+def send_record(idempotency_key):
+    # was the email with this idempotency key sent?
+    record = get_ledger().lookup(idempotency_key)
+    if record is None:
+        abort(404)
+    return jsonify(record)
+
+@app.route('/stats')
+def stats():
+    smtp_pool = registry.get('smtp').stats() if config.SMTP_HOST else None
+    queue = lookup_queue().lane_depths() if config.SEND_ASYNC or config.RETRY_ENABLED else None
+    return jsonify(providers=provider_router.stats(), http_pools=http_session.pool_stats(),
+                   validation_cache=validation.address_cache.stats(), smtp_pool=smtp_pool,
+                   attachment_cache=attachments.get_encoded_cache().stats(), template_cache=get_template_store().stats(),
+                   lanes=get_lane_scheduler().stats(), queue=queue, worker=os.getpid())
+
+@app.route('/metrics')
+def metrics_page():
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
+    # the development server, see server.py to serve in production
     app.run()